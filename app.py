@@ -31,6 +31,15 @@ def start_channel(channel_name: str):
                         const.FEISHU, const.DINGTALK]:
         PluginManager().load_plugins()
 
+    if conf().get("config_watch", False):
+        # 配置文件变化时自动重载，只重建受影响的bot和插件
+        from common.file_watcher import FileWatcher
+
+        watcher = FileWatcher(conf().get("config_watch_interval", 3))
+        watcher.watch("./config/config.json", load_config)
+        watcher.watch("./plugins/config.json", PluginManager().reload_all_config)
+        watcher.start()
+
     if conf().get("use_linkai"):
         try:
             from common import linkai_client
@@ -0,0 +1,69 @@
+"""
+基准测试：50000个随机中文敏感词，比较WordsSearch与ArrayWordsSearch的编译、读取缓存、内存和扫描耗时
+python -m benchmarks.banwords_search
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# 直接导入词库实现，导入plugins.banwords会注册插件
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "plugins", "banwords", "lib"))
+from ArrayWordsSearch import ArrayWordsSearch  # noqa: E402
+from WordsSearch import WordsSearch  # noqa: E402
+
+
+def main():
+    random.seed(0)
+    chars = [chr(c) for c in range(0x4E00, 0x4E00 + 3000)]
+    words = list({"".join(random.choices(chars, k=random.randint(2, 6))) for _ in range(50000)})
+    # dense: 全部是关键词中出现过的字符；mixed: 常见汉字、字母和标点混合，更接近实际消息
+    mixed_chars = [chr(c) for c in range(0x4E00, 0x9FA5)] + list("abcdefghijklmnopqrstuvwxyz0123456789 ，。！？")
+    texts = {
+        "dense": "".join(random.choices(chars, k=2000)) + words[123] + "".join(random.choices(chars, k=2000)),
+        "mixed": "".join(random.choices(mixed_chars, k=2000)) + words[123] + "".join(random.choices(mixed_chars, k=2000)),
+    }
+
+    def build_time(searcher, *args):
+        start = time.perf_counter()
+        searcher.SetKeywords(words, *args)
+        return time.perf_counter() - start
+
+    def build_memory(cls):
+        tracemalloc.start()
+        searcher = cls()
+        searcher.SetKeywords(words)
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return memory
+
+    def scan_time(searcher, text):
+        start = time.perf_counter()
+        for _ in range(20):
+            searcher.ContainsAny(text)
+            searcher.FindAll(text)
+            searcher.Replace(text)
+        return (time.perf_counter() - start) / 20
+
+    cache_path = os.path.join(tempfile.mkdtemp(), "banwords.dat")
+    old, new, cached = WordsSearch(), ArrayWordsSearch(), ArrayWordsSearch()
+    old_build = build_time(old)
+    new_build = build_time(new, cache_path)
+    cache_load = build_time(cached, cache_path)
+    for text in texts.values():
+        assert old.FindAll(text) == new.FindAll(text) == cached.FindAll(text)
+        assert old.FindFirst(text) == new.FindFirst(text)
+        assert old.Replace(text) == new.Replace(text)
+    print("{} words, {} chars text".format(len(words), len(texts["dense"])))
+    for name, searcher, build in (("WordsSearch", old, old_build), ("ArrayWordsSearch", new, new_build)):
+        print("{:<17} build {:.0f}ms, memory {:.1f}MB, {}".format(
+            name + ":", build * 1000, build_memory(type(searcher)) / 2**20,
+            ", ".join("scan {} {:.2f}ms".format(k, scan_time(searcher, text) * 1000) for k, text in texts.items())))
+    print("ArrayWordsSearch load from cache {:.0f}ms".format(cache_load * 1000))
+
+
+if __name__ == "__main__":
+    main()
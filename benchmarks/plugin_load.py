@@ -0,0 +1,34 @@
+"""
+基准测试：在子进程中分别测量全部导入和按清单延迟导入时load_plugins的耗时
+python -m benchmarks.plugin_load
+"""
+
+import subprocess
+import sys
+
+CODE = """
+import time
+start = time.perf_counter()
+from config import conf, load_config
+load_config()
+conf()["plugin_lazy_load"] = {lazy}
+from plugins import PluginManager
+PluginManager().load_plugins()
+print("%.1f" % ((time.perf_counter() - start) * 1000))
+"""
+
+
+def time_to_ready(lazy):
+    output = subprocess.run([sys.executable, "-c", CODE.format(lazy=lazy)], capture_output=True, text=True).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def main():
+    time_to_ready(True)  # 生成清单
+    for lazy in (False, True):
+        times = sorted(time_to_ready(lazy) for _ in range(3))
+        print("plugin_lazy_load={}: time to ready {:.1f}ms (median of 3)".format(lazy, times[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+基准测试：在存在10k个处理中的空闲session时，测量消息从produce到开始处理的延迟
+python -m benchmarks.session_scheduler
+"""
+
+import statistics
+import threading
+import time
+
+from bridge.context import Context, ContextType
+from channel.chat_channel import ChatChannel
+from common.dequeue import Dequeue
+from config import load_config
+
+
+class BenchChannel(ChatChannel):
+    def __init__(self):
+        super().__init__()
+        self.latencies = []
+        self.done = threading.Semaphore(0)
+
+    def _handle(self, context: Context):
+        self.latencies.append(time.perf_counter() - context["produce_time"])
+        self.done.release()
+
+
+def main():
+    load_config()
+    channel = BenchChannel()
+    with channel.lock:
+        for i in range(10000):
+            semaphore = threading.BoundedSemaphore(1)
+            semaphore.acquire()  # 模拟正在等待LLM回复的session
+            channel.sessions["idle_{}".format(i)] = [Dequeue(), semaphore]
+    for i in range(200):
+        context = Context(ContextType.TEXT, "hello", {"session_id": "bench_{}".format(i)})
+        context["produce_time"] = time.perf_counter()
+        channel.produce(context)
+        channel.done.acquire()
+    latencies = sorted(channel.latencies)
+    print("enqueue-to-dispatch with 10k idle sessions: p50={:.3f}ms p99={:.3f}ms max={:.3f}ms".format(
+        statistics.median(latencies) * 1000, latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000))
+
+
+if __name__ == "__main__":
+    main()
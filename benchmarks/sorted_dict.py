@@ -0,0 +1,29 @@
+"""
+基准测试：1000个插件规模下SortedDict的插入、调整优先级和删除
+python -m benchmarks.sorted_dict
+"""
+
+import random
+import time
+
+from common.sorted_dict import SortedDict
+
+
+def main():
+    n = 1000
+    sorted_dict = SortedDict(lambda k, v: v["priority"], reverse=True)
+    start = time.perf_counter()
+    for i in range(n):
+        sorted_dict["plugin_{}".format(i)] = {"priority": random.randint(-1000, 1000)}
+    for i in range(n):
+        key = "plugin_{}".format(random.randrange(n))
+        sorted_dict[key]["priority"] = random.randint(-1000, 1000)
+        sorted_dict._update_order(key)
+        sorted_dict.keys()
+    for i in range(n):
+        del sorted_dict["plugin_{}".format(i)]
+    print("{} inserts, {} priority updates with keys(), {} deletes: {:.3f}ms".format(n, n, n, (time.perf_counter() - start) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""
+基准测试：50轮对话的历史，对比每次全量tokenize与使用encoder/字符串缓存后的计数耗时
+python -m benchmarks.token_count
+"""
+
+import time
+
+import tiktoken
+
+from bot.chatgpt.chat_gpt_session import num_tokens_from_messages
+
+
+def count_uncached(messages):
+    encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    return sum(4 + sum(len(encoding.encode(v)) for v in m.values()) for m in messages) + 3
+
+
+def main():
+    history = [{"role": "system", "content": "You are a helpful assistant. " * 20}]
+    for i in range(50):
+        history.append({"role": "user", "content": "这是第{}轮提问，请帮我解释一下这段话的含义。".format(i) * 3})
+        history.append({"role": "assistant", "content": "Answer number {} with some explanation text. ".format(i) * 8})
+    rounds = 200
+
+    count_uncached(history)  # 预热tiktoken的bpe文件加载
+    start = time.perf_counter()
+    for _ in range(rounds):
+        before = count_uncached(history)
+    uncached = (time.perf_counter() - start) / rounds
+
+    num_tokens_from_messages(history, "gpt-3.5-turbo")
+    start = time.perf_counter()
+    for _ in range(rounds):
+        after = num_tokens_from_messages(history, "gpt-3.5-turbo")
+    cached = (time.perf_counter() - start) / rounds
+    assert before == after
+    print("50-turn history ({} tokens): uncached={:.3f}ms cached={:.3f}ms".format(after, uncached * 1000, cached * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,7 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry import CIRCUIT_OPEN_REPLY, RetryPolicy
 from common import const
 from config import conf, load_config
 
@@ -23,6 +24,7 @@ class AliQwenBot(Bot):
         super().__init__()
         self.api_key_expired_time = self.set_api_key()
         self.sessions = SessionManager(AliQwenSession, model=conf().get("model", const.QWEN))
+        self.retry = RetryPolicy("qwen")
 
     def api_key_client(self):
         return broadscope_bailian.AccessTokenClient(access_key_id=self.access_key_id(), access_key_secret=self.access_key_secret())
@@ -67,10 +69,11 @@ class AliQwenBot(Bot):
                 reply = Reply(ReplyType.INFO, "配置已更新")
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
+            retry_count = context.get("retry_count", 0)
+            session = self.sessions.session_query(query, session_id, retry=retry_count > 0)
             logger.debug("[QWEN] session query={}".format(session.messages))
 
-            reply_content = self.reply_text(session)
+            reply_content = self.reply_text(session, retry_count=retry_count)
             logger.debug(
                 "[QWEN] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -100,12 +103,15 @@ class AliQwenBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
+        if not self.retry.allow():
+            return {"completion_tokens": 0, "content": CIRCUIT_OPEN_REPLY}
         try:
             prompt, history = self.convert_messages_format(session.messages)
             self.update_api_key_if_expired()
             # NOTE 阿里百炼的call()函数未提供temperature参数，考虑到temperature和top_p参数作用相同，取两者较小的值作为top_p参数传入，详情见文档 https://help.aliyun.com/document_detail/2587502.htm
             response = broadscope_bailian.Completions().call(app_id=self.app_id(), prompt=prompt, history=history, top_p=min(self.temperature(), self.top_p()))
             completion_content = self.get_completion_content(response, self.node_id())
+            self.retry.record_success()
             completion_tokens, total_tokens = self.calc_tokens(session.messages, completion_content)
             return {
                 "total_tokens": total_tokens,
@@ -113,34 +119,30 @@ class AliQwenBot(Bot):
                 "content": completion_content,
             }
         except Exception as e:
-            need_retry = retry_count < 2
+            need_retry = True
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[QWEN] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[QWEN] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
+                self.retry.record_failure()
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[QWEN] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
+                self.retry.record_failure()
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[QWEN] APIConnectionError: {}".format(e))
                 need_retry = False
                 result["content"] = "我连接不到你的网络"
+                self.retry.record_failure()
             else:
                 logger.exception("[QWEN] Exception: {}".format(e))
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
-            if need_retry:
-                logger.warn("[QWEN] 第{}次重试".format(retry_count + 1))
+            if need_retry and self.retry.wait(retry_count, e):
                 return self.reply_text(session, retry_count + 1)
             else:
                 return result
@@ -0,0 +1,232 @@
+"""
+openai兼容接口的key/endpoint池
+每个成员有自己的每分钟请求数(rpm)和token数(tpm)预算，请求时选择负载最低的成员，都超出预算时等待最早回到预算内的成员
+返回401/403/429/5xx或连接失败、超时的成员被暂时移出，冷却结束后重新加入，连续失败时冷却时间翻倍
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+
+from common.log import logger
+from common.retry import throttle
+from config import conf, subscribe_config
+
+WINDOW_SECONDS = 60
+
+
+class PoolMember(object):
+    def __init__(self, api_key, api_base=None, weight=1, rpm=0, tpm=0, **extra):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.weight = max(weight or 1, 1)
+        self.rpm = rpm or 0
+        self.tpm = tpm or 0
+        self.extra = extra  # api_type、api_version、deployment_id等，请求时原样传给openai
+        self.inflight = 0
+        self.window = deque()  # 最近WINDOW_SECONDS秒内的请求，每项为[发起时间, token数]
+        self.window_tokens = 0
+        self.ejected_until = 0
+        self.failures = 0  # 连续失败次数
+
+    @property
+    def name(self):
+        key = self.api_key or ""
+        return "{}***{}@{}".format(key[:3], key[-4:], self.api_base or "default")
+
+    def trim(self, now):
+        while self.window and now - self.window[0][0] >= WINDOW_SECONDS:
+            entry = self.window.popleft()
+            self.window_tokens -= entry[1]
+            entry[1] = None  # 已移出窗口，请求结束时不再计入token数
+
+    def within_budget(self):
+        return (not self.rpm or len(self.window) < self.rpm) and (not self.tpm or self.window_tokens < self.tpm)
+
+    def available_in(self, now):
+        """
+        还需等待多少秒，窗口中足够多的请求移出后才回到预算内
+        """
+        wait = 0
+        if self.rpm and len(self.window) >= self.rpm:
+            wait = self.window[len(self.window) - self.rpm][0] + WINDOW_SECONDS - now
+        if self.tpm and self.window_tokens >= self.tpm:
+            tokens = self.window_tokens
+            for start, entry_tokens in self.window:
+                tokens -= entry_tokens or 0
+                if tokens < self.tpm:
+                    wait = max(wait, start + WINDOW_SECONDS - now)
+                    break
+        return max(wait, 0)
+
+    def load(self):
+        # 最近一分钟的请求数加上处理中的请求数(处理中的请求也在窗口内，相当于加倍计算)，按权重折算
+        return (len(self.window) + self.inflight) / self.weight
+
+
+class Lease(object):
+    """
+    一次请求占用的成员，请求结束后需要交给ApiKeyPool.release
+    """
+
+    def __init__(self, member, entry):
+        self.member = member
+        self.entry = entry
+        self.released = False
+
+    def request_args(self, args):
+        member = self.member
+        request_args = dict(args)
+        request_args["api_key"] = member.api_key
+        if member.api_base:
+            request_args["api_base"] = member.api_base
+        request_args.update(member.extra)
+        return request_args
+
+
+class ApiKeyPool(object):
+    def __init__(self, members):
+        self.members = [PoolMember(**member) for member in members if member.get("api_key")]
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.members)
+
+    def try_acquire(self):
+        """
+        选择预算内负载最低的成员；未移出的成员都超出预算时不选择，返回最早回到预算内的等待时间；全部被移出时选最早恢复的成员
+        :return: (lease, 需要等待的秒数)，池为空时lease为None
+        """
+        if not self.members:
+            return None, 0
+        with self.lock:
+            now = time.time()
+            for member in self.members:
+                member.trim(now)
+            healthy = [member for member in self.members if member.ejected_until <= now]
+            if healthy:
+                candidates = [member for member in healthy if member.within_budget()]
+                if not candidates:
+                    return None, max(min(member.available_in(now) for member in healthy), 0.01)
+                member = min(candidates, key=PoolMember.load)
+            else:
+                member = min(self.members, key=lambda m: m.ejected_until)
+            entry = [now, 0]
+            member.window.append(entry)
+            member.inflight += 1
+            return Lease(member, entry), 0
+
+    def acquire(self, retry_count=0) -> Lease:
+        """
+        所有成员都超出预算时等待，在defer_retry范围内抛出RetryLater，由channel稍后重新调度，不计入重试次数
+        :return: 池为空时返回None
+        """
+        while True:
+            lease, wait = self.try_acquire()
+            if not wait:
+                return lease
+            logger.debug("[ApiKeyPool] all members over budget, wait {:.1f}s".format(wait))
+            throttle(wait, retry_count)
+
+    async def async_acquire(self) -> Lease:
+        """
+        acquire的asyncio版本，在事件循环中等待
+        """
+        while True:
+            lease, wait = self.try_acquire()
+            if not wait:
+                return lease
+            await asyncio.sleep(wait)
+
+    def release(self, lease: Lease, tokens=0, status=None, retry_after=None, failed=False):
+        """
+        :param tokens: 本次请求消耗的token数
+        :param status: 请求失败时的http状态码，401/403/429/5xx会使成员被暂时移出
+        :param retry_after: 429时接口要求的等待秒数，作为冷却时间
+        :param failed: 没有http状态码的失败(连接失败、超时)，同样使成员被暂时移出
+        """
+        if lease is None or lease.released:
+            return
+        member = lease.member
+        with self.lock:
+            lease.released = True
+            member.inflight -= 1
+            if tokens and lease.entry[1] is not None:
+                lease.entry[1] = tokens
+                member.window_tokens += tokens
+            if status is None and not failed:
+                member.failures = 0
+                return
+            if status is not None and status not in (401, 403, 429) and status < 500:
+                return
+            member.failures += 1
+            cooldown = conf().get("open_ai_api_pool_cooldown", 60)
+            if status == 429 and retry_after:
+                cooldown = retry_after
+            else:
+                cooldown = cooldown * min(2 ** (member.failures - 1), 16)
+            member.ejected_until = time.time() + cooldown
+        if status in (401, 403):
+            logger.error("[ApiKeyPool] {} auth failed, status={}, ejected for {}s".format(member.name, status, int(cooldown)))
+        elif status is None:
+            logger.warn("[ApiKeyPool] {} unreachable, ejected for {}s".format(member.name, int(cooldown)))
+        else:
+            logger.warn("[ApiKeyPool] {} status={}, ejected for {}s".format(member.name, status, int(cooldown)))
+
+    def cancel(self, lease: Lease):
+        """
+        归还没有发出请求的lease，不计入该成员的请求数，也不影响其健康状态
+        """
+        if lease is None or lease.released:
+            return
+        member = lease.member
+        with self.lock:
+            lease.released = True
+            member.inflight -= 1
+            if lease.entry[1] is not None:
+                member.window.remove(lease.entry)
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            for member in self.members:
+                member.trim(now)
+            return [
+                {
+                    "name": member.name,
+                    "inflight": member.inflight,
+                    "rpm": len(member.window),
+                    "tpm": member.window_tokens,
+                    "ejected": max(0, int(member.ejected_until - now)),
+                }
+                for member in self.members
+            ]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_openai_pool() -> ApiKeyPool:
+    """
+    按open_ai_api_pool创建的全局key池，未配置时只包含open_ai_api_key和open_ai_api_base
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            members = conf().get("open_ai_api_pool") or [{"api_key": conf().get("open_ai_api_key"), "api_base": conf().get("open_ai_api_base")}]
+            _pool = ApiKeyPool(members)
+            if len(_pool) > 1:
+                logger.info("[ApiKeyPool] {} members: {}".format(len(_pool), [member.name for member in _pool.members]))
+        return _pool
+
+
+def _on_config_changed(changed_keys, old_config, new_config):
+    global _pool
+    if {"open_ai_api_pool", "open_ai_api_key", "open_ai_api_base"} & set(changed_keys):
+        with _pool_lock:
+            _pool = None
+
+
+subscribe_config(_on_config_changed)
@@ -1,6 +1,7 @@
 # encoding:utf-8
 
-import requests
+from common import http_client
+from common.access_token import token_manager
 import json
 from common import const
 from bot.bot import Bot
@@ -78,7 +79,7 @@ class BaiduWenxinBot(Bot):
         try:
             logger.info("[BAIDU] model={}".format(session.model))
             access_token = self.get_access_token()
-            if access_token == 'None':
+            if not access_token:
                 logger.warn("[BAIDU] access token 获取失败")
                 return {
                     "total_tokens": 0,
@@ -90,9 +91,12 @@ class BaiduWenxinBot(Bot):
                 'Content-Type': 'application/json'
             }
             payload = {'messages': session.messages, 'system': self.prompt} if self.prompt_enabled else {'messages': session.messages}
-            response = requests.request("POST", url, headers=headers, data=json.dumps(payload))
+            response = http_client.request("POST", url, headers=headers, data=json.dumps(payload))
             response_text = json.loads(response.text)
             logger.info(f"[BAIDU] response text={response_text}")
+            if response_text.get("error_code") in (110, 111):
+                # access token失效或过期，下次请求重新获取
+                token_manager.invalidate("baidu_wenxin", BAIDU_API_KEY)
             res_content = response_text["result"]
             total_tokens = response_text["usage"]["total_tokens"]
             completion_tokens = response_text["usage"]["completion_tokens"]
@@ -112,9 +116,19 @@ class BaiduWenxinBot(Bot):
 
     def get_access_token(self):
         """
-        使用 AK，SK 生成鉴权签名（Access Token）
+        获取缓存的Access Token，过期前在后台刷新
         :return: access_token，或是None(如果错误)
         """
+        return token_manager.get("baidu_wenxin", BAIDU_API_KEY, self._request_access_token)
+
+    def _request_access_token(self):
+        """
+        使用 AK，SK 生成鉴权签名（Access Token）
+        :return: (access_token, 有效秒数)
+        """
         url = "https://aip.baidubce.com/oauth/2.0/token"
         params = {"grant_type": "client_credentials", "client_id": BAIDU_API_KEY, "client_secret": BAIDU_SECRET_KEY}
-        return str(requests.post(url, params=params).json().get("access_token"))
+        res = http_client.post(url, params=params).json()
+        if not res.get("access_token"):
+            raise Exception(res.get("error_description") or res)
+        return res["access_token"], res.get("expires_in", 2592000)
@@ -20,6 +20,7 @@ class BaiduWenxinSession(Session):
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
+            message_tokens = self.get_message_tokens()
             cur_tokens = self.calc_tokens()
         except Exception as e:
             precise = False
@@ -30,17 +31,17 @@ class BaiduWenxinSession(Session):
             if len(self.messages) >= 2:
                 self.messages.pop(0)
                 self.messages.pop(0)
+                if precise:
+                    cur_tokens -= message_tokens.pop(0) + message_tokens.pop(0)
+                else:
+                    cur_tokens = cur_tokens - max_tokens
             else:
                 logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
                 break
-            if precise:
-                cur_tokens = self.calc_tokens()
-            else:
-                cur_tokens = cur_tokens - max_tokens
         return cur_tokens
 
-    def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+    def calc_message_tokens(self, message):
+        return num_tokens_from_messages([message], self.model)
 
 
 def num_tokens_from_messages(messages, model):
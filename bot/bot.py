@@ -2,9 +2,11 @@
 Auto-replay chat robot abstract class
 """
 
+import asyncio
 
 from bridge.context import Context
 from bridge.reply import Reply
+from common.retry import RetryLater, defer_retry
 
 
 class Bot(object):
@@ -15,3 +17,26 @@ class Bot(object):
         :return: reply content
         """
         raise NotImplementedError
+
+    async def async_reply(self, query, context: Context = None) -> Reply:
+        """
+        bot auto-reply content in asyncio mode,
+        bots that only implement reply run it in the event loop's default executor,
+        retry backoff waits in the event loop instead of an executor thread
+        :param req: received message
+        :return: reply content
+        """
+        loop = asyncio.get_event_loop()
+        if context is None:
+            # 没有context时无法记录重试次数，退避等待在线程池中进行
+            return await loop.run_in_executor(None, self.reply, query, context)
+        while True:
+            try:
+                return await loop.run_in_executor(None, self._deferred_reply, query, context)
+            except RetryLater as e:
+                context["retry_count"] = e.retry_count
+                await asyncio.sleep(e.delay)
+
+    def _deferred_reply(self, query, context: Context = None) -> Reply:
+        with defer_retry():
+            return self.reply(query, context)
@@ -1,11 +1,13 @@
 # encoding:utf-8
 
-import time
+import weakref
 
 import openai
 import openai.error
 import requests
-from common import const
+from common import http_client
+from common import const, utils
+from bot.api_key_pool import get_openai_pool
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
 from bot.openai.open_ai_image import OpenAIImage
@@ -13,7 +15,8 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
-from common.token_bucket import TokenBucket
+from common.retry import CIRCUIT_OPEN_REPLY, RetryPolicy, get_retry_after, throttle
+from common.token_bucket import RateLimiter
 from config import conf, load_config
 from bot.baidu.baidu_wenxin_session import BaiduWenxinSession
 
@@ -28,8 +31,10 @@ class ChatGPTBot(Bot, OpenAIImage):
         proxy = conf().get("proxy")
         if proxy:
             openai.proxy = proxy
-        if conf().get("rate_limit_chatgpt"):
-            self.tb4chatgpt = TokenBucket(conf().get("rate_limit_chatgpt", 20))
+        self.tb4chatgpt = None
+        if conf().get("rate_limit_chatgpt") or conf().get("rate_limit_chatgpt_tpm"):
+            self.tb4chatgpt = RateLimiter(rpm=conf().get("rate_limit_chatgpt"), tpm=conf().get("rate_limit_chatgpt_tpm"))
+        self.retry = RetryPolicy("chatgpt")
         conf_model = conf().get("model") or "gpt-3.5-turbo"
         self.sessions = SessionManager(ChatGPTSession, model=conf().get("model") or "gpt-3.5-turbo")
         # o1相关模型不支持system prompt，暂时用文心模型的session
@@ -55,52 +60,17 @@ class ChatGPTBot(Bot, OpenAIImage):
         # acquire reply content
         if context.type == ContextType.TEXT:
             logger.info("[CHATGPT] query={}".format(query))
-
-            session_id = context["session_id"]
-            reply = None
-            clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
-            if query in clear_memory_commands:
-                self.sessions.clear_session(session_id)
-                reply = Reply(ReplyType.INFO, "记忆已清除")
-            elif query == "#清除所有":
-                self.sessions.clear_all_session()
-                reply = Reply(ReplyType.INFO, "所有人记忆已清除")
-            elif query == "#更新配置":
-                load_config()
-                reply = Reply(ReplyType.INFO, "配置已更新")
+            reply = self._reply_command(query, context)
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
-            logger.debug("[CHATGPT] session query={}".format(session.messages))
-
-            api_key = context.get("openai_api_key")
-            model = context.get("gpt_model")
-            new_args = None
-            if model:
-                new_args = self.args.copy()
-                new_args["model"] = model
-            # if context.get('stream'):
-            #     # reply in stream
-            #     return self.reply_text_stream(query, new_query, session_id)
-
-            reply_content = self.reply_text(session, api_key, args=new_args)
-            logger.debug(
-                "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
-                    session.messages,
-                    session_id,
-                    reply_content["content"],
-                    reply_content["completion_tokens"],
-                )
-            )
-            if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-            elif reply_content["completion_tokens"] > 0:
-                self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
-                reply = Reply(ReplyType.TEXT, reply_content["content"])
-            else:
-                reply = Reply(ReplyType.ERROR, reply_content["content"])
-                logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
-            return reply
+            session, api_key, new_args = self._prepare_text(query, context)
+            if context.get("stream"):
+                reply = self.reply_text_stream(session, api_key, args=new_args)
+                if reply:
+                    return reply
+
+            reply_content = self.reply_text(session, api_key, args=new_args, retry_count=context.get("retry_count", 0))
+            return self._build_text_reply(session, reply_content)
 
         elif context.type == ContextType.IMAGE_CREATE:
             ok, retstring = self.create_img(query, 0)
@@ -114,6 +84,69 @@ class ChatGPTBot(Bot, OpenAIImage):
             reply = Reply(ReplyType.ERROR, "Bot不支持处理{}类型的消息".format(context.type))
             return reply
 
+    async def async_reply(self, query, context=None):
+        """
+        文本消息使用openai的异步接口，等待回复时不占用线程；流式回复和其他类型的消息仍在线程池中执行
+        """
+        if context is None or context.type != ContextType.TEXT or context.get("stream"):
+            return await super().async_reply(query, context)
+        logger.info("[CHATGPT] query={}".format(query))
+        reply = self._reply_command(query, context)
+        if reply:
+            return reply
+        session, api_key, new_args = self._prepare_text(query, context)
+        reply_content = await self.async_reply_text(session, api_key, args=new_args, retry_count=context.get("retry_count", 0))
+        return self._build_text_reply(session, reply_content)
+
+    def _reply_command(self, query, context):
+        session_id = context["session_id"]
+        clear_memory_commands = conf().get("clear_memory_commands", ["#清除记忆"])
+        if query in clear_memory_commands:
+            self.sessions.clear_session(session_id)
+            return Reply(ReplyType.INFO, "记忆已清除")
+        elif query == "#清除所有":
+            self.sessions.clear_all_session()
+            return Reply(ReplyType.INFO, "所有人记忆已清除")
+        elif query == "#更新配置":
+            load_config()
+            return Reply(ReplyType.INFO, "配置已更新")
+        return None
+
+    def _prepare_text(self, query, context):
+        """
+        :return: (加入问题后的session, 用户设置的api_key, 指定模型时的请求参数)
+        """
+        # 退避重试或等待限流后重新调度的请求带有retry_count，问题已经加入会话
+        session = self.sessions.session_query(query, context["session_id"], retry="retry_count" in context)
+        logger.debug("[CHATGPT] session query={}".format(session.messages))
+        api_key = context.get("openai_api_key")
+        model = context.get("gpt_model")
+        new_args = None
+        if model:
+            new_args = self.args.copy()
+            new_args["model"] = model
+        return session, api_key, new_args
+
+    def _build_text_reply(self, session: ChatGPTSession, reply_content) -> Reply:
+        session_id = session.session_id
+        logger.debug(
+            "[CHATGPT] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
+                session.messages,
+                session_id,
+                reply_content["content"],
+                reply_content["completion_tokens"],
+            )
+        )
+        if reply_content["completion_tokens"] == 0 and len(reply_content["content"]) > 0:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+        elif reply_content["completion_tokens"] > 0:
+            self.sessions.session_reply(reply_content["content"], session_id, reply_content["total_tokens"])
+            reply = Reply(ReplyType.TEXT, reply_content["content"])
+        else:
+            reply = Reply(ReplyType.ERROR, reply_content["content"])
+            logger.debug("[CHATGPT] reply {} used 0 tokens.".format(reply_content))
+        return reply
+
     def reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
         """
         call openai's ChatCompletion to get the answer
@@ -122,54 +155,200 @@ class ChatGPTBot(Bot, OpenAIImage):
         :param retry_count: retry count
         :return: {}
         """
+        pool = get_openai_pool()
+        lease = None
+        prompt_tokens = 0
+        if self.tb4chatgpt:
+            prompt_tokens = self._estimate_tokens(session)
+            self._acquire_rate_limit(prompt_tokens, retry_count)
+        # 用户设置了自己的api_key时直接使用，否则从key池中选择负载最低的key
+        if not api_key:
+            lease = pool.acquire(retry_count)
+        # 等待限流和key池预算之后再检查熔断，重新调度的请求不会占用半开状态的探测机会
+        if not self.retry.allow():
+            pool.cancel(lease)
+            return {"completion_tokens": 0, "content": CIRCUIT_OPEN_REPLY}
         try:
-            if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
-                raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
-            # if api_key == None, the default openai.api_key will be used
             if args is None:
                 args = self.args
-            response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
-            # logger.debug("[CHATGPT] response={}".format(response))
-            # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            return {
-                "total_tokens": response["usage"]["total_tokens"],
-                "completion_tokens": response["usage"]["completion_tokens"],
-                "content": response.choices[0]["message"]["content"],
-            }
+            if api_key:
+                request_args = dict(args, api_key=api_key)
+            else:
+                request_args = lease.request_args(args) if lease else args
+            response = openai.ChatCompletion.create(messages=session.messages, **request_args)
+            return self._handle_response(response, pool, lease, prompt_tokens)
         except Exception as e:
-            need_retry = retry_count < 2
-            result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if isinstance(e, openai.error.RateLimitError):
-                logger.warn("[CHATGPT] RateLimitError: {}".format(e))
-                result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
-            elif isinstance(e, openai.error.Timeout):
-                logger.warn("[CHATGPT] Timeout: {}".format(e))
-                result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
-            elif isinstance(e, openai.error.APIError):
-                logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
-                result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
-            elif isinstance(e, openai.error.APIConnectionError):
-                logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
-                result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
+            need_retry, result = self._handle_error(e, session, pool, lease)
+            if need_retry and self.retry.wait(retry_count, e):
+                return self.reply_text(session, api_key, args, retry_count + 1)
             else:
-                logger.exception("[CHATGPT] Exception: {}".format(e))
-                need_retry = False
-                self.sessions.clear_session(session.session_id)
+                return result
 
-            if need_retry:
-                logger.warn("[CHATGPT] 第{}次重试".format(retry_count + 1))
-                return self.reply_text(session, api_key, args, retry_count + 1)
+    async def async_reply_text(self, session: ChatGPTSession, api_key=None, args=None, retry_count=0) -> dict:
+        """
+        reply_text的asyncio版本，限流和退避重试都在事件循环中等待
+        """
+        pool = get_openai_pool()
+        lease = None
+        prompt_tokens = 0
+        if self.tb4chatgpt:
+            prompt_tokens = self._estimate_tokens(session)
+            await self.tb4chatgpt.async_acquire(prompt_tokens)
+        if not api_key:
+            lease = await pool.async_acquire()
+        if not self.retry.allow():
+            pool.cancel(lease)
+            return {"completion_tokens": 0, "content": CIRCUIT_OPEN_REPLY}
+        try:
+            if args is None:
+                args = self.args
+            if api_key:
+                request_args = dict(args, api_key=api_key)
+            else:
+                request_args = lease.request_args(args) if lease else args
+            response = await openai.ChatCompletion.acreate(messages=session.messages, **request_args)
+            return self._handle_response(response, pool, lease, prompt_tokens)
+        except Exception as e:
+            need_retry, result = self._handle_error(e, session, pool, lease)
+            if need_retry and await self.retry.async_wait(retry_count, e):
+                return await self.async_reply_text(session, api_key, args, retry_count + 1)
             else:
                 return result
 
+    def _handle_response(self, response, pool, lease, prompt_tokens) -> dict:
+        self.retry.record_success()
+        pool.release(lease, tokens=response["usage"]["total_tokens"])
+        if self.tb4chatgpt:
+            self.tb4chatgpt.record(response["usage"]["total_tokens"] - prompt_tokens)
+        # logger.debug("[CHATGPT] response={}".format(response))
+        # logger.info("[ChatGPT] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
+        return {
+            "total_tokens": response["usage"]["total_tokens"],
+            "completion_tokens": response["usage"]["completion_tokens"],
+            "content": response.choices[0]["message"]["content"],
+        }
+
+    def _handle_error(self, e, session: ChatGPTSession, pool, lease):
+        """
+        :return: (是否需要重试, 不再重试时的回复)
+        """
+        pool.release(lease, status=getattr(e, "http_status", None), retry_after=get_retry_after(e),
+                     failed=isinstance(e, (openai.error.APIConnectionError, openai.error.Timeout)))
+        need_retry = True
+        result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
+        if isinstance(e, openai.error.RateLimitError):
+            logger.warn("[CHATGPT] RateLimitError: {}".format(e))
+            result["content"] = "提问太快啦，请休息一下再问我吧"
+        elif isinstance(e, openai.error.Timeout):
+            logger.warn("[CHATGPT] Timeout: {}".format(e))
+            result["content"] = "我没有收到你的消息"
+            self.retry.record_failure()
+        elif isinstance(e, openai.error.APIError):
+            logger.warn("[CHATGPT] Bad Gateway: {}".format(e))
+            result["content"] = "请再问我一次"
+            self.retry.record_failure()
+        elif isinstance(e, openai.error.APIConnectionError):
+            logger.warn("[CHATGPT] APIConnectionError: {}".format(e))
+            result["content"] = "我连接不到你的网络"
+            self.retry.record_failure()
+        else:
+            logger.exception("[CHATGPT] Exception: {}".format(e))
+            need_retry = False
+            self.sessions.clear_session(session.session_id)
+        return need_retry, result
+
+    def _acquire_rate_limit(self, tokens, retry_count):
+        """
+        等待本地限流的令牌，在channel的处理线程中不阻塞，由channel在令牌足够时重新调度，不计入重试次数
+        """
+        while True:
+            ok, wait = self.tb4chatgpt.try_acquire(tokens)
+            if ok:
+                return
+            throttle(wait, retry_count)
+
+    @staticmethod
+    def _estimate_tokens(session: ChatGPTSession) -> int:
+        # 按会话的prompt预估token数，请求结束后按实际用量补扣
+        try:
+            return session.calc_tokens()
+        except Exception:
+            return 0
+
+    @staticmethod
+    def _estimate_completion_tokens(session: ChatGPTSession, content) -> int:
+        try:
+            return session.calc_message_tokens({"role": "assistant", "content": content})
+        except Exception:
+            return 0
+
+    def reply_text_stream(self, session: ChatGPTSession, api_key=None, args=None) -> Reply:
+        """
+        call openai's ChatCompletion in stream mode
+        :param session: a conversation session
+        :return: a TEXT_STREAM reply, an ERROR reply if the circuit breaker is open, or None if the request failed and should fall back to reply_text
+        """
+        pool = get_openai_pool()
+        lease = None
+        prompt_tokens = self._estimate_tokens(session)
+        if self.tb4chatgpt and not self.tb4chatgpt.try_acquire(prompt_tokens)[0]:
+            return None  # 由reply_text等待限流
+        if not api_key:
+            lease, wait = pool.try_acquire()
+            if wait:
+                return None  # 由reply_text等待key池的预算
+        if not self.retry.allow():
+            pool.cancel(lease)
+            return Reply(ReplyType.ERROR, CIRCUIT_OPEN_REPLY)
+        try:
+            if args is None:
+                args = self.args
+            if api_key:
+                request_args = dict(args, api_key=api_key)
+            else:
+                request_args = lease.request_args(args) if lease else args
+            response = openai.ChatCompletion.create(messages=session.messages, stream=True, **request_args)
+            self.retry.record_success()
+        except Exception as e:
+            pool.release(lease, status=getattr(e, "http_status", None), retry_after=get_retry_after(e),
+                         failed=isinstance(e, (openai.error.APIConnectionError, openai.error.Timeout)))
+            if isinstance(e, (openai.error.Timeout, openai.error.APIError, openai.error.APIConnectionError)):
+                self.retry.record_failure()
+            logger.warn("[CHATGPT] stream request failed, fallback to normal request: {}".format(e))
+            return None
+
+        def iter_content():
+            content = ""
+            failed = False
+            try:
+                for chunk in response:
+                    if not chunk.choices:
+                        continue
+                    delta_content = chunk.choices[0].get("delta", {}).get("content")
+                    if delta_content:
+                        content += delta_content
+                        yield delta_content
+            except Exception as e:
+                failed = isinstance(e, (openai.error.APIConnectionError, openai.error.Timeout))
+                if isinstance(e, (openai.error.Timeout, openai.error.APIError, openai.error.APIConnectionError)):
+                    self.retry.record_failure()
+                logger.exception("[CHATGPT] stream interrupted: {}".format(e))
+            finally:
+                # 流式回复结束后才归还key，按prompt和实际输出计入该key的token用量
+                pool.release(lease, tokens=prompt_tokens + self._estimate_completion_tokens(session, content), failed=failed)
+
+        def on_complete(content):
+            # 流式接口不返回用量，按prompt和回复内容计算token数
+            completion_tokens = self._estimate_completion_tokens(session, content)
+            total_tokens = self._estimate_tokens(session) + completion_tokens
+            self.sessions.session_reply(content, session.session_id, total_tokens)
+            if self.tb4chatgpt:
+                self.tb4chatgpt.record(completion_tokens)
+
+        chunks = iter_content()
+        weakref.finalize(chunks, pool.release, lease)  # 回复没有被发送时也归还key
+        return Reply(ReplyType.TEXT_STREAM, utils.join_stream(chunks, on_complete))
+
 
 class AzureChatGPTBot(ChatGPTBot):
     def __init__(self):
@@ -191,13 +370,13 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "256x256"),"n": 1}
-                submission = requests.post(url, headers=headers, json=body)
+                submission = http_client.post(url, headers=headers, json=body)
                 operation_location = submission.headers['operation-location']
                 status = ""
                 while (status != "succeeded"):
                     if retry_count > 3:
                         return False, "图片生成失败"
-                    response = requests.get(operation_location, headers=headers)
+                    response = http_client.get(operation_location, headers=headers)
                     status = response.json()['status']
                     retry_count += 1
                 image_url = response.json()['result']['data'][0]['url']
@@ -216,7 +395,7 @@ class AzureChatGPTBot(ChatGPTBot):
             headers = {"api-key": api_key, "Content-Type": "application/json"}
             try:
                 body = {"prompt": query, "size": conf().get("image_create_size", "1024x1024"), "quality": conf().get("dalle3_image_quality", "standard")}
-                response = requests.post(url, headers=headers, json=body)
+                response = http_client.post(url, headers=headers, json=body)
                 response.raise_for_status()  # 检查请求是否成功
                 data = response.json()
 
@@ -1,3 +1,6 @@
+import functools
+import threading
+
 from bot.session_manager import Session
 from common.log import logger
 from common import const
@@ -18,84 +21,99 @@ class ChatGPTSession(Session):
         self.model = model
         self.reset()
 
-    def discard_exceeding(self, max_tokens, cur_tokens=None):
-        precise = True
-        try:
-            cur_tokens = self.calc_tokens()
-        except Exception as e:
-            precise = False
-            if cur_tokens is None:
-                raise e
-            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
-        while cur_tokens > max_tokens:
-            if len(self.messages) > 2:
-                self.messages.pop(1)
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
-                self.messages.pop(1)
-                if precise:
-                    cur_tokens = self.calc_tokens()
-                else:
-                    cur_tokens = cur_tokens - max_tokens
-                break
-            elif len(self.messages) == 2 and self.messages[1]["role"] == "user":
-                logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
-                break
-            else:
-                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
-                break
-            if precise:
-                cur_tokens = self.calc_tokens()
-            else:
-                cur_tokens = cur_tokens - max_tokens
-        return cur_tokens
-
     def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+        tokens = super().calc_tokens()
+        if not is_character_model(self.model):
+            tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        return tokens
+
+    def calc_message_tokens(self, message):
+        return num_tokens_from_message(message, self.model)
+
+
+def is_character_model(model):
+    return model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI)
 
 
-# refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 def num_tokens_from_messages(messages, model):
     """Returns the number of tokens used by a list of messages."""
-
-    if model in ["wenxin", "xunfei"] or model.startswith(const.GEMINI):
+    if is_character_model(model):
         return num_tokens_by_character(messages)
-
-    import tiktoken
-
-    if model in ["gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot", const.LINKAI_35]:
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    elif model in ["gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
-                   "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
-                   "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW, const.GPT4_TURBO_01_25,
-                   const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o, const.LINKAI_4_TURBO]:
-        return num_tokens_from_messages(messages, model="gpt-4")
-    elif model.startswith("claude-3"):
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.debug("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model == "gpt-3.5-turbo":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4":
-        tokens_per_message = 3
-        tokens_per_name = 1
-    else:
-        logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo")
     num_tokens = 0
     for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+        num_tokens += num_tokens_from_message(message, model)
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
 
+# 模型名 -> token计算规则所属的模型族，未列出的模型按gpt-3.5-turbo计算
+MODEL_FAMILY_ALIASES = {
+    **dict.fromkeys(["gpt-3.5-turbo", "gpt-3.5-turbo-0301", "gpt-35-turbo", "gpt-3.5-turbo-1106", "moonshot",
+                     const.LINKAI_35], "gpt-3.5-turbo"),
+    **dict.fromkeys(["gpt-4", "gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-4-32k-0613", "gpt-3.5-turbo-0613",
+                     "gpt-3.5-turbo-16k", "gpt-3.5-turbo-16k-0613", "gpt-35-turbo-16k", "gpt-4-turbo-preview",
+                     "gpt-4-1106-preview", const.GPT4_TURBO_PREVIEW, const.GPT4_VISION_PREVIEW,
+                     const.GPT4_TURBO_01_25, const.GPT_4o, const.GPT_4O_0806, const.GPT_4o_MINI, const.LINKAI_4o,
+                     const.LINKAI_4_TURBO], "gpt-4"),
+}
+
+# 模型族 -> (tokens_per_message, tokens_per_name)
+MODEL_FAMILY_RULES = {
+    "gpt-3.5-turbo": (4, -1),  # every message follows <|start|>{role/name}\n{content}<|end|>\n; if there's a name, the role is omitted
+    "gpt-4": (3, 1),
+}
+
+_encodings = {}  # 进程内共享的tiktoken encoder，key为模型族
+_encodings_lock = threading.Lock()
+
+
+def resolve_model_family(model):
+    family = MODEL_FAMILY_ALIASES.get(model)
+    if family is None:
+        if not model.startswith("claude-3"):
+            logger.debug(f"num_tokens_from_messages() is not implemented for model {model}. Returning num tokens assuming gpt-3.5-turbo.")
+        family = "gpt-3.5-turbo"
+    return family
+
+
+def get_encoding(family):
+    encoding = _encodings.get(family)
+    if encoding is None:
+        with _encodings_lock:
+            encoding = _encodings.get(family)
+            if encoding is None:
+                import tiktoken
+
+                try:
+                    encoding = tiktoken.encoding_for_model(family)
+                except KeyError:
+                    logger.debug("Warning: model not found. Using cl100k_base encoding.")
+                    encoding = tiktoken.get_encoding("cl100k_base")
+                _encodings[family] = encoding
+    return encoding
+
+
+@functools.lru_cache(maxsize=4096)
+def num_tokens_from_string(string, family):
+    """Returns the number of tokens in a string, cached for repeated strings such as system prompts."""
+    return len(get_encoding(family).encode(string))
+
+
+# refer to https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+def num_tokens_from_message(message, model):
+    """Returns the number of tokens used by a single message, excluding the reply priming tokens."""
+    if is_character_model(model):
+        return len(message["content"])
+    family = resolve_model_family(model)
+    tokens_per_message, tokens_per_name = MODEL_FAMILY_RULES[family]
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += num_tokens_from_string(value, family)
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+
 def num_tokens_by_character(messages):
     """Returns the number of tokens used by a list of messages."""
     tokens = 0
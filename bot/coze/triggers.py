@@ -1,6 +1,6 @@
 from typing import Any, Dict, List
 from config import conf
-import requests
+from common import http_client
 
 
 class Trigger:
@@ -22,5 +22,5 @@ class Trigger:
             "Content-Type": "application/json",
             "Authorization": f"Bearer {h_token}",
         }
-        response = requests.post(url, {}, {}, headers=headers)
+        response = http_client.post(url, data={}, json={}, headers=headers)
         return response
@@ -3,7 +3,7 @@
 
 import re
 import time
-import requests
+from common import http_client
 import config
 from bot.bot import Bot
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
@@ -11,6 +11,7 @@ from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry import CIRCUIT_OPEN_REPLY, RetryPolicy
 from config import conf, pconf
 import threading
 from common import memory, utils
@@ -26,10 +27,11 @@ class LinkAIBot(Bot):
         super().__init__()
         self.sessions = LinkAISessionManager(LinkAISession, model=conf().get("model") or "gpt-3.5-turbo")
         self.args = {}
+        self.retry = RetryPolicy("linkai")
 
     def reply(self, query, context: Context = None) -> Reply:
         if context.type == ContextType.TEXT:
-            return self._chat(query, context)
+            return self._chat(query, context, context.get("retry_count", 0))
         elif context.type == ContextType.IMAGE_CREATE:
             if not conf().get("text_to_image"):
                 logger.warn("[LinkAI] text_to_image is not enabled, ignore the IMAGE_CREATE request")
@@ -52,10 +54,8 @@ class LinkAIBot(Bot):
         :param retry_count: 当前递归重试次数
         :return: 回复
         """
-        if retry_count > 2:
-            # exit from retry 2 times
-            logger.warn("[LINKAI] failed after maximum number of retry times")
-            return Reply(ReplyType.TEXT, "请再问我一次吧")
+        if not self.retry.allow():
+            return Reply(ReplyType.TEXT, CIRCUIT_OPEN_REPLY)
 
         try:
             # load config
@@ -121,11 +121,21 @@ class LinkAIBot(Bot):
             logger.info(f"[LINKAI] query={query}, app_code={app_code}, model={body.get('model')}, file_id={file_id}")
             headers = {"Authorization": "Bearer " + linkai_api_key}
 
+            # 流式回复时不处理知识库、插件后缀和图片，直接透传文本
+            stream = bool(context.get("stream"))
+            if stream:
+                body["stream"] = True
+
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
-                                timeout=conf().get("request_timeout", 180))
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+                                timeout=conf().get("request_timeout", 180), stream=stream)
             if res.status_code == 200:
+                self.retry.record_success()
+            if res.status_code == 200 and stream:
+                on_complete = lambda content: self.sessions.session_reply(content, session_id, query=query)
+                return Reply(ReplyType.TEXT_STREAM, utils.join_stream(utils.iter_stream_content(res), on_complete))
+            elif res.status_code == 200:
                 # execute success
                 response = res.json()
                 reply_content = response["choices"][0]["message"]["content"]
@@ -160,9 +170,10 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self._chat(query, context, retry_count + 1)
+                    self.retry.record_failure()
+                    if self.retry.wait(retry_count, res):
+                        return self._chat(query, context, retry_count + 1)
+                    return self._retry_exhausted_reply()
 
                 error_reply = "提问太快啦，请休息一下再问我吧"
                 if res.status_code == 409:
@@ -171,10 +182,14 @@ class LinkAIBot(Bot):
 
         except Exception as e:
             logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self._chat(query, context, retry_count + 1)
+            self.retry.record_failure()
+            if self.retry.wait(retry_count, e):
+                return self._chat(query, context, retry_count + 1)
+            return self._retry_exhausted_reply()
+
+    def _retry_exhausted_reply(self):
+        logger.warn("[LINKAI] failed after maximum number of retry times")
+        return Reply(ReplyType.TEXT, "请再问我一次吧")
 
     def _process_image_msg(self, app_code: str, session_id: str, query:str, img_cache: dict):
         try:
@@ -237,13 +252,11 @@ class LinkAIBot(Bot):
             logger.exception(e)
 
     def reply_text(self, session: ChatGPTSession, app_code="", retry_count=0) -> dict:
-        if retry_count >= 2:
-            # exit from retry 2 times
-            logger.warn("[LINKAI] failed after maximum number of retry times")
+        if not self.retry.allow():
             return {
                 "total_tokens": 0,
                 "completion_tokens": 0,
-                "content": "请再问我一次吧"
+                "content": CIRCUIT_OPEN_REPLY
             }
 
         try:
@@ -262,10 +275,11 @@ class LinkAIBot(Bot):
 
             # do http request
             base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
-            res = requests.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
+            res = http_client.post(url=base_url + "/v1/chat/completions", json=body, headers=headers,
                                 timeout=conf().get("request_timeout", 180))
             if res.status_code == 200:
                 # execute success
+                self.retry.record_success()
                 response = res.json()
                 reply_content = response["choices"][0]["message"]["content"]
                 total_tokens = response["usage"]["total_tokens"]
@@ -284,9 +298,9 @@ class LinkAIBot(Bot):
 
                 if res.status_code >= 500:
                     # server error, need retry
-                    time.sleep(2)
-                    logger.warn(f"[LINKAI] do retry, times={retry_count}")
-                    return self.reply_text(session, app_code, retry_count + 1)
+                    self.retry.record_failure()
+                    if self.retry.wait(retry_count, res):
+                        return self.reply_text(session, app_code, retry_count + 1)
 
                 return {
                     "total_tokens": 0,
@@ -296,17 +310,22 @@ class LinkAIBot(Bot):
 
         except Exception as e:
             logger.exception(e)
-            # retry
-            time.sleep(2)
-            logger.warn(f"[LINKAI] do retry, times={retry_count}")
-            return self.reply_text(session, app_code, retry_count + 1)
+            self.retry.record_failure()
+            if self.retry.wait(retry_count, e):
+                return self.reply_text(session, app_code, retry_count + 1)
+            logger.warn("[LINKAI] failed after maximum number of retry times")
+            return {
+                "total_tokens": 0,
+                "completion_tokens": 0,
+                "content": "请再问我一次吧"
+            }
 
     def _fetch_app_info(self, app_code: str):
         headers = {"Authorization": "Bearer " + conf().get("linkai_api_key")}
         # do http request
         base_url = conf().get("linkai_api_base", "https://api.link-ai.tech")
         params = {"app_code": app_code}
-        res = requests.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
+        res = http_client.get(url=base_url + "/v1/app/info", params=params, headers=headers, timeout=(5, 10))
         if res.status_code == 200:
             return res.json()
         else:
@@ -327,7 +346,7 @@ class LinkAIBot(Bot):
                 "img_proxy": conf().get("image_proxy")
             }
             url = conf().get("linkai_api_base", "https://api.link-ai.tech") + "/v1/images/generations"
-            res = requests.post(url, headers=headers, json=data, timeout=(5, 90))
+            res = http_client.post(url, headers=headers, json=data, timeout=(5, 90))
             t2 = time.time()
             image_url = res.json()["data"][0]["url"]
             logger.info("[OPEN_AI] image_url={}".format(image_url))
@@ -430,7 +449,7 @@ def _download_file(url: str):
             os.makedirs(file_path)
         file_name = url.split("/")[-1]  # 获取文件名
         file_path = os.path.join(file_path, file_name)
-        response = requests.get(url)
+        response = http_client.get(url)
         with open(file_path, "wb") as f:
             f.write(response.content)
         return file_path
@@ -455,6 +474,7 @@ class LinkAISessionManager(SessionManager):
             logger.debug(f"[LinkAI] chat history, before tokens={total_tokens}, now tokens={tokens_cnt}")
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.save_session(session)
         return session
 
 
@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 from bot.bot import Bot
@@ -10,9 +8,10 @@ from bot.session_manager import SessionManager
 from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry import CIRCUIT_OPEN_REPLY, RetryPolicy
 from config import conf, load_config
 from bot.chatgpt.chat_gpt_session import ChatGPTSession
-import requests
+from common import http_client
 from common import const
 
 
@@ -42,6 +41,7 @@ class MinimaxBot(Bot):
             ],
         }
         self.sessions = SessionManager(MinimaxSession, model=const.MiniMax)
+        self.retry = RetryPolicy("minimax")
 
     def reply(self, query, context: Context = None) -> Reply:
         # acquire reply content
@@ -61,7 +61,8 @@ class MinimaxBot(Bot):
                 reply = Reply(ReplyType.INFO, "配置已更新")
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
+            retry_count = context.get("retry_count", 0)
+            session = self.sessions.session_query(query, session_id, retry=retry_count > 0)
             logger.debug("[Minimax_AI] session query={}".format(session))
 
             model = context.get("Minimax_model")
@@ -72,7 +73,7 @@ class MinimaxBot(Bot):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, args=new_args)
+            reply_content = self.reply_text(session, args=new_args, retry_count=retry_count)
             logger.debug(
                 "[Minimax_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -102,15 +103,18 @@ class MinimaxBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
+        if not self.retry.allow():
+            return {"completion_tokens": 0, "content": CIRCUIT_OPEN_REPLY}
         try:
             headers = {"Content-Type": "application/json", "Authorization": "Bearer " + self.api_key}
             self.request_body["messages"].extend(session.messages)
             logger.info("[Minimax_AI] request_body={}".format(self.request_body))
             # logger.info("[Minimax_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
-            res = requests.post(self.base_url, headers=headers, json=self.request_body)
+            res = http_client.post(self.base_url, headers=headers, json=self.request_body)
 
             # self.request_body["messages"].extend(response.json()["choices"][0]["messages"])
             if res.status_code == 200:
+                self.retry.record_success()
                 response = res.json()
                 return {
                     "total_tokens": response["usage"]["total_tokens"],
@@ -126,26 +130,25 @@ class MinimaxBot(Bot):
                 need_retry = False
                 if res.status_code >= 500:
                     # server error, need retry
-                    logger.warn(f"[Minimax_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
+                    need_retry = True
+                    self.retry.record_failure()
                 elif res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
+                    need_retry = True
                 else:
                     need_retry = False
 
-                if need_retry:
-                    time.sleep(3)
+                if need_retry and self.retry.wait(retry_count, res):
                     return self.reply_text(session, args, retry_count + 1)
                 else:
                     return result
         except Exception as e:
             logger.exception(e)
-            need_retry = retry_count < 2
+            self.retry.record_failure()
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
+            if self.retry.wait(retry_count, e):
                 return self.reply_text(session, args, retry_count + 1)
             else:
                 return result
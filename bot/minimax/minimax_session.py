@@ -29,6 +29,7 @@ class MinimaxSession(Session):
     def discard_exceeding(self, max_tokens, cur_tokens=None):
         precise = True
         try:
+            message_tokens = self.get_message_tokens()
             cur_tokens = self.calc_tokens()
         except Exception as e:
             precise = False
@@ -41,7 +42,7 @@ class MinimaxSession(Session):
             elif len(self.messages) == 2 and self.messages[1]["sender_type"] == "BOT":
                 self.messages.pop(1)
                 if precise:
-                    cur_tokens = self.calc_tokens()
+                    cur_tokens -= message_tokens.pop(1)
                 else:
                     cur_tokens = cur_tokens - max_tokens
                 break
@@ -52,13 +53,13 @@ class MinimaxSession(Session):
                 logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
                 break
             if precise:
-                cur_tokens = self.calc_tokens()
+                cur_tokens -= message_tokens.pop(1)
             else:
                 cur_tokens = cur_tokens - max_tokens
         return cur_tokens
 
-    def calc_tokens(self):
-        return num_tokens_from_messages(self.messages, self.model)
+    def calc_message_tokens(self, message):
+        return num_tokens_from_messages([message], self.model)
 
 
 def num_tokens_from_messages(messages, model):
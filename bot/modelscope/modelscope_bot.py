@@ -1,6 +1,5 @@
 # encoding:utf-8
 
-import time
 import json
 import openai
 import openai.error
@@ -8,10 +7,12 @@ from bot.bot import Bot
 from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common import utils
 from common.log import logger
+from common.retry import CIRCUIT_OPEN_REPLY, RetryPolicy
 from config import conf, load_config
 from .modelscope_session import ModelScopeSession
-import requests
+from common import http_client
 
 
 # ModelScope对话模型API
@@ -29,6 +30,7 @@ class ModelScopeBot(Bot):
         }
         self.api_key = conf().get("modelscope_api_key")
         self.base_url = conf().get("modelscope_base_url", "https://api-inference.modelscope.cn/v1/chat/completions")
+        self.retry = RetryPolicy("modelscope")
         """
         需要获取ModelScope支持API-inference的模型名称列表，请到魔搭社区官网模型中心查看 https://modelscope.cn/models?filter=inference_type&page=1。
         或者使用命令 curl https://api-inference.modelscope.cn/v1/models 对模型列表和ID进行获取。查看commend/const.py文件也可以获取模型列表。
@@ -53,7 +55,8 @@ class ModelScopeBot(Bot):
                 reply = Reply(ReplyType.INFO, "配置已更新")
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
+            retry_count = context.get("retry_count", 0)
+            session = self.sessions.session_query(query, session_id, retry=retry_count > 0)
             logger.debug("[MODELSCOPE_AI] session query={}".format(session.messages))
 
             model = context.get("modelscope_model")
@@ -61,10 +64,15 @@ class ModelScopeBot(Bot):
             if model:
                 new_args["model"] = model
 
+            if context.get("stream"):
+                reply = self.reply_stream(session, args=new_args)
+                if reply:
+                    return reply
+
             if new_args["model"] == "Qwen/QwQ-32B":
-                reply_content = self.reply_text_stream(session, args=new_args)
+                reply_content = self.reply_text_stream(session, args=new_args, retry_count=retry_count)
             else:
-                reply_content = self.reply_text(session, args=new_args)
+                reply_content = self.reply_text(session, args=new_args, retry_count=retry_count)
 
             logger.debug(
                 "[MODELSCOPE_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
@@ -107,6 +115,8 @@ class ModelScopeBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
+        if not self.retry.allow():
+            return {"completion_tokens": 0, "content": CIRCUIT_OPEN_REPLY}
         try:
             headers = {
                 "Content-Type": "application/json",
@@ -115,13 +125,14 @@ class ModelScopeBot(Bot):
             
             body = args
             body["messages"] = session.messages
-            res = requests.post(
+            res = http_client.post(
                 self.base_url,
                 headers=headers,
                 data=json.dumps(body)
             )
 
             if res.status_code == 200:
+                self.retry.record_success()
                 response = res.json()
                 return {
                     "total_tokens": response["usage"]["total_tokens"],
@@ -143,26 +154,25 @@ class ModelScopeBot(Bot):
                 need_retry = False
                 if res.status_code >= 500:
                     # server error, need retry
-                    logger.warn(f"[MODELSCOPE_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
+                    need_retry = True
+                    self.retry.record_failure()
                 elif res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
+                    need_retry = True
                 else:
                     need_retry = False
 
-                if need_retry:
-                    time.sleep(3)
+                if need_retry and self.retry.wait(retry_count, res):
                     return self.reply_text(session, args, retry_count + 1)
                 else:
                     return result
         except Exception as e:
             logger.exception(e)
-            need_retry = retry_count < 2
+            self.retry.record_failure()
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
+            if self.retry.wait(retry_count, e):
                 return self.reply_text(session, args, retry_count + 1)
             else:
                 return result
@@ -175,6 +185,8 @@ class ModelScopeBot(Bot):
         :param retry_count: retry count
         :return: {}
         """
+        if not self.retry.allow():
+            return {"completion_tokens": 0, "content": CIRCUIT_OPEN_REPLY}
         try:
             headers = {
                 "Content-Type": "application/json",
@@ -185,25 +197,15 @@ class ModelScopeBot(Bot):
             body["messages"] = session.messages
             body["stream"] = True  # 启用流式响应
 
-            res = requests.post(
+            res = http_client.post(
                 self.base_url,
                 headers=headers,
                 data=json.dumps(body),
                 stream=True
             )
             if res.status_code == 200:
-                content = ""
-                for line in res.iter_lines():
-                    if line:
-                        decoded_line = line.decode('utf-8')
-                        if decoded_line.startswith("data: "):
-                            try:
-                                json_data = json.loads(decoded_line[6:])
-                                delta_content = json_data.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                                if delta_content:
-                                    content += delta_content
-                            except json.JSONDecodeError as e:
-                                pass
+                content = "".join(utils.iter_stream_content(res))
+                self.retry.record_success()
                 return {
                     "total_tokens": 1,  # 流式响应通常不返回token使用情况
                     "completion_tokens": 1,
@@ -224,29 +226,53 @@ class ModelScopeBot(Bot):
                 need_retry = False
                 if res.status_code >= 500:
                     # server error, need retry
-                    logger.warn(f"[MODELSCOPE_AI] do retry, times={retry_count}")
-                    need_retry = retry_count < 2
+                    need_retry = True
+                    self.retry.record_failure()
                 elif res.status_code == 401:
                     result["content"] = "授权失败，请检查API Key是否正确"
                 elif res.status_code == 429:
                     result["content"] = "请求过于频繁，请稍后再试"
-                    need_retry = retry_count < 2
+                    need_retry = True
                 else:
                     need_retry = False
 
-                if need_retry:
-                    time.sleep(3)
+                if need_retry and self.retry.wait(retry_count, res):
                     return self.reply_text_stream(session, args, retry_count + 1)
                 else:
                     return result
         except Exception as e:
             logger.exception(e)
-            need_retry = retry_count < 2
+            self.retry.record_failure()
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
-            if need_retry:
+            if self.retry.wait(retry_count, e):
                 return self.reply_text_stream(session, args, retry_count + 1)
             else:
                 return result
+
+    def reply_stream(self, session: ModelScopeSession, args=None) -> Reply:
+        """
+        call ModelScope's ChatCompletion and pass through the stream response
+        :param session: a conversation session
+        :return: a TEXT_STREAM reply, or None if the request failed and should fall back to reply_text
+        """
+        try:
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": "Bearer " + self.api_key
+            }
+            body = dict(args)
+            body["messages"] = session.messages
+            body["stream"] = True
+            res = http_client.post(self.base_url, headers=headers, data=json.dumps(body), stream=True)
+            if res.status_code != 200:
+                logger.warn(f"[MODELSCOPE_AI] stream request failed, status_code={res.status_code}, fallback to normal request")
+                return None
+        except Exception as e:
+            logger.warn(f"[MODELSCOPE_AI] stream request failed, fallback to normal request: {e}")
+            return None
+        on_complete = lambda content: self.sessions.session_reply(content, session.session_id)
+        return Reply(ReplyType.TEXT_STREAM, utils.join_stream(utils.iter_stream_content(res), on_complete))
+
     def create_img(self, query, retry_count=0):
         try:
             logger.info("[ModelScopeImage] image_query={}".format(query))
@@ -265,7 +291,7 @@ class ModelScopeBot(Bot):
             json_payload = json.dumps(payload, ensure_ascii=False).encode('utf-8')
             
             # 使用 data 参数发送原始字符串（requests 会自动处理编码）
-            res = requests.post(url, headers=headers, data=json_payload)
+            res = http_client.post(url, headers=headers, data=json_payload)
             
             response_data = res.json()
             image_url = response_data['images'][0]['url']
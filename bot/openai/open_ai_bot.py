@@ -5,6 +5,7 @@ import time
 import openai
 import openai.error
 
+from bot.api_key_pool import get_openai_pool
 from bot.bot import Bot
 from bot.openai.open_ai_image import OpenAIImage
 from bot.openai.open_ai_session import OpenAISession
@@ -12,6 +13,7 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry import get_retry_after
 from config import conf
 
 user_session = dict()
@@ -82,11 +84,14 @@ class OpenAIBot(Bot, OpenAIImage):
                 return reply
 
     def reply_text(self, session: OpenAISession, retry_count=0):
+        pool = get_openai_pool()
+        lease = pool.acquire(retry_count)
         try:
-            response = openai.Completion.create(prompt=str(session), **self.args)
+            response = openai.Completion.create(prompt=str(session), **(lease.request_args(self.args) if lease else self.args))
             res_content = response.choices[0]["text"].strip().replace("<|endoftext|>", "")
             total_tokens = response["usage"]["total_tokens"]
             completion_tokens = response["usage"]["completion_tokens"]
+            pool.release(lease, tokens=total_tokens)
             logger.info("[OPEN_AI] reply={}".format(res_content))
             return {
                 "total_tokens": total_tokens,
@@ -94,6 +99,8 @@ class OpenAIBot(Bot, OpenAIImage):
                 "content": res_content,
             }
         except Exception as e:
+            pool.release(lease, status=getattr(e, "http_status", None), retry_after=get_retry_after(e),
+                         failed=isinstance(e, (openai.error.APIConnectionError, openai.error.Timeout)))
             need_retry = retry_count < 2
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
@@ -4,7 +4,7 @@ import openai
 import openai.error
 
 from common.log import logger
-from common.token_bucket import TokenBucket
+from common.token_bucket import RateLimiter
 from config import conf
 
 
@@ -12,13 +12,16 @@ from config import conf
 class OpenAIImage(object):
     def __init__(self):
         openai.api_key = conf().get("open_ai_api_key")
+        self.tb4dalle = None
         if conf().get("rate_limit_dalle"):
-            self.tb4dalle = TokenBucket(conf().get("rate_limit_dalle", 50))
+            self.tb4dalle = RateLimiter(rpm=conf().get("rate_limit_dalle", 50))
 
     def create_img(self, query, retry_count=0, api_key=None, api_base=None):
         try:
-            if conf().get("rate_limit_dalle") and not self.tb4dalle.get_token():
-                return False, "请求太快了，请休息一下再问我吧"
+            if self.tb4dalle:
+                ok, wait = self.tb4dalle.try_acquire()
+                if not ok:
+                    return False, "请求太快了，请{}秒后再试吧".format(int(wait) + 1)
             logger.info("[OPEN_AI] image_query={}".format(query))
             response = openai.Image.create(
                 api_key=api_key,
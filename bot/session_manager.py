@@ -1,3 +1,4 @@
+from bot.session_store import create_session_store
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from config import conf
@@ -7,6 +8,9 @@ class Session(object):
     def __init__(self, session_id, system_prompt=None):
         self.session_id = session_id
         self.messages = []
+        self.message_tokens = {}  # 缓存每条消息的token数，id(message) -> (message, tokens)
+        self.stored_messages = {}  # 已写入存储的消息，id(message) -> (message, seq)
+        self.stored_version = None  # 最近一次读写存储时的版本号
         if system_prompt is None:
             self.system_prompt = conf().get("character_desc", "")
         else:
@@ -30,11 +34,65 @@ class Session(object):
         self.messages.append(assistant_item)
 
     def discard_exceeding(self, max_tokens=None, cur_tokens=None):
-        raise NotImplementedError
+        """
+        丢弃最早的历史消息直到token数不超过max_tokens，messages[0]为system prompt时始终保留
+        每条消息的token数只在首次出现时计算，丢弃时直接从总数中减去
+        """
+        precise = True
+        try:
+            message_tokens = self.get_message_tokens()
+            cur_tokens = self.calc_tokens()
+        except Exception as e:
+            precise = False
+            if cur_tokens is None:
+                raise e
+            logger.debug("Exception when counting tokens precisely for query: {}".format(e))
+        while cur_tokens > max_tokens:
+            if len(self.messages) > 2:
+                self.messages.pop(1)
+            elif len(self.messages) == 2 and self.messages[1]["role"] == "assistant":
+                self.messages.pop(1)
+                if precise:
+                    cur_tokens -= message_tokens.pop(1)
+                else:
+                    cur_tokens = cur_tokens - max_tokens
+                break
+            elif len(self.messages) == 2 and self.messages[1]["role"] == "user":
+                logger.warn("user message exceed max_tokens. total_tokens={}".format(cur_tokens))
+                break
+            else:
+                logger.debug("max_tokens={}, total_tokens={}, len(messages)={}".format(max_tokens, cur_tokens, len(self.messages)))
+                break
+            if precise:
+                cur_tokens -= message_tokens.pop(1)
+            else:
+                cur_tokens = cur_tokens - max_tokens
+        return cur_tokens
 
     def calc_tokens(self):
+        return sum(self.get_message_tokens())
+
+    def calc_message_tokens(self, message) -> int:
+        """
+        计算单条消息的token数，由get_message_tokens缓存
+        """
         raise NotImplementedError
 
+    def get_message_tokens(self) -> list:
+        """
+        返回与messages一一对应的token数，新消息计算一次后缓存，已丢弃消息的缓存随之清理
+        """
+        cache = {}
+        tokens = []
+        for message in self.messages:
+            entry = self.message_tokens.get(id(message))
+            if entry is None or entry[0] is not message:
+                entry = (message, self.calc_message_tokens(message))
+            cache[id(message)] = entry
+            tokens.append(entry[1])
+        self.message_tokens = cache
+        return tokens
+
 
 class SessionManager(object):
     def __init__(self, sessioncls, **session_args):
@@ -45,24 +103,84 @@ class SessionManager(object):
         self.sessions = sessions
         self.sessioncls = sessioncls
         self.session_args = session_args
+        self.store = create_session_store()
 
     def build_session(self, session_id, system_prompt=None):
         """
-        如果session_id不在sessions中，创建一个新的session并添加到sessions中
+        如果session_id不在sessions中，从存储中加载或创建一个新的session并添加到sessions中
         如果system_prompt不会空，会更新session的system_prompt并重置session
         """
         if session_id is None:
             return self.sessioncls(session_id, system_prompt, **self.session_args)
 
+        if session_id in self.sessions and self.is_stale(self.sessions[session_id]):
+            del self.sessions[session_id]  # 其他进程更新了该session，重新加载
         if session_id not in self.sessions:
-            self.sessions[session_id] = self.sessioncls(session_id, system_prompt, **self.session_args)
+            session = self.sessioncls(session_id, system_prompt, **self.session_args)
+            if self.load_session(session) and system_prompt is not None:
+                session.set_system_prompt(system_prompt)
+                self.save_session(session)
+            self.sessions[session_id] = session
         elif system_prompt is not None:  # 如果有新的system_prompt，更新并重置session
             self.sessions[session_id].set_system_prompt(system_prompt)
+            self.save_session(self.sessions[session_id])
         session = self.sessions[session_id]
         return session
 
-    def session_query(self, query, session_id):
+    def store_key(self, session_id):
+        # 不同bot的消息格式不同，按session类型区分存储
+        return "{}:{}".format(self.sessioncls.__name__, session_id)
+
+    def load_session(self, session):
+        """
+        从存储中恢复session的历史消息，存储中没有该session时返回False
+        """
+        if not self.store.persistent:
+            return False
+        items, version = self.store.load(self.store_key(session.session_id))
+        if not items:
+            return False
+        session.messages = [message for _, message in items]
+        session.stored_messages = {id(message): (message, seq) for seq, message in items}
+        session.stored_version = version
+        return True
+
+    def save_session(self, session):
+        """
+        将session与上次写入时的差异写入存储：新增的消息追加写入，seq由存储在写入时分配，被丢弃的消息按seq删除
+        """
+        if not self.store.persistent or session.session_id is None:
+            return
+        stored = {}
+        appended = []
+        for message in session.messages:
+            entry = session.stored_messages.get(id(message))
+            if entry is None or entry[0] is not message:
+                appended.append(message)
+            else:
+                stored[id(message)] = entry
+        removed = [seq for key, (_, seq) in session.stored_messages.items() if key not in stored]
+        if not appended and not removed:
+            return
+        version, seqs = self.store.save(self.store_key(session.session_id), appended, removed)
+        if seqs is None:
+            return  # 写入失败，下次保存时重新写入差异
+        for message, seq in zip(appended, seqs):
+            stored[id(message)] = (message, seq)
+        session.stored_messages = stored
+        session.stored_version = version
+
+    def is_stale(self, session):
+        if not self.store.persistent:
+            return False
+        version = self.store.version(self.store_key(session.session_id))
+        return version is not None and version != session.stored_version
+
+    def session_query(self, query, session_id, retry=False):
         session = self.build_session(session_id)
+        # 退避重试的请求，问题在第一次请求时已经加入会话；等待期间会话被清除或过期时重新加入
+        if retry and session.messages and session.messages[-1].get("role") == "user" and session.messages[-1].get("content") == query:
+            return session
         session.add_query(query)
         try:
             max_tokens = conf().get("conversation_max_tokens", 1000)
@@ -70,6 +188,7 @@ class SessionManager(object):
             logger.debug("prompt tokens used={}".format(total_tokens))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for prompt: {}".format(str(e)))
+        self.save_session(session)
         return session
 
     def session_reply(self, reply, session_id, total_tokens=None):
@@ -81,11 +200,14 @@ class SessionManager(object):
             logger.debug("raw total_tokens={}, savesession tokens={}".format(total_tokens, tokens_cnt))
         except Exception as e:
             logger.warning("Exception when counting tokens precisely for session: {}".format(str(e)))
+        self.save_session(session)
         return session
 
     def clear_session(self, session_id):
         if session_id in self.sessions:
             del self.sessions[session_id]
+        self.store.delete(self.store_key(session_id))
 
     def clear_all_session(self):
         self.sessions.clear()
+        self.store.clear()
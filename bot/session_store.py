@@ -0,0 +1,310 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from sqlite3 import Error
+
+from common.log import logger
+from config import conf, get_appdata_dir
+
+
+class SessionStore(object):
+    """
+    会话消息的持久化存储
+    消息以(seq, message)的形式按session追加写入，丢弃历史消息时按seq删除，SessionManager在session首次被访问时才加载
+    """
+
+    persistent = True
+
+    def __init__(self):
+        self.expires_in_seconds = conf().get("expires_in_seconds")
+
+    def load(self, session_id):
+        """
+        返回(items, version)，items为按seq排序的[(seq, message)]，session不存在或已过期时返回(None, None)
+        """
+        raise NotImplementedError
+
+    def save(self, session_id, appended, removed):
+        """
+        追加appended中的消息并为其分配seq，删除removed中的seq
+        :return: (写入后的版本号, 与appended对应的seq列表)，写入失败时seq列表为None
+        """
+        raise NotImplementedError
+
+    def version(self, session_id):
+        """
+        返回session在存储中的版本号，用于发现其他进程的写入，不支持多进程共享的存储返回None
+        """
+        return None
+
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def is_expired(self, updated_at):
+        return bool(self.expires_in_seconds) and updated_at + self.expires_in_seconds < time.time()
+
+
+class MemorySessionStore(SessionStore):
+    """
+    不做持久化，session只保存在SessionManager的内存中
+    """
+
+    persistent = False
+
+    def load(self, session_id):
+        return None, None
+
+    def save(self, session_id, appended, removed):
+        return None, []
+
+    def delete(self, session_id):
+        pass
+
+    def clear(self):
+        pass
+
+
+class SqliteSessionStore(SessionStore):
+    """
+    SQLite存储，WAL模式下多个进程可以共享同一个数据库文件
+    每个线程复用一个连接，seq在写事务中分配，多个进程同时写入同一session时不会互相覆盖
+    """
+
+    def __init__(self, db_path):
+        super().__init__()
+        self.db_path = Path(db_path)
+        self.local = threading.local()
+        self._init_db()
+
+    def _init_db(self):
+        """初始化数据库和表结构"""
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._get_connection() as conn:
+            try:
+                conn.execute("""PRAGMA journal_mode = WAL""")
+                conn.execute("""PRAGMA synchronous = NORMAL""")
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS conversation_sessions (
+                                session_id TEXT PRIMARY KEY,
+                                version INTEGER NOT NULL,
+                                updated_at INTEGER NOT NULL
+                            )"""
+                )
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS conversation_messages (
+                                session_id TEXT NOT NULL,
+                                seq INTEGER NOT NULL,
+                                message TEXT NOT NULL,
+                                PRIMARY KEY (session_id, seq)
+                            )"""
+                )
+                conn.commit()
+            except Error as e:
+                logger.error(f"[SessionStore] 初始化数据库失败: {str(e)}")
+
+    def _get_connection(self):
+        """获取当前线程的数据库连接"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.db_path, timeout=10)
+        return conn
+
+    def load(self, session_id):
+        with self._get_connection() as conn:
+            try:
+                row = conn.execute(
+                    """SELECT version, updated_at FROM conversation_sessions WHERE session_id = ?""",
+                    (session_id,),
+                ).fetchone()
+                if not row:
+                    return None, None
+                if self.is_expired(row[1]):
+                    self._delete(conn, session_id)
+                    return None, None
+                cursor = conn.execute(
+                    """SELECT seq, message FROM conversation_messages WHERE session_id = ? ORDER BY seq""",
+                    (session_id,),
+                )
+                return [(seq, json.loads(message)) for seq, message in cursor], row[0]
+            except Error as e:
+                logger.error(f"[SessionStore] 加载会话失败: {str(e)}")
+                return None, None
+
+    def save(self, session_id, appended, removed):
+        conn = self._get_connection()
+        try:
+            with conn:
+                # 立即获取写锁，读取最大seq到写入完成之间其他进程不能写入
+                conn.execute("""BEGIN IMMEDIATE""")
+                start = conn.execute(
+                    """SELECT COALESCE(MAX(seq), 0) FROM conversation_messages WHERE session_id = ?""", (session_id,)
+                ).fetchone()[0] + 1
+                seqs = list(range(start, start + len(appended)))
+                if removed:
+                    conn.executemany(
+                        """DELETE FROM conversation_messages WHERE session_id = ? AND seq = ?""",
+                        [(session_id, seq) for seq in removed],
+                    )
+                if appended:
+                    conn.executemany(
+                        """INSERT INTO conversation_messages (session_id, seq, message) VALUES (?, ?, ?)""",
+                        [(session_id, seq, json.dumps(message, ensure_ascii=False)) for seq, message in zip(seqs, appended)],
+                    )
+                conn.execute(
+                    """INSERT INTO conversation_sessions (session_id, version, updated_at) VALUES (?, 1, ?)
+                             ON CONFLICT(session_id) DO UPDATE SET version = version + 1, updated_at = excluded.updated_at""",
+                    (session_id, int(time.time())),
+                )
+                version = conn.execute(
+                    """SELECT version FROM conversation_sessions WHERE session_id = ?""", (session_id,)
+                ).fetchone()[0]
+            return version, seqs
+        except Error as e:
+            logger.error(f"[SessionStore] 保存会话失败: {str(e)}")
+            return None, None
+
+    def version(self, session_id):
+        with self._get_connection() as conn:
+            try:
+                row = conn.execute(
+                    """SELECT version FROM conversation_sessions WHERE session_id = ?""", (session_id,)
+                ).fetchone()
+                return row[0] if row else None
+            except Error as e:
+                logger.error(f"[SessionStore] 获取会话版本失败: {str(e)}")
+                return None
+
+    def delete(self, session_id):
+        with self._get_connection() as conn:
+            try:
+                self._delete(conn, session_id)
+            except Error as e:
+                logger.error(f"[SessionStore] 删除会话失败: {str(e)}")
+
+    def _delete(self, conn, session_id):
+        conn.execute("""DELETE FROM conversation_messages WHERE session_id = ?""", (session_id,))
+        conn.execute("""DELETE FROM conversation_sessions WHERE session_id = ?""", (session_id,))
+        conn.commit()
+
+    def clear(self):
+        with self._get_connection() as conn:
+            try:
+                conn.execute("""DELETE FROM conversation_messages""")
+                conn.execute("""DELETE FROM conversation_sessions""")
+                conn.commit()
+            except Error as e:
+                logger.error(f"[SessionStore] 清空会话失败: {str(e)}")
+
+
+class FileSessionStore(SessionStore):
+    """
+    文件存储，每个session一个jsonl文件，只追加写入，删除消息时追加一条墓碑记录，墓碑过多时重写文件
+    只适用于单进程
+    """
+
+    COMPACT_THRESHOLD = 200  # 墓碑记录超过该数量时重写文件
+
+    def __init__(self, dir_path):
+        super().__init__()
+        self.dir_path = dir_path
+        os.makedirs(dir_path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.removed_counts = {}  # session_id -> 文件中的墓碑记录数
+        self.max_seqs = {}  # session_id -> 已分配的最大seq
+
+    def _path(self, session_id):
+        return os.path.join(self.dir_path, hashlib.md5(session_id.encode("utf-8")).hexdigest() + ".jsonl")
+
+    def _read(self, path):
+        items = {}
+        removed_count = 0
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("[SessionStore] skip broken record in {}".format(path))
+                    continue
+                if "removed" in record:
+                    removed_count += 1
+                    for seq in record["removed"]:
+                        items.pop(seq, None)
+                else:
+                    items[record["seq"]] = record["message"]
+        return sorted(items.items()), removed_count
+
+    def load(self, session_id):
+        path = self._path(session_id)
+        with self.lock:
+            if not os.path.exists(path):
+                return None, None
+            if self.is_expired(os.path.getmtime(path)):
+                os.remove(path)
+                return None, None
+            items, self.removed_counts[session_id] = self._read(path)
+            self.max_seqs[session_id] = items[-1][0] if items else 0
+            return items, None
+
+    def save(self, session_id, appended, removed):
+        path = self._path(session_id)
+        with self.lock:
+            if session_id not in self.max_seqs:
+                items = self._read(path)[0] if os.path.exists(path) else []
+                self.max_seqs[session_id] = items[-1][0] if items else 0
+            start = self.max_seqs[session_id] + 1
+            seqs = list(range(start, start + len(appended)))
+            self.max_seqs[session_id] = start + len(appended) - 1
+            with open(path, "a", encoding="utf-8") as f:
+                if removed:
+                    f.write(json.dumps({"removed": list(removed)}) + "\n")
+                for seq, message in zip(seqs, appended):
+                    f.write(json.dumps({"seq": seq, "message": message}, ensure_ascii=False) + "\n")
+            if removed:
+                self.removed_counts[session_id] = self.removed_counts.get(session_id, 0) + 1
+                if self.removed_counts[session_id] > self.COMPACT_THRESHOLD:
+                    self._compact(path)
+                    self.removed_counts[session_id] = 0
+        return None, seqs
+
+    def _compact(self, path):
+        items, _ = self._read(path)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for seq, message in items:
+                f.write(json.dumps({"seq": seq, "message": message}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+
+    def delete(self, session_id):
+        path = self._path(session_id)
+        with self.lock:
+            self.removed_counts.pop(session_id, None)
+            self.max_seqs.pop(session_id, None)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def clear(self):
+        with self.lock:
+            self.removed_counts.clear()
+            self.max_seqs.clear()
+            for file_name in os.listdir(self.dir_path):
+                if file_name.endswith(".jsonl"):
+                    os.remove(os.path.join(self.dir_path, file_name))
+
+
+def create_session_store():
+    store_type = conf().get("session_store", "memory")
+    path = conf().get("session_store_path")
+    if store_type == "sqlite":
+        return SqliteSessionStore(path or os.path.join(get_appdata_dir(), "conversations.db"))
+    elif store_type == "file":
+        return FileSessionStore(path or os.path.join(get_appdata_dir(), "conversations"))
+    elif store_type != "memory":
+        logger.warning("[SessionStore] unknown session_store={}, fallback to memory".format(store_type))
+    return MemorySessionStore()
@@ -1,7 +1,5 @@
 # encoding:utf-8
 
-import time
-
 import openai
 import openai.error
 from bot.bot import Bot
@@ -11,6 +9,7 @@ from bot.session_manager import SessionManager
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
 from common.log import logger
+from common.retry import CIRCUIT_OPEN_REPLY, RetryPolicy
 from config import conf, load_config
 from zhipuai import ZhipuAI
 
@@ -26,6 +25,7 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             "top_p": conf().get("top_p", 0.7),  # 值在(0,1)之间(智谱AI 的 top_p 不能取 0 或者 1)
         }
         self.client = ZhipuAI(api_key=conf().get("zhipu_ai_api_key"))
+        self.retry = RetryPolicy("zhipuai")
 
     def reply(self, query, context=None):
         # acquire reply content
@@ -46,7 +46,8 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
                 reply = Reply(ReplyType.INFO, "配置已更新")
             if reply:
                 return reply
-            session = self.sessions.session_query(query, session_id)
+            retry_count = context.get("retry_count", 0)
+            session = self.sessions.session_query(query, session_id, retry=retry_count > 0)
             logger.debug("[ZHIPU_AI] session query={}".format(session.messages))
 
             api_key = context.get("openai_api_key") or openai.api_key
@@ -59,7 +60,7 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
             #     # reply in stream
             #     return self.reply_text_stream(query, new_query, session_id)
 
-            reply_content = self.reply_text(session, api_key, args=new_args)
+            reply_content = self.reply_text(session, api_key, args=new_args, retry_count=retry_count)
             logger.debug(
                 "[ZHIPU_AI] new_query={}, session_id={}, reply_cont={}, completion_tokens={}".format(
                     session.messages,
@@ -98,6 +99,8 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
         :param retry_count: retry count
         :return: {}
         """
+        if not self.retry.allow():
+            return {"completion_tokens": 0, "content": CIRCUIT_OPEN_REPLY}
         try:
             # if conf().get("rate_limit_chatgpt") and not self.tb4chatgpt.get_token():
             #     raise openai.error.RateLimitError("RateLimitError: rate limit exceeded")
@@ -106,6 +109,7 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
                 args = self.args
             # response = openai.ChatCompletion.create(api_key=api_key, messages=session.messages, **args)
             response = self.client.chat.completions.create(messages=session.messages, **args)
+            self.retry.record_success()
             # logger.debug("[ZHIPU_AI] response={}".format(response))
             # logger.info("[ZHIPU_AI] reply={}, total_tokens={}".format(response.choices[0]['message']['content'], response["usage"]["total_tokens"]))
 
@@ -115,35 +119,29 @@ class ZHIPUAIBot(Bot, ZhipuAIImage):
                 "content": response.choices[0].message.content,
             }
         except Exception as e:
-            need_retry = retry_count < 2
+            need_retry = True
             result = {"completion_tokens": 0, "content": "我现在有点累了，等会再来吧"}
             if isinstance(e, openai.error.RateLimitError):
                 logger.warn("[ZHIPU_AI] RateLimitError: {}".format(e))
                 result["content"] = "提问太快啦，请休息一下再问我吧"
-                if need_retry:
-                    time.sleep(20)
             elif isinstance(e, openai.error.Timeout):
                 logger.warn("[ZHIPU_AI] Timeout: {}".format(e))
                 result["content"] = "我没有收到你的消息"
-                if need_retry:
-                    time.sleep(5)
+                self.retry.record_failure()
             elif isinstance(e, openai.error.APIError):
                 logger.warn("[ZHIPU_AI] Bad Gateway: {}".format(e))
                 result["content"] = "请再问我一次"
-                if need_retry:
-                    time.sleep(10)
+                self.retry.record_failure()
             elif isinstance(e, openai.error.APIConnectionError):
                 logger.warn("[ZHIPU_AI] APIConnectionError: {}".format(e))
                 result["content"] = "我连接不到你的网络"
-                if need_retry:
-                    time.sleep(5)
+                self.retry.record_failure()
             else:
                 logger.exception("[ZHIPU_AI] Exception: {}".format(e), e)
                 need_retry = False
                 self.sessions.clear_session(session.session_id)
 
-            if need_retry:
-                logger.warn("[ZHIPU_AI] 第{}次重试".format(retry_count + 1))
+            if need_retry and self.retry.wait(retry_count, e):
                 return self.reply_text(session, api_key, args, retry_count + 1)
             else:
                 return result
@@ -4,87 +4,131 @@ from bridge.reply import Reply
 from common import const
 from common.log import logger
 from common.singleton import singleton
-from config import conf
+from config import conf, subscribe_config
 from translate.factory import create_translator
 from voice.factory import create_voice
 
 
+# 语音和翻译bot初始化时读取的配置项，配置重载时只有这些配置项变化才重建对应的bot
+BOT_CONFIG_KEYS = {
+    "voice_to_text": ({"proxy", "baidu_app_id", "baidu_api_key", "baidu_secret_key", "baidu_dev_pid", "open_ai_api_key",
+                       "open_ai_api_base"}, ("azure_voice_", "linkai_", "xunfei_")),
+    "text_to_voice": ({"proxy", "baidu_app_id", "baidu_api_key", "baidu_secret_key", "open_ai_api_key",
+                       "open_ai_api_base", "text_to_voice_model", "tts_voice_id"}, ("azure_voice_", "xi_", "linkai_", "xunfei_")),
+    "translate": (set(), ("baidu_translate_",)),
+}
+
+# chat bot读取的配置项较多且各不相同，除以下确定与chat bot无关的配置项外，任何配置项变化都重建chat bot
+CHAT_IRRELEVANT_KEYS = (
+    {"single_chat_prefix", "single_chat_reply_prefix", "single_chat_reply_suffix", "group_chat_prefix", "no_need_at",
+     "group_chat_reply_prefix", "group_chat_reply_suffix", "group_chat_keyword", "group_at_off", "group_name_white_list",
+     "group_name_keyword_white_list", "group_chat_in_one_session", "nick_name_black_list", "group_welcome_msg",
+     "trigger_by_self", "image_create_prefix", "concurrency_in_session", "handler_pool_size", "max_inflight_messages",
+     "session_busy_reply", "stream_update_interval", "async_mode", "group_chat_exit_group", "speech_recognition",
+     "group_speech_recognition", "voice_reply_voice", "always_reply_voice", "voice_to_text", "text_to_voice",
+     "text_to_voice_model", "tts_voice_id", "baidu_dev_pid", "chat_time_module", "chat_start_time", "chat_stop_time",
+     "translate", "hot_reload", "clear_memory_commands", "channel_type", "subscribe_msg", "debug", "config_watch",
+     "config_watch_interval", "use_global_plugin_config", "max_media_send_count", "media_send_interval", "web_port"},
+    ("session_queue_", "stream_reply", "plugin_", "http_", "azure_voice_", "xi_", "baidu_translate_", "wechaty_",
+     "wechatmp_", "wechatcom", "wework_", "feishu_", "dingtalk_"),
+)
+
+
+def chat_bot_affected(changed_keys):
+    keys, prefixes = CHAT_IRRELEVANT_KEYS
+    return any(key not in keys and not key.startswith(prefixes) for key in changed_keys)
+
+
+def resolve_bot_types():
+    """
+    根据当前配置确定各类bot的类型
+    """
+    btype = {
+        "chat": const.CHATGPT,
+        "voice_to_text": conf().get("voice_to_text", "openai"),
+        "text_to_voice": conf().get("text_to_voice", "google"),
+        "translate": conf().get("translate", "baidu"),
+    }
+    # 这边取配置的模型
+    bot_type = conf().get("bot_type")
+    if bot_type:
+        btype["chat"] = bot_type
+    else:
+        model_type = conf().get("model") or const.GPT35
+        if model_type in ["text-davinci-003"]:
+            btype["chat"] = const.OPEN_AI
+        if conf().get("use_azure_chatgpt", False):
+            btype["chat"] = const.CHATGPTONAZURE
+        if model_type in ["wenxin", "wenxin-4"]:
+            btype["chat"] = const.BAIDU
+        if model_type in ["xunfei"]:
+            btype["chat"] = const.XUNFEI
+        if model_type in [const.QWEN]:
+            btype["chat"] = const.QWEN
+        if model_type in [const.QWEN_TURBO, const.QWEN_PLUS, const.QWEN_MAX]:
+            btype["chat"] = const.QWEN_DASHSCOPE
+        if model_type and model_type.startswith("gemini"):
+            btype["chat"] = const.GEMINI
+        if model_type and model_type.startswith("glm"):
+            btype["chat"] = const.ZHIPU_AI
+        if model_type and model_type.startswith("claude-3"):
+            btype["chat"] = const.CLAUDEAPI
+
+        if model_type in ["claude"]:
+            btype["chat"] = const.CLAUDEAI
+
+        if model_type in [const.MOONSHOT, "moonshot-v1-8k", "moonshot-v1-32k", "moonshot-v1-128k"]:
+            btype["chat"] = const.MOONSHOT
+
+        if model_type in [const.MODELSCOPE]:
+            btype["chat"] = const.MODELSCOPE
+        
+        if model_type in ["abab6.5-chat"]:
+            btype["chat"] = const.MiniMax
+
+        if conf().get("use_linkai") and conf().get("linkai_api_key"):
+            btype["chat"] = const.LINKAI
+            if not conf().get("voice_to_text") or conf().get("voice_to_text") in ["openai"]:
+                btype["voice_to_text"] = const.LINKAI
+            if not conf().get("text_to_voice") or conf().get("text_to_voice") in ["openai", const.TTS_1, const.TTS_1_HD]:
+                btype["text_to_voice"] = const.LINKAI
+    return btype
+
+
 @singleton
 class Bridge(object):
     def __init__(self):
-        self.btype = {
-            "chat": const.CHATGPT,
-            "voice_to_text": conf().get("voice_to_text", "openai"),
-            "text_to_voice": conf().get("text_to_voice", "google"),
-            "translate": conf().get("translate", "baidu"),
-        }
-        # 这边取配置的模型
-        bot_type = conf().get("bot_type")
-        if bot_type:
-            self.btype["chat"] = bot_type
-        else:
-            model_type = conf().get("model") or const.GPT35
-            if model_type in ["text-davinci-003"]:
-                self.btype["chat"] = const.OPEN_AI
-            if conf().get("use_azure_chatgpt", False):
-                self.btype["chat"] = const.CHATGPTONAZURE
-            if model_type in ["wenxin", "wenxin-4"]:
-                self.btype["chat"] = const.BAIDU
-            if model_type in ["xunfei"]:
-                self.btype["chat"] = const.XUNFEI
-            if model_type in [const.QWEN]:
-                self.btype["chat"] = const.QWEN
-            if model_type in [const.QWEN_TURBO, const.QWEN_PLUS, const.QWEN_MAX]:
-                self.btype["chat"] = const.QWEN_DASHSCOPE
-            if model_type and model_type.startswith("gemini"):
-                self.btype["chat"] = const.GEMINI
-            if model_type and model_type.startswith("glm"):
-                self.btype["chat"] = const.ZHIPU_AI
-            if model_type and model_type.startswith("claude-3"):
-                self.btype["chat"] = const.CLAUDEAPI
-
-            if model_type in ["claude"]:
-                self.btype["chat"] = const.CLAUDEAI
-
-            if model_type in [const.MOONSHOT, "moonshot-v1-8k", "moonshot-v1-32k", "moonshot-v1-128k"]:
-                self.btype["chat"] = const.MOONSHOT
-
-            if model_type in [const.MODELSCOPE]:
-                self.btype["chat"] = const.MODELSCOPE
-            
-            if model_type in ["abab6.5-chat"]:
-                self.btype["chat"] = const.MiniMax
-
-            if conf().get("use_linkai") and conf().get("linkai_api_key"):
-                self.btype["chat"] = const.LINKAI
-                if not conf().get("voice_to_text") or conf().get("voice_to_text") in ["openai"]:
-                    self.btype["voice_to_text"] = const.LINKAI
-                if not conf().get("text_to_voice") or conf().get("text_to_voice") in ["openai", const.TTS_1, const.TTS_1_HD]:
-                    self.btype["text_to_voice"] = const.LINKAI
-
+        self.btype = resolve_bot_types()
         self.bots = {}
         self.chat_bots = {}
+        subscribe_config(self.on_config_changed)
 
     # 模型对应的接口
     def get_bot(self, typename):
         if self.bots.get(typename) is None:
-            logger.info("create bot {} for {}".format(self.btype[typename], typename))
-            if typename == "text_to_voice":
-                self.bots[typename] = create_voice(self.btype[typename])
-            elif typename == "voice_to_text":
-                self.bots[typename] = create_voice(self.btype[typename])
-            elif typename == "chat":
-                self.bots[typename] = create_bot(self.btype[typename])
-            elif typename == "translate":
-                self.bots[typename] = create_translator(self.btype[typename])
+            self.bots[typename] = self.create_bot(typename)
         return self.bots[typename]
 
+    def create_bot(self, typename):
+        logger.info("create bot {} for {}".format(self.btype[typename], typename))
+        if typename == "text_to_voice":
+            return create_voice(self.btype[typename])
+        elif typename == "voice_to_text":
+            return create_voice(self.btype[typename])
+        elif typename == "chat":
+            return create_bot(self.btype[typename])
+        elif typename == "translate":
+            return create_translator(self.btype[typename])
+
     def get_bot_type(self, typename):
         return self.btype[typename]
 
     def fetch_reply_content(self, query, context: Context) -> Reply:
         return self.get_bot("chat").reply(query, context)
 
+    async def async_fetch_reply_content(self, query, context: Context) -> Reply:
+        return await self.get_bot("chat").async_reply(query, context)
+
     def fetch_voice_to_text(self, voiceFile) -> Reply:
         return self.get_bot("voice_to_text").voiceToText(voiceFile)
 
@@ -103,4 +147,57 @@ class Bridge(object):
         """
         重置bot路由
         """
-        self.__init__()
+        self.btype = resolve_bot_types()
+        self.bots = {}
+        self.chat_bots = {}
+
+    def on_config_changed(self, changed_keys, old_config, new_config):
+        """
+        配置重载后只重建受影响的bot，新bot创建成功后再替换，未受影响的bot及其会话保持不变
+        """
+        btype = resolve_bot_types()
+        for typename in btype:
+            if btype[typename] != self.btype[typename]:
+                affected = True
+            elif typename == "chat":
+                affected = chat_bot_affected(changed_keys)
+            else:
+                keys, prefixes = BOT_CONFIG_KEYS[typename]
+                affected = any(key in keys or key.startswith(prefixes) for key in changed_keys)
+            self.btype[typename] = btype[typename]
+            if not affected:
+                continue
+            if typename == "chat":
+                self.chat_bots = {}
+            old_bot = self.bots.get(typename)
+            if old_bot is None:
+                continue
+            logger.info("[Bridge] config changed, rebuild {} bot: {}".format(typename, btype[typename]))
+            try:
+                new_bot = self.create_bot(typename)
+            except Exception as e:
+                logger.exception("[Bridge] rebuild {} bot failed, keep the old one: {}".format(typename, e))
+                continue
+            if type(new_bot) is type(old_bot) and hasattr(old_bot, "sessions") and hasattr(new_bot, "sessions"):
+                self._carry_sessions(old_bot.sessions, new_bot.sessions)
+            self.bots[typename] = new_bot
+
+    @staticmethod
+    def _carry_sessions(old_manager, new_manager):
+        """
+        同类型的bot沿用原有会话，逐个放入新容器，使新的expires_in_seconds生效
+        模型变化时改为新模型并清空缓存的token数，下次请求时按新模型重新计算
+        """
+        model = new_manager.session_args.get("model")
+        for session_id, session in old_manager.sessions.items():
+            if type(session) is not new_manager.sessioncls:
+                # 换用了其他session类型(如o1模型)，按新类型重建后沿用消息和存储状态
+                new_session = new_manager.sessioncls(session_id, session.system_prompt, **new_manager.session_args)
+                new_session.messages = session.messages
+                new_session.stored_messages = session.stored_messages
+                new_session.stored_version = session.stored_version
+                session = new_session
+            elif model and getattr(session, "model", model) != model:
+                session.model = model
+                session.message_tokens = {}
+            new_manager.sessions[session_id] = session
@@ -37,6 +37,9 @@ class Channel(object):
     def build_reply_content(self, query, context: Context = None) -> Reply:
         return Bridge().fetch_reply_content(query, context)
 
+    async def async_build_reply_content(self, query, context: Context = None) -> Reply:
+        return await Bridge().async_fetch_reply_content(query, context)
+
     def build_voice_to_text(self, voice_file) -> Reply:
         return Bridge().fetch_voice_to_text(voice_file)
 
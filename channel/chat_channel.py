@@ -1,14 +1,19 @@
+import asyncio
 import os
 import re
 import threading
 import time
 from asyncio import CancelledError
+from collections import deque
 from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Empty
 
 from bridge.context import *
 from bridge.reply import *
 from channel.channel import Channel
+from channel.trigger_matcher import TriggerMatcher, mention_pattern
 from common.dequeue import Dequeue
+from common.retry import RetryLater, defer_retry
 from common import memory
 from plugins import *
 
@@ -17,18 +22,34 @@ try:
 except Exception as e:
     pass
 
-handler_pool = ThreadPoolExecutor(max_workers=8)  # 处理消息的线程池
+SENTENCE_END_PATTERN = re.compile(r"[。！？；!?;\n]|\.(?=\s)")  # 流式回复分段发送时的句子结尾
 
 
 # 抽象类, 它包含了与消息通道无关的通用处理逻辑
 class ChatChannel(Channel):
+    SUPPORT_STREAM_REPLY = False  # 是否支持逐步展示流式回复，不支持时按句子分段发送
     name = None  # 登录的用户名
     user_id = None  # 登录的用户id
     futures = {}  # 记录每个session_id提交到线程池的future对象, 用于重置会话时把没执行的future取消掉，正在执行的不会被取消
     sessions = {}  # 用于控制并发，每个session_id同时只能有一个context在处理
     lock = threading.Lock()  # 用于控制对sessions的访问
+    ready_cond = threading.Condition(lock)  # 就绪队列非空时唤醒消费线程
+    ready_queue = deque()  # 有待处理消息且可以再分发的session_id
+    ready_set = set()  # 已在ready_queue中的session_id，避免重复入队
+    loop = None  # asyncio模式下处理消息的事件循环
+    stats = {"inflight": 0, "drop_oldest": 0, "drop_newest": 0, "reply_busy": 0}  # 处理中的消息数和各策略丢弃的消息数
+    generation = 0  # 每次取消会话加1，消息入队时记录当时的值，用于丢弃取消之前的退避重试
+    cancelled_generations = {}  # session_id -> 最近一次取消该会话时的generation，会话处理完且没有等待中的重试时删除
+    backoff_counts = {}  # session_id -> 等待退避后重新入队的消息数
+    all_cancelled_generation = 0  # 最近一次取消所有会话时的generation
 
     def __init__(self):
+        self.handler_pool = ThreadPoolExecutor(max_workers=conf().get("handler_pool_size", 8))  # 处理消息的线程池
+        if conf().get("async_mode", False) and ChatChannel.loop is None:
+            ChatChannel.loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=ChatChannel.loop.run_forever)
+            _loop_thread.setDaemon(True)
+            _loop_thread.start()
         _thread = threading.Thread(target=self.consume)
         _thread.setDaemon(True)
         _thread.start()
@@ -44,34 +65,21 @@ class ChatChannel(Channel):
             context["origin_ctype"] = ctype
         # context首次传入时，receiver是None，根据类型设置receiver
         first_in = "receiver" not in context
+        matcher = TriggerMatcher.get()  # 按当前配置编译的触发规则
+        config = matcher.config
         # 群名匹配过程，设置session_id和receiver
         if first_in:  # context首次传入时，receiver是None，根据类型设置receiver
-            config = conf()
             cmsg = context["msg"]
-            user_data = conf().get_user_data(cmsg.from_user_id)
+            user_data = config.get_user_data(cmsg.from_user_id)
             context["openai_api_key"] = user_data.get("openai_api_key")
             context["gpt_model"] = user_data.get("gpt_model")
             if context.get("isgroup", False):
                 group_name = cmsg.other_user_nickname
                 group_id = cmsg.other_user_id
 
-                group_name_white_list = config.get("group_name_white_list", [])
-                group_name_keyword_white_list = config.get("group_name_keyword_white_list", [])
-                if any(
-                    [
-                        group_name in group_name_white_list,
-                        "ALL_GROUP" in group_name_white_list,
-                        check_contain(group_name, group_name_keyword_white_list),
-                    ]
-                ):
-                    group_chat_in_one_session = conf().get("group_chat_in_one_session", [])
+                if matcher.is_group_allowed(group_name):
                     session_id = cmsg.actual_user_id
-                    if any(
-                        [
-                            group_name in group_chat_in_one_session,
-                            "ALL_GROUP" in group_chat_in_one_session,
-                        ]
-                    ):
+                    if matcher.is_group_in_one_session(group_name):
                         session_id = group_id
                 else:
                     logger.debug(f"No need reply, groupName not in whitelist, group_name={group_name}")
@@ -96,11 +104,10 @@ class ChatChannel(Channel):
                 logger.debug("[chat_channel]reference query skipped")
                 return None
 
-            nick_name_black_list = conf().get("nick_name_black_list", [])
             if context.get("isgroup", False):  # 群聊
                 # 校验关键字
-                match_prefix = check_prefix(content, conf().get("group_chat_prefix"))
-                match_contain = check_contain(content, conf().get("group_chat_keyword"))
+                match_prefix = matcher.group_chat_prefix.match(content)
+                match_contain = matcher.group_chat_keyword.match(content)
                 flag = False
                 if context["msg"].to_user_id != context["msg"].actual_user_id:
                     if match_prefix is not None or match_contain is not None:
@@ -109,25 +116,22 @@ class ChatChannel(Channel):
                             content = content.replace(match_prefix, "", 1).strip()
                     if context["msg"].is_at:
                         nick_name = context["msg"].actual_user_nickname
-                        if nick_name and nick_name in nick_name_black_list:
+                        if matcher.is_nick_name_blocked(nick_name):
                             # 黑名单过滤
                             logger.warning(f"[chat_channel] Nickname {nick_name} in In BlackList, ignore")
                             return None
 
                         logger.info("[chat_channel]receive group at")
-                        if not conf().get("group_at_off", False):
+                        if not config.get("group_at_off", False):
                             flag = True
                         self.name = self.name if self.name is not None else ""  # 部分渠道self.name可能没有赋值
-                        pattern = f"@{re.escape(self.name)}(\u2005|\u0020)"
-                        subtract_res = re.sub(pattern, r"", content)
+                        subtract_res = mention_pattern(self.name).sub(r"", content)
                         if isinstance(context["msg"].at_list, list):
                             for at in context["msg"].at_list:
-                                pattern = f"@{re.escape(at)}(\u2005|\u0020)"
-                                subtract_res = re.sub(pattern, r"", subtract_res)
+                                subtract_res = mention_pattern(at).sub(r"", subtract_res)
                         if subtract_res == content and context["msg"].self_display_name:
                             # 前缀移除后没有变化，使用群昵称再次移除
-                            pattern = f"@{re.escape(context['msg'].self_display_name)}(\u2005|\u0020)"
-                            subtract_res = re.sub(pattern, r"", content)
+                            subtract_res = mention_pattern(context["msg"].self_display_name).sub(r"", content)
                         content = subtract_res
                 if not flag:
                     if context["origin_ctype"] == ContextType.VOICE:
@@ -135,12 +139,12 @@ class ChatChannel(Channel):
                     return None
             else:  # 单聊
                 nick_name = context["msg"].from_user_nickname
-                if nick_name and nick_name in nick_name_black_list:
+                if matcher.is_nick_name_blocked(nick_name):
                     # 黑名单过滤
                     logger.warning(f"[chat_channel] Nickname '{nick_name}' in In BlackList, ignore")
                     return None
 
-                match_prefix = check_prefix(content, conf().get("single_chat_prefix", [""]))
+                match_prefix = matcher.single_chat_prefix.match(content)
                 if match_prefix is not None:  # 判断如果匹配到自定义前缀，则返回过滤掉前缀+空格后的内容
                     content = content.replace(match_prefix, "", 1).strip()
                 elif context["origin_ctype"] == ContextType.VOICE:  # 如果源消息是私聊的语音消息，允许不匹配前缀，放宽条件
@@ -149,17 +153,17 @@ class ChatChannel(Channel):
                     logger.info("[chat_channel]receive single chat msg, but checkprefix didn't match")
                     return None
             content = content.strip()
-            img_match_prefix = check_prefix(content, conf().get("image_create_prefix",[""]))
+            img_match_prefix = matcher.image_create_prefix.match(content)
             if img_match_prefix:
                 content = content.replace(img_match_prefix, "", 1)
                 context.type = ContextType.IMAGE_CREATE
             else:
                 context.type = ContextType.TEXT
             context.content = content.strip()
-            if "desire_rtype" not in context and conf().get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and config.get("always_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         elif context.type == ContextType.VOICE:
-            if "desire_rtype" not in context and conf().get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
+            if "desire_rtype" not in context and config.get("voice_reply_voice") and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                 context["desire_rtype"] = ReplyType.VOICE
         return context
 
@@ -180,6 +184,9 @@ class ChatChannel(Channel):
             self._send_reply(context, reply)
 
     def _generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
+        if "retry_count" in context:
+            # 退避重试或等待限流的消息已经过插件处理，直接请求bot
+            return self._build_bot_reply(context)
         e_context = PluginManager().emit_event(
             EventContext(
                 Event.ON_HANDLE_CONTEXT,
@@ -191,28 +198,10 @@ class ChatChannel(Channel):
             logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
             if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
                 context["channel"] = e_context["channel"]
-                reply = super().build_reply_content(context.content, context)
+                context["stream"] = self._stream_enabled(context)
+                reply = self._build_bot_reply(context)
             elif context.type == ContextType.VOICE:  # 语音消息
-                cmsg = context["msg"]
-                cmsg.prepare()
-                file_path = context.content
-                wav_path = os.path.splitext(file_path)[0] + ".wav"
-                try:
-                    any_to_wav(file_path, wav_path)
-                except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
-                    logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
-                    wav_path = file_path
-                # 语音识别
-                reply = super().build_voice_to_text(wav_path)
-                # 删除临时文件
-                try:
-                    os.remove(file_path)
-                    if wav_path != file_path:
-                        os.remove(wav_path)
-                except Exception as e:
-                    pass
-                    # logger.warning("[chat_channel]delete temp file error: " + str(e))
-
+                reply = self._build_voice_text(context)
                 if reply.type == ReplyType.TEXT:
                     new_context = self._compose_context(ContextType.TEXT, reply.content, **context.kwargs)
                     if new_context:
@@ -233,6 +222,90 @@ class ChatChannel(Channel):
                 return
         return reply
 
+    def _build_bot_reply(self, context: Context) -> Reply:
+        """
+        请求bot回复，bot需要退避重试时不在处理线程中等待，等待结束后把消息放回会话队列的队首重新分发
+        """
+        try:
+            with defer_retry():
+                return super().build_reply_content(context.content, context)
+        except RetryLater as e:
+            context["retry_count"] = e.retry_count
+            with self.lock:
+                self.backoff_counts[context["session_id"]] = self.backoff_counts.get(context["session_id"], 0) + 1
+            timer = threading.Timer(e.delay, self._requeue, args=(context,))
+            timer.daemon = True
+            timer.start()
+            return None
+
+    def _requeue(self, context: Context):
+        session_id = context["session_id"]
+        with self.lock:
+            self.backoff_counts[session_id] -= 1
+            if not self.backoff_counts[session_id]:
+                del self.backoff_counts[session_id]
+            if self._is_cancelled(context):
+                logger.info("[chat_channel] session {} cancelled during backoff, drop retry".format(session_id))
+                self._forget_cancelled(session_id)
+                return
+            context_queue = self._ensure_session(session_id)[0]
+            max_size = conf().get("session_queue_max_size", 0)
+            if max_size and context_queue.qsize() >= max_size:
+                # 重试的消息比队列中的都早，队列已满时按drop_oldest丢弃
+                self.stats["drop_oldest"] += 1
+                logger.warning("[chat_channel] session queue full, drop retry, session_id={}, qsize={}".format(session_id, context_queue.qsize()))
+                self._schedule(session_id)
+                return
+            context_queue.putleft(context)
+            self._schedule(session_id)
+
+    def _is_cancelled(self, context: Context):
+        """
+        消息入队后会话是否被取消过，调用方需持有self.lock
+        """
+        generation = context.get("generation", self.generation)
+        cancelled = max(self.cancelled_generations.get(context["session_id"], 0), self.all_cancelled_generation)
+        return generation < cancelled
+
+    def _forget_cancelled(self, session_id):
+        """
+        会话处理完且没有等待中的重试时，不会再有取消之前的消息，删除其取消记录，调用方需持有self.lock
+        """
+        if session_id not in self.sessions and session_id not in self.backoff_counts:
+            self.cancelled_generations.pop(session_id, None)
+
+    def _stream_enabled(self, context: Context) -> bool:
+        # 需要语音回复时要拿到完整文本再合成，不使用流式回复
+        return bool(conf().get("stream_reply")) and context.type == ContextType.TEXT and context.get("desire_rtype") != ReplyType.VOICE
+
+    def _support_stream_reply(self, context: Context) -> bool:
+        """
+        本次回复能否逐步展示，不能时由_send_stream_by_sentence分段发送
+        """
+        return self.SUPPORT_STREAM_REPLY
+
+    def _build_voice_text(self, context: Context) -> Reply:
+        cmsg = context["msg"]
+        cmsg.prepare()
+        file_path = context.content
+        wav_path = os.path.splitext(file_path)[0] + ".wav"
+        try:
+            any_to_wav(file_path, wav_path)
+        except Exception as e:  # 转换失败，直接使用mp3，对于某些api，mp3也可以识别
+            logger.warning("[chat_channel]any to wav error, use raw path. " + str(e))
+            wav_path = file_path
+        # 语音识别
+        reply = super().build_voice_to_text(wav_path)
+        # 删除临时文件
+        try:
+            os.remove(file_path)
+            if wav_path != file_path:
+                os.remove(wav_path)
+        except Exception as e:
+            pass
+            # logger.warning("[chat_channel]delete temp file error: " + str(e))
+        return reply
+
     def _decorate_reply(self, context: Context, reply: Reply) -> Reply:
         if reply and reply.type:
             e_context = PluginManager().emit_event(
@@ -254,13 +327,20 @@ class ChatChannel(Channel):
                     if desire_rtype == ReplyType.VOICE and ReplyType.VOICE not in self.NOT_SUPPORT_REPLYTYPE:
                         reply = super().build_text_to_voice(reply.content)
                         return self._decorate_reply(context, reply)
+                    reply.content = self._wrap_reply_text(context, reply_text)
+                elif reply.type == ReplyType.TEXT_STREAM and self._support_stream_reply(context):
+                    # 不支持逐步展示的通道分段发送，每段在_send_stream_by_sentence中分别加上前后缀
                     if context.get("isgroup", False):
+                        prefix = conf().get("group_chat_reply_prefix", "")
                         if not context.get("no_need_at", False):
-                            reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
-                        reply_text = conf().get("group_chat_reply_prefix", "") + reply_text + conf().get("group_chat_reply_suffix", "")
+                            prefix += "@" + context["msg"].actual_user_nickname + "\n"
+                        suffix = conf().get("group_chat_reply_suffix", "")
                     else:
-                        reply_text = conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
-                    reply.content = reply_text
+                        prefix = conf().get("single_chat_reply_prefix", "")
+                        suffix = conf().get("single_chat_reply_suffix", "")
+                    reply.content = _wrap_stream(reply.content, prefix, suffix)
+                elif reply.type == ReplyType.TEXT_STREAM:
+                    pass
                 elif reply.type == ReplyType.ERROR or reply.type == ReplyType.INFO:
                     reply.content = "[" + str(reply.type) + "]\n" + reply.content
                 elif reply.type == ReplyType.IMAGE_URL or reply.type == ReplyType.VOICE or reply.type == ReplyType.IMAGE or reply.type == ReplyType.FILE or reply.type == ReplyType.VIDEO or reply.type == ReplyType.VIDEO_URL:
@@ -272,6 +352,16 @@ class ChatChannel(Channel):
                 logger.warning("[chat_channel] desire_rtype: {}, but reply type: {}".format(context.get("desire_rtype"), reply.type))
             return reply
 
+    def _wrap_reply_text(self, context: Context, reply_text):
+        """
+        文本回复加上群聊@和配置的前后缀
+        """
+        if context.get("isgroup", False):
+            if not context.get("no_need_at", False):
+                reply_text = "@" + context["msg"].actual_user_nickname + "\n" + reply_text.strip()
+            return conf().get("group_chat_reply_prefix", "") + reply_text + conf().get("group_chat_reply_suffix", "")
+        return conf().get("single_chat_reply_prefix", "") + reply_text + conf().get("single_chat_reply_suffix", "")
+
     def _send_reply(self, context: Context, reply: Reply):
         if reply and reply.type:
             e_context = PluginManager().emit_event(
@@ -287,16 +377,100 @@ class ChatChannel(Channel):
 
     def _send(self, reply: Reply, context: Context, retry_cnt=0):
         try:
-            self.send(reply, context)
+            if reply.type == ReplyType.TEXT_STREAM and not self._support_stream_reply(context):
+                self._send_stream_by_sentence(reply, context)
+            else:
+                self.send(reply, context)
         except Exception as e:
             logger.error("[chat_channel] sendMsg error: {}".format(str(e)))
             if isinstance(e, NotImplementedError):
                 return
             logger.exception(e)
-            if retry_cnt < 2:
+            if retry_cnt < 2 and reply.type != ReplyType.TEXT_STREAM:  # 流式回复已被部分消费，无法重发
                 time.sleep(3 + 3 * retry_cnt)
                 self._send(reply, context, retry_cnt + 1)
 
+    # 不支持逐步展示的通道，缓存流式回复，超过stream_reply_min_length后在句子结尾处分段发送
+    def _send_stream_by_sentence(self, reply: Reply, context: Context):
+        min_length = conf().get("stream_reply_min_length", 100)
+        buffer = ""
+        for chunk in reply.content:
+            buffer += chunk
+            if len(buffer) < min_length:
+                continue
+            end = 0
+            for match in SENTENCE_END_PATTERN.finditer(buffer):
+                end = match.end()
+            if end:
+                segment, buffer = buffer[:end], buffer[end:]
+                self._send(Reply(ReplyType.TEXT, self._wrap_reply_text(context, segment.strip())), context)
+        if buffer.strip():
+            self._send(Reply(ReplyType.TEXT, self._wrap_reply_text(context, buffer.strip())), context)
+
+    # asyncio模式下的消息处理流程，与同步流程一一对应，插件事件和阻塞的IO放到线程池执行，bot回复通过async_reply获取
+    async def _async_handle(self, context: Context):
+        if context is None or not context.content:
+            return
+        logger.debug("[chat_channel] ready to handle context in asyncio: {}".format(context))
+        reply = await self._async_generate_reply(context)
+
+        logger.debug("[chat_channel] ready to decorate reply: {}".format(reply))
+
+        if reply and reply.content:
+            reply = await self._async_decorate_reply(context, reply)
+
+            await self._async_send_reply(context, reply)
+
+    async def _async_generate_reply(self, context: Context, reply: Reply = Reply()) -> Reply:
+        if "retry_count" in context:
+            # 退避重试或等待限流的消息已经过插件处理，直接请求bot
+            return await super().async_build_reply_content(context.content, context)
+        loop = asyncio.get_event_loop()
+        e_context = await loop.run_in_executor(
+            None,
+            PluginManager().emit_event,
+            EventContext(
+                Event.ON_HANDLE_CONTEXT,
+                {"channel": self, "context": context, "reply": reply},
+            ),
+        )
+        reply = e_context["reply"]
+        if not e_context.is_pass():
+            logger.debug("[chat_channel] ready to handle context: type={}, content={}".format(context.type, context.content))
+            if context.type == ContextType.TEXT or context.type == ContextType.IMAGE_CREATE:  # 文字和图片消息
+                context["channel"] = e_context["channel"]
+                context["stream"] = self._stream_enabled(context)
+                reply = await super().async_build_reply_content(context.content, context)
+            elif context.type == ContextType.VOICE:  # 语音消息
+                reply = await loop.run_in_executor(None, self._build_voice_text, context)
+                if reply.type == ReplyType.TEXT:
+                    new_context = self._compose_context(ContextType.TEXT, reply.content, **context.kwargs)
+                    if new_context:
+                        reply = await self._async_generate_reply(new_context)
+                    else:
+                        return
+            elif context.type == ContextType.IMAGE:  # 图片消息，当前仅做下载保存到本地的逻辑
+                memory.USER_IMAGE_CACHE[context["session_id"]] = {
+                    "path": context.content,
+                    "msg": context.get("msg")
+                }
+            elif context.type == ContextType.SHARING:  # 分享信息，当前无默认逻辑
+                pass
+            elif context.type == ContextType.FUNCTION or context.type == ContextType.FILE:  # 文件消息及函数调用等，当前无默认逻辑
+                pass
+            else:
+                logger.warning("[chat_channel] unknown context type: {}".format(context.type))
+                return
+        return reply
+
+    async def _async_decorate_reply(self, context: Context, reply: Reply) -> Reply:
+        # 装饰过程可能触发语音合成，整体放到线程池执行
+        return await asyncio.get_event_loop().run_in_executor(None, self._decorate_reply, context, reply)
+
+    async def _async_send_reply(self, context: Context, reply: Reply):
+        # 各channel的send均为同步实现，放到线程池执行，需要原生异步发送的channel可以重写此方法
+        await asyncio.get_event_loop().run_in_executor(None, self._send_reply, context, reply)
+
     def _success_callback(self, session_id, **kwargs):  # 线程正常结束时的回调函数
         logger.debug("Worker return success, session_id = {}".format(session_id))
 
@@ -317,69 +491,169 @@ class ChatChannel(Channel):
                 logger.exception("Worker raise exception: {}".format(e))
             with self.lock:
                 self.sessions[session_id][1].release()
+                self.stats["inflight"] -= 1
+                self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
+                self._schedule(session_id)
+                self.ready_cond.notify()  # 处理中的消息数减少，唤醒可能因max_inflight_messages等待的消费线程
 
         return func
 
+    def _schedule(self, session_id):
+        """
+        根据session状态决定其去留，调用方需持有self.lock
+        有待处理消息且信号量有余量时放入就绪队列并唤醒消费线程；无消息且无任务在处理时删除session
+        """
+        context_queue, semaphore = self.sessions[session_id]
+        if not context_queue.empty():
+            if session_id not in self.ready_set and semaphore._value > 0:
+                self.ready_set.add(session_id)
+                self.ready_queue.append(session_id)
+                self.ready_cond.notify()
+        elif semaphore._initial_value == semaphore._value:  # 没有任务持有信号量，说明所有任务都处理完毕
+            assert len(self.futures.get(session_id, [])) == 0, "thread pool error"
+            self.futures.pop(session_id, None)
+            del self.sessions[session_id]
+            self._forget_cancelled(session_id)
+
+    def _ensure_session(self, session_id):
+        """
+        返回session的[消息队列, 信号量]，不存在时创建，调用方需持有self.lock
+        """
+        if session_id not in self.sessions:
+            self.sessions[session_id] = [
+                Dequeue(),
+                threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
+            ]
+        return self.sessions[session_id]
+
     def produce(self, context: Context):
         session_id = context["session_id"]
+        busy = False
         with self.lock:
-            if session_id not in self.sessions:
-                self.sessions[session_id] = [
-                    Dequeue(),
-                    threading.BoundedSemaphore(conf().get("concurrency_in_session", 4)),
-                ]
-            if context.type == ContextType.TEXT and context.content.startswith("#"):
-                self.sessions[session_id][0].putleft(context)  # 优先处理管理命令
+            context["generation"] = self.generation
+            context_queue = self._ensure_session(session_id)[0]
+            if _is_admin_command(context):
+                context_queue.putleft(context)  # 优先处理管理命令，不受队列长度限制
             else:
-                self.sessions[session_id][0].put(context)
-
-    # 消费者函数，单独线程，用于从消息队列中取出消息并处理
+                max_size = conf().get("session_queue_max_size", 0)
+                policy = conf().get("session_queue_overflow_policy", "drop_oldest")
+                if max_size and context_queue.qsize() >= max_size:
+                    if policy not in ["drop_newest", "reply_busy"]:
+                        policy = "drop_oldest"
+                    self.stats[policy] += 1
+                    logger.warning("[chat_channel] session queue full, policy={}, session_id={}, qsize={}".format(policy, session_id, context_queue.qsize()))
+                    if policy == "drop_oldest":
+                        try:
+                            # 管理命令在队列头部，跳过它们丢弃最早的普通消息
+                            context_queue.get_first_nowait(lambda queued: not _is_admin_command(queued))
+                            context_queue.put(context)
+                        except Empty:
+                            logger.warning("[chat_channel] session queue full of admin commands, drop new message, session_id={}".format(session_id))
+                    else:
+                        busy = policy == "reply_busy"
+                else:
+                    context_queue.put(context)
+            self._schedule(session_id)
+        if busy:
+            reply = Reply(ReplyType.TEXT, conf().get("session_busy_reply", "消息太多啦，请稍后再发"))
+            self.handler_pool.submit(self._send_busy_reply, context, reply)
+
+    def _send_busy_reply(self, context: Context, reply: Reply):
+        reply = self._decorate_reply(context, reply)
+        self._send_reply(context, reply)
+
+    def get_queue_stats(self) -> dict:
+        """
+        获取消息队列的运行状态
+        :return: 会话数、排队消息总数、最长会话队列、处理中的消息数及各策略丢弃的消息数
+        """
+        with self.lock:
+            depths = [context_queue.qsize() for context_queue, _ in self.sessions.values()]
+            stats = {
+                "sessions": len(self.sessions),
+                "queued": sum(depths),
+                "max_queue_depth": max(depths) if depths else 0,
+                "ready": len(self.ready_queue),
+            }
+            stats.update(self.stats)
+            return stats
+
+    # 消费者函数，单独线程，由produce和任务结束回调唤醒，每次从就绪队列取出一个session分发一条消息
     def consume(self):
         while True:
+            with self.ready_cond:
+                while not self.ready_queue or self._inflight_full():
+                    self.ready_cond.wait()
+                session_id = self.ready_queue.popleft()
+                self.ready_set.discard(session_id)
+                if session_id not in self.sessions:
+                    continue
+                context_queue, semaphore = self.sessions[session_id]
+                if context_queue.empty() or not semaphore.acquire(blocking=False):
+                    self._schedule(session_id)
+                    continue
+                context = context_queue.get()
+                self.stats["inflight"] += 1
+                if session_id not in self.futures:
+                    self.futures[session_id] = []
+                # 仍有消息且信号量有余量时重新排到队尾，保证各session轮流分发
+                self._schedule(session_id)
+            logger.debug("[chat_channel] consume context: {}".format(context))
+            if self.loop:
+                future: Future = asyncio.run_coroutine_threadsafe(self._async_handle(context), self.loop)
+            else:
+                future: Future = self.handler_pool.submit(self._handle, context)
             with self.lock:
-                session_ids = list(self.sessions.keys())
-            for session_id in session_ids:
-                with self.lock:
-                    context_queue, semaphore = self.sessions[session_id]
-                if semaphore.acquire(blocking=False):  # 等线程处理完毕才能删除
-                    if not context_queue.empty():
-                        context = context_queue.get()
-                        logger.debug("[chat_channel] consume context: {}".format(context))
-                        future: Future = handler_pool.submit(self._handle, context)
-                        future.add_done_callback(self._thread_pool_callback(session_id, context=context))
-                        with self.lock:
-                            if session_id not in self.futures:
-                                self.futures[session_id] = []
-                            self.futures[session_id].append(future)
-                    elif semaphore._initial_value == semaphore._value + 1:  # 除了当前，没有任务再申请到信号量，说明所有任务都处理完毕
-                        with self.lock:
-                            self.futures[session_id] = [t for t in self.futures[session_id] if not t.done()]
-                            assert len(self.futures[session_id]) == 0, "thread pool error"
-                            del self.sessions[session_id]
-                    else:
-                        semaphore.release()
-            time.sleep(0.2)
+                self.futures[session_id].append(future)
+            future.add_done_callback(self._thread_pool_callback(session_id, context=context))
+
+    def _inflight_full(self):
+        max_inflight = conf().get("max_inflight_messages", 0)
+        return max_inflight and self.stats["inflight"] >= max_inflight
 
     # 取消session_id对应的所有任务，只能取消排队的消息和已提交线程池但未执行的任务
     def cancel_session(self, session_id):
         with self.lock:
-            if session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
-                cnt = self.sessions[session_id][0].qsize()
-                if cnt > 0:
-                    logger.info("Cancel {} messages in session {}".format(cnt, session_id))
-                self.sessions[session_id][0] = Dequeue()
+            ChatChannel.generation += 1
+            if session_id in self.sessions or session_id in self.backoff_counts:
+                self.cancelled_generations[session_id] = self.generation
+            if session_id not in self.sessions:
+                return
+            futures = list(self.futures.get(session_id, []))
+            cnt = self.sessions[session_id][0].qsize()
+            if cnt > 0:
+                logger.info("Cancel {} messages in session {}".format(cnt, session_id))
+            self.sessions[session_id][0] = Dequeue()
+        # 取消成功会同步触发回调，回调中需要获取self.lock，因此在锁外取消
+        for future in futures:
+            future.cancel()
 
     def cancel_all_session(self):
+        futures = []
         with self.lock:
+            ChatChannel.generation += 1
+            ChatChannel.all_cancelled_generation = self.generation
+            self.cancelled_generations.clear()
             for session_id in self.sessions:
-                for future in self.futures[session_id]:
-                    future.cancel()
+                futures.extend(self.futures.get(session_id, []))
                 cnt = self.sessions[session_id][0].qsize()
                 if cnt > 0:
                     logger.info("Cancel {} messages in session {}".format(cnt, session_id))
                 self.sessions[session_id][0] = Dequeue()
+        for future in futures:
+            future.cancel()
+
+
+def _wrap_stream(chunks, prefix, suffix):
+    if prefix:
+        yield prefix
+    yield from chunks
+    if suffix:
+        yield suffix
+
+
+def _is_admin_command(context):
+    return context.type == ContextType.TEXT and context.content.startswith("#")
 
 
 def check_prefix(content, prefix_list):
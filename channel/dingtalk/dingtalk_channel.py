@@ -21,14 +21,13 @@ from bridge.context import Context, ContextType
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel
 from channel.dingtalk.dingtalk_message import DingTalkMessage
+from common.access_token import token_manager
 from common.expired_dict import ExpiredDict
 from common.log import logger
 from common.singleton import singleton
 from common.time_check import time_checker
 from config import conf
 
-_token_cache = {"token": None, "expire": 0}
-
 
 class CustomAICardReplier(CardReplier):
     def __init__(self, dingtalk_client, incoming_message):
@@ -86,14 +85,15 @@ def _check(func):
 
 @singleton
 class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
+    SUPPORT_STREAM_REPLY = True  # 开启AI卡片时逐步刷新卡片，否则按句子分段发送
     dingtalk_client_id = conf().get("dingtalk_client_id")
     dingtalk_client_secret = conf().get("dingtalk_client_secret")
     dingtalk_robot_code = conf().get("dingtalk_robot_code")
 
     def get_token(self):
-        now = time.time()
-        if _token_cache["token"] and now < _token_cache["expire"]:
-            return _token_cache["token"]
+        return token_manager.get("dingtalk", self.dingtalk_client_id, self._request_token)
+
+    def _request_token(self):
         config = open_api_models.Config()
         config.protocol = "https"
         config.region_id = "central"
@@ -102,17 +102,8 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
             app_key=self.dingtalk_client_id, 
             app_secret=self.dingtalk_client_secret
         )
-        try:
-            response = authclient.get_access_token(get_access_token_request)
-            token = getattr(response.body, "access_token", None)
-            expire_in = getattr(response.body, "expire_in", 7200)
-            if token:
-                _token_cache["token"] = token
-                _token_cache["expire"] = now + expire_in - 500  # 提前200秒刷新
-            return token
-        except Exception as err:
-            print(f"获取token失败: {err}")
-            return None
+        response = authclient.get_access_token(get_access_token_request)
+        return getattr(response.body, "access_token", None), getattr(response.body, "expire_in", 7200)
 
     def setup_logger(self):
         logger = logging.getLogger()
@@ -196,11 +187,18 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
         if context:
             self.produce(context)
 
+    def _support_stream_reply(self, context: Context) -> bool:
+        return bool(conf().get("dingtalk_card_enabled") and conf().get("dingtalk_card_template_id"))
+
     def send(self, reply: Reply, context: Context):
         receiver = context["receiver"]
         isgroup = context.kwargs["msg"].is_group
         from_message = context.kwargs["msg"].incoming_message
 
+        if reply.type == ReplyType.TEXT_STREAM:
+            self.reply_ai_card_stream(reply, from_message)
+            return
+
         # if conf().get("dingtalk_card_enabled"):
         #     logger.info("[Dingtalk] sendMsg={}, receiver={}".format(reply, receiver))
 
@@ -244,6 +242,27 @@ class DingTalkChanel(ChatChannel, dingtalk_stream.ChatbotHandler):
 
         return button_list, markdown_content
 
+    def reply_ai_card_stream(self, reply: Reply, incoming_message):
+        """
+        使用AI卡片展示流式回复，按stream_update_interval间隔刷新卡片内容
+        """
+        card_replier = AICardReplier(self.dingtalk_client, incoming_message)
+        card_instance_id = card_replier.start(conf().get("dingtalk_card_template_id"), {"content": ""})
+        interval = conf().get("stream_update_interval", 1)
+        content = ""
+        last_update = 0
+        try:
+            for chunk in reply.content:
+                content += chunk
+                if time.time() - last_update >= interval:
+                    card_replier.streaming(card_instance_id, content_key="content", content_value=content, append=False, finished=False, failed=False)
+                    last_update = time.time()
+            card_replier.streaming(card_instance_id, content_key="content", content_value=content, append=False, finished=True, failed=False)
+            card_replier.finish(card_instance_id, {"content": content})
+        except Exception as e:
+            logger.error(f"[DingTalk] stream ai card failed: {e}")
+            card_replier.fail(card_instance_id, {"content": content})
+
     def create_client(self):
         config = open_api_models.Config()
         config.protocol = "https"
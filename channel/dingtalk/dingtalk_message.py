@@ -1,6 +1,6 @@
 import os
 
-import requests
+from common import http_client
 from dingtalk_stream import ChatbotMessage
 
 from bridge.context import ContextType
@@ -64,7 +64,7 @@ def download_image_file(image_url, temp_dir):
     # 设置代理
     # self.proxies
     # , proxies=self.proxies
-    response = requests.get(image_url, headers=headers, stream=True, timeout=60 * 5)
+    response = http_client.get(image_url, headers=headers, stream=True, timeout=60 * 5)
     if response.status_code == 200:
 
         # 生成文件名
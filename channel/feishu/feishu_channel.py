@@ -6,9 +6,11 @@
 """
 
 # -*- coding=utf-8 -*-
+import time
 import uuid
 
-import requests
+from common import http_client
+from common.access_token import token_manager
 import web
 from channel.feishu.feishu_message import FeishuMessage
 from bridge.context import Context
@@ -24,10 +26,12 @@ import json
 import os
 
 URL_VERIFICATION = "url_verification"
+MAX_MESSAGE_EDITS = 20  # 飞书限制同一条消息的编辑次数
 
 
 @singleton
 class FeiShuChanel(ChatChannel):
+    SUPPORT_STREAM_REPLY = True
     feishu_app_id = conf().get('feishu_app_id')
     feishu_app_secret = conf().get('feishu_app_secret')
     feishu_token = conf().get('feishu_token')
@@ -51,17 +55,17 @@ class FeiShuChanel(ChatChannel):
         web.httpserver.runsimple(app.wsgifunc(), ("0.0.0.0", port))
 
     def send(self, reply: Reply, context: Context):
-        msg = context.get("msg")
-        is_group = context["isgroup"]
-        if msg:
-            access_token = msg.access_token
-        else:
-            access_token = self.fetch_access_token()
+        # token有缓存，消息在队列中等待较久时也能拿到未过期的token
+        access_token = self.fetch_access_token()
         headers = {
             "Authorization": "Bearer " + access_token,
             "Content-Type": "application/json",
         }
         msg_type = "text"
+        if reply.type == ReplyType.TEXT_STREAM:
+            logger.info(f"[FeiShu] start send stream reply message, type={context.type}")
+            self._send_stream(reply, context, headers)
+            return
         logger.info(f"[FeiShu] start send reply message, type={context.type}, content={reply.content}")
         reply_content = reply.content
         content_key = "text"
@@ -73,31 +77,94 @@ class FeiShuChanel(ChatChannel):
                 return
             msg_type = "image"
             content_key = "image_key"
-        if is_group:
+        self._post_message(context, headers, msg_type, json.dumps({content_key: reply_content}))
+
+    def _post_message(self, context: Context, headers: dict, msg_type: str, content: str) -> dict:
+        msg = context.get("msg")
+        if context["isgroup"]:
             # 群聊中直接回复
             url = f"https://open.feishu.cn/open-apis/im/v1/messages/{msg.msg_id}/reply"
             data = {
                 "msg_type": msg_type,
-                "content": json.dumps({content_key: reply_content})
+                "content": content
             }
-            res = requests.post(url=url, headers=headers, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, json=data, timeout=(5, 10))
         else:
             url = "https://open.feishu.cn/open-apis/im/v1/messages"
             params = {"receive_id_type": context.get("receive_id_type") or "open_id"}
             data = {
                 "receive_id": context.get("receiver"),
                 "msg_type": msg_type,
-                "content": json.dumps({content_key: reply_content})
+                "content": content
             }
-            res = requests.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
+            res = http_client.post(url=url, headers=headers, params=params, json=data, timeout=(5, 10))
         res = res.json()
         if res.get("code") == 0:
             logger.info(f"[FeiShu] send message success")
         else:
             logger.error(f"[FeiShu] send message failed, code={res.get('code')}, msg={res.get('msg')}")
+        return res
+
+    def _send_stream(self, reply: Reply, context: Context, headers: dict):
+        """
+        流式回复：收到首个片段时发送消息，之后编辑该消息，结束时写入完整内容
+        消息的编辑次数有上限，每编辑5次刷新间隔翻倍，并给最后一次完整写入留出一次
+        """
+        interval = conf().get("stream_update_interval", 1)
+        message_id = None
+        content = ""
+        sent_content = ""
+        last_update = 0
+        edits = 0
+        for chunk in reply.content:
+            content += chunk
+            if not content.strip():
+                continue
+            if message_id is None:
+                res = self._post_message(context, headers, "text", json.dumps({"text": content}))
+                message_id = (res.get("data") or {}).get("message_id")
+                if not message_id:
+                    break
+                sent_content, last_update = content, time.time()
+            elif edits < MAX_MESSAGE_EDITS - 1 and time.time() - last_update >= interval * 2 ** (edits // 5):
+                edits += 1
+                if self._update_message(message_id, headers, content):
+                    sent_content = content
+                else:
+                    edits = MAX_MESSAGE_EDITS - 1  # 编辑失败后不再刷新，只在结束时尝试写入完整内容
+                last_update = time.time()
+        if message_id is None:
+            # 首条消息发送失败，消费剩余片段后整体发送
+            content += "".join(reply.content)
+            if content.strip():
+                self._post_message(context, headers, "text", json.dumps({"text": content}))
+        elif content != sent_content and not self._update_message(message_id, headers, content):
+            # 写入完整内容失败时，未展示的部分作为新消息发送
+            rest = content[len(sent_content):]
+            if rest.strip():
+                self._post_message(context, headers, "text", json.dumps({"text": rest}))
+
+    def _update_message(self, message_id: str, headers: dict, text: str) -> bool:
+        url = f"https://open.feishu.cn/open-apis/im/v1/messages/{message_id}"
+        data = {
+            "msg_type": "text",
+            "content": json.dumps({"text": text})
+        }
+        try:
+            res = http_client.put(url=url, headers=headers, json=data, timeout=(5, 10)).json()
+        except Exception as e:
+            logger.error(f"[FeiShu] update message failed: {e}")
+            return False
+        if res.get("code") != 0:
+            logger.error(f"[FeiShu] update message failed, code={res.get('code')}, msg={res.get('msg')}")
+            return False
+        return True
 
 
     def fetch_access_token(self) -> str:
+        return token_manager.get("feishu", self.feishu_app_id, self._request_access_token) or ""
+
+    def _request_access_token(self):
         url = "https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal/"
         headers = {
             "Content-Type": "application/json"
@@ -107,21 +174,18 @@ class FeiShuChanel(ChatChannel):
             "app_secret": self.feishu_app_secret
         }
         data = bytes(json.dumps(req_body), encoding='utf8')
-        response = requests.post(url=url, data=data, headers=headers)
-        if response.status_code == 200:
-            res = response.json()
-            if res.get("code") != 0:
-                logger.error(f"[FeiShu] get tenant_access_token error, code={res.get('code')}, msg={res.get('msg')}")
-                return ""
-            else:
-                return res.get("tenant_access_token")
-        else:
-            logger.error(f"[FeiShu] fetch token error, res={response}")
+        response = http_client.post(url=url, data=data, headers=headers)
+        if response.status_code != 200:
+            raise Exception(f"http status {response.status_code}")
+        res = response.json()
+        if res.get("code") != 0:
+            raise Exception(f"code={res.get('code')}, msg={res.get('msg')}")
+        return res.get("tenant_access_token"), res.get("expire", 7200)
 
 
     def _upload_image_url(self, img_url, access_token):
         logger.debug(f"[WX] start download image, img_url={img_url}")
-        response = requests.get(img_url)
+        response = http_client.get(img_url)
         suffix = utils.get_path_suffix(img_url)
         temp_name = str(uuid.uuid4()) + "." + suffix
         if response.status_code == 200:
@@ -138,7 +202,7 @@ class FeiShuChanel(ChatChannel):
             'Authorization': f'Bearer {access_token}',
         }
         with open(temp_name, "rb") as file:
-            upload_response = requests.post(upload_url, files={"image": file}, data=data, headers=headers)
+            upload_response = http_client.post(upload_url, files={"image": file}, data=data, headers=headers)
             logger.info(f"[FeiShu] upload file, res={upload_response.content}")
             os.remove(temp_name)
             return upload_response.json().get("data").get("image_key")
@@ -0,0 +1,153 @@
+import functools
+import re
+import threading
+from collections import deque
+
+from config import conf
+
+
+class PrefixMatcher(object):
+    """
+    前缀列表编译成的trie，返回与check_prefix相同的结果：列表中最靠前的、content以之开头的前缀
+    """
+
+    def __init__(self, prefix_list):
+        self.prefix_list = list(prefix_list or [])
+        self.root = {}
+        for index, prefix in enumerate(self.prefix_list):
+            node = self.root
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            if None not in node:
+                node[None] = index  # None键记录在该节点结束的前缀在列表中的位置
+
+    def match(self, content):
+        if not self.prefix_list:
+            return None
+        node = self.root
+        best = node.get(None)
+        for ch in content:
+            node = node.get(ch)
+            if node is None:
+                break
+            index = node.get(None)
+            if index is not None and (best is None or index < best):
+                best = index
+        return None if best is None else self.prefix_list[best]
+
+
+class KeywordMatcher(object):
+    """
+    关键词列表编译成的Aho–Corasick自动机，一次扫描判断content是否包含任一关键词，返回与check_contain相同的结果
+    output[state]为在该状态结束的最长关键词，没有时为None
+    """
+
+    def __init__(self, keyword_list):
+        keyword_list = [keyword for keyword in (keyword_list or []) if keyword is not None]
+        self.empty = not keyword_list
+        self.match_all = "" in keyword_list  # 空关键词匹配任意内容
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+        for keyword in keyword_list:
+            state = 0
+            for ch in keyword:
+                next_state = self.goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][ch] = next_state
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                state = next_state
+            self.output[state] = keyword
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail_state = self.fail[state]
+                while fail_state and ch not in self.goto[fail_state]:
+                    fail_state = self.fail[fail_state]
+                self.fail[next_state] = self.goto[fail_state].get(ch, 0)
+                if self.output[next_state] is None:
+                    self.output[next_state] = self.output[self.fail[next_state]]
+
+    def match(self, content):
+        if self.empty:
+            return None
+        if self.match_all:
+            return True
+        return True if self.find(content) is not None else None
+
+    def find(self, content):
+        """
+        返回content中最先出现(结束位置最靠前)的关键词，没有时返回None
+        """
+        if self.empty:
+            return None
+        if self.match_all:
+            return ""
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for ch in content:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state] is not None:
+                return output[state]
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def mention_pattern(name):
+    """
+    匹配消息中@某人的正则，按名字缓存编译结果
+    """
+    return re.compile(f"@{re.escape(name)}(\u2005|\u0020)")
+
+
+class TriggerMatcher(object):
+    """
+    _compose_context使用的触发规则，由当前配置编译而成，配置重新加载或被修改后自动重新编译
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        config = conf()
+        matcher = cls._instance
+        if matcher is None or matcher.config is not config or matcher.version != config.version:
+            with cls._lock:
+                matcher = cls._instance
+                if matcher is None or matcher.config is not config or matcher.version != config.version:
+                    matcher = cls(config)
+                    cls._instance = matcher
+        return matcher
+
+    def __init__(self, config):
+        self.config = config
+        self.version = config.version
+        group_name_white_list = config.get("group_name_white_list", [])
+        self.all_group = "ALL_GROUP" in group_name_white_list
+        self.group_name_white_list = frozenset(group_name_white_list)
+        self.group_name_keyword_white_list = KeywordMatcher(config.get("group_name_keyword_white_list", []))
+        group_chat_in_one_session = config.get("group_chat_in_one_session", [])
+        self.all_group_in_one_session = "ALL_GROUP" in group_chat_in_one_session
+        self.group_chat_in_one_session = frozenset(group_chat_in_one_session)
+        self.group_chat_prefix = PrefixMatcher(config.get("group_chat_prefix"))
+        self.group_chat_keyword = KeywordMatcher(config.get("group_chat_keyword"))
+        self.single_chat_prefix = PrefixMatcher(config.get("single_chat_prefix", [""]))
+        self.image_create_prefix = PrefixMatcher(config.get("image_create_prefix", [""]))
+        self.nick_name_black_list = frozenset(config.get("nick_name_black_list", []))
+
+    def is_group_allowed(self, group_name):
+        return self.all_group or group_name in self.group_name_white_list or self.group_name_keyword_white_list.match(group_name) is not None
+
+    def is_group_in_one_session(self, group_name):
+        return self.all_group_in_one_session or group_name in self.group_chat_in_one_session
+
+    def is_nick_name_blocked(self, nick_name):
+        return bool(nick_name) and nick_name in self.nick_name_black_list
@@ -2,7 +2,7 @@ import sys
 import time
 import web
 import json
-from queue import Queue
+from queue import Empty, Queue
 from bridge.context import *
 from bridge.reply import Reply, ReplyType
 from channel.chat_channel import ChatChannel, check_prefix
@@ -34,6 +34,7 @@ class WebMessage(ChatMessage):
 @singleton
 class WebChannel(ChatChannel):
     NOT_SUPPORT_REPLYTYPE = [ReplyType.VOICE]
+    SUPPORT_STREAM_REPLY = True
     _instance = None
     
     # def __new__(cls):
@@ -76,6 +77,9 @@ class WebChannel(ChatChannel):
                 img = Image.open(image_storage)
                 print(img_url)
                 img.show()
+            elif reply.type == ReplyType.TEXT_STREAM:
+                self._send_stream(reply, context)
+                return
             else:
                 print(reply.content)
 
@@ -99,6 +103,23 @@ class WebChannel(ChatChannel):
             logger.error(f"Error in send method: {e}")
             raise
 
+    def _send_stream(self, reply: Reply, context: Context):
+        """
+        将流式回复的片段逐个放入用户的消息队列，前端按stream_id拼接成一条消息
+        """
+        user_id = context["receiver"]
+        if user_id not in self.message_queues:
+            self.message_queues[user_id] = Queue()
+        stream_id = "stream_" + self._generate_msg_id()
+        for chunk in reply.content:
+            self.message_queues[user_id].put({
+                "type": str(reply.type),
+                "stream_id": stream_id,
+                "content": chunk,
+                "timestamp": time.time()
+            })
+        logger.debug(f"Stream message queued for user {user_id}")
+
     def sse_handler(self, user_id):
         """
         Handle Server-Sent Events (SSE) for real-time communication.
@@ -114,14 +135,13 @@ class WebChannel(ChatChannel):
         try:    
             while True:
                 try:
-                    # 发送心跳
-                    yield f": heartbeat\n\n"
-                    
-                    # 非阻塞方式获取消息
-                    if not self.message_queues[user_id].empty():
-                        message = self.message_queues[user_id].get_nowait()
-                        yield f"data: {json.dumps(message)}\n\n"
-                    time.sleep(0.5)
+                    # 阻塞等待消息，有消息立即推送，空闲时发送心跳
+                    try:
+                        message = self.message_queues[user_id].get(timeout=1)
+                    except Empty:
+                        yield f": heartbeat\n\n"
+                        continue
+                    yield f"data: {json.dumps(message)}\n\n"
                 except Exception as e:
                     logger.error(f"SSE Error: {e}")
                     break
@@ -0,0 +1,116 @@
+"""
+第三方接口access_token的统一缓存，按(服务, 凭证)缓存token，过期前在后台刷新，同一凭证同时只有一个线程在获取token
+"""
+
+import threading
+import time
+
+from common.log import logger
+
+
+class _Entry(object):
+    def __init__(self):
+        self.token = None
+        self.expire_at = 0  # token过期时间
+        self.refresh_at = 0  # 到这个时间后在后台刷新token
+        self.lock = threading.Lock()  # 持有锁的线程负责获取token，其余线程等待它的结果
+        self.timer = None
+
+
+class AccessTokenManager(object):
+    """
+    fetcher: 无参函数，返回(token, 有效秒数)，获取失败时返回空token或抛出异常
+    token在有效期内直接返回缓存；进入刷新窗口后仍返回缓存，同时在后台刷新；
+    每次获取成功后设置定时器，即使一直没有请求，token也会在过期前刷新，消息处理时不再等待获取token
+    """
+
+    def __init__(self, refresh_ahead=300, retry_interval=60):
+        self.refresh_ahead = refresh_ahead  # 提前多少秒刷新
+        self.retry_interval = retry_interval  # 后台刷新失败后多少秒重试
+        self.entries = {}  # (provider, credential) -> _Entry
+        self.lock = threading.Lock()
+
+    def _entry(self, provider, credential):
+        key = (provider, credential)
+        entry = self.entries.get(key)
+        if entry is None:
+            with self.lock:
+                entry = self.entries.setdefault(key, _Entry())
+        return entry
+
+    def get(self, provider, credential, fetcher):
+        """
+        :return: 有效的token，获取失败时返回None
+        """
+        entry = self._entry(provider, credential)
+        token, expire_at = entry.token, entry.expire_at
+        now = time.time()
+        if token and now < expire_at:
+            if now >= entry.refresh_at:
+                self._refresh_async(provider, entry, fetcher)
+            return token
+        with entry.lock:
+            # 等锁期间其他线程可能已经获取到token
+            if not (entry.token and time.time() < entry.expire_at):
+                try:
+                    self._refresh(provider, entry, fetcher)
+                except Exception as e:
+                    logger.error("[AccessToken] fetch {} token failed: {}".format(provider, e))
+                    return None
+            return entry.token
+
+    def invalidate(self, provider, credential):
+        """
+        接口返回token失效时调用，下次get时重新获取
+        """
+        entry = self._entry(provider, credential)
+        with entry.lock:
+            entry.token = None
+            entry.expire_at = entry.refresh_at = 0
+            if entry.timer:
+                entry.timer.cancel()
+                entry.timer = None
+
+    def _refresh(self, provider, entry, fetcher):
+        """
+        获取token并设置下次刷新的定时器，调用时需持有entry.lock
+        """
+        token, expires_in = fetcher()
+        if not token:
+            raise ValueError("empty token")
+        now = time.time()
+        # 有效期比refresh_ahead还短时在有效期过半时刷新
+        delay = max(expires_in - self.refresh_ahead, expires_in / 2)
+        entry.token = token
+        entry.expire_at = now + expires_in
+        entry.refresh_at = now + delay
+        self._schedule(provider, entry, fetcher, delay)
+        logger.debug("[AccessToken] {} token refreshed, expires in {}s".format(provider, int(expires_in)))
+
+    def _schedule(self, provider, entry, fetcher, delay):
+        if entry.timer:
+            entry.timer.cancel()
+        entry.timer = threading.Timer(delay, self._refresh_async, args=(provider, entry, fetcher))
+        entry.timer.daemon = True
+        entry.timer.start()
+
+    def _refresh_async(self, provider, entry, fetcher):
+        # 已有线程在获取token时直接返回，锁由后台线程释放
+        if not entry.lock.acquire(blocking=False):
+            return
+        threading.Thread(target=self._background_refresh, args=(provider, entry, fetcher), daemon=True).start()
+
+    def _background_refresh(self, provider, entry, fetcher):
+        try:
+            self._refresh(provider, entry, fetcher)
+        except Exception as e:
+            logger.warn("[AccessToken] refresh {} token failed: {}".format(provider, e))
+            # 旧token在过期前仍然可用，稍后重试
+            if entry.expire_at > time.time():
+                entry.refresh_at = time.time() + self.retry_interval
+                self._schedule(provider, entry, fetcher, self.retry_interval)
+        finally:
+            entry.lock.release()
+
+
+token_manager = AccessTokenManager()
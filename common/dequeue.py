@@ -1,4 +1,4 @@
-from queue import Full, Queue
+from queue import Empty, Full, Queue
 from time import monotonic as time
 
 
@@ -31,3 +31,15 @@ class Dequeue(Queue):
 
     def _putleft(self, item):
         self.queue.appendleft(item)
+
+    def get_first_nowait(self, predicate):
+        """
+        取出队列中第一个满足predicate的元素，没有时抛出Empty
+        """
+        with self.not_empty:
+            for index, item in enumerate(self.queue):
+                if predicate(item):
+                    del self.queue[index]
+                    self.not_full.notify()
+                    return item
+            raise Empty
@@ -1,22 +1,71 @@
-from datetime import datetime, timedelta
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+SWEEP_INTERVAL = 60  # 后台清理过期key的间隔，单位秒
+
+_instances = weakref.WeakValueDictionary()  # id -> ExpiredDict，dict不可hash，不能用WeakSet
+_sweeper_lock = threading.Lock()
+_sweeper = None
+
+
+def _sweep_forever():
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        for expired_dict in list(_instances.values()):
+            expired_dict.expire()
+
+
+def _register(expired_dict):
+    global _sweeper
+    with _sweeper_lock:
+        _instances[id(expired_dict)] = expired_dict
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=_sweep_forever, name="expired-dict-sweeper", daemon=True)
+            _sweeper.start()
 
 
 class ExpiredDict(dict):
-    def __init__(self, expires_in_seconds):
+    """
+    带过期时间的dict，读写key会刷新过期时间，in、len和遍历只读不刷新
+    所有key的有效期相同，因此按最近访问排序的顺序就是过期顺序，过期的key在写入时和后台线程中从队首清理
+    max_size大于0时，超出容量会淘汰最久未访问的key
+    """
+
+    def __init__(self, expires_in_seconds, max_size=0):
         super().__init__()
         self.expires_in_seconds = expires_in_seconds
+        self.max_size = max_size
+        self.expiry = OrderedDict()  # key -> 过期时间(monotonic)，最早过期的在队首
+        self.lock = threading.RLock()
+        _register(self)
 
     def __getitem__(self, key):
-        value, expiry_time = super().__getitem__(key)
-        if datetime.now() > expiry_time:
-            del self[key]
-            raise KeyError("expired {}".format(key))
-        self.__setitem__(key, value)
-        return value
+        with self.lock:
+            expiry_time = self.expiry.get(key)
+            if expiry_time is None:
+                raise KeyError(key)
+            if time.monotonic() > expiry_time:
+                self._remove(key)
+                raise KeyError("expired {}".format(key))
+            self._touch(key)
+            return super().__getitem__(key)
 
     def __setitem__(self, key, value):
-        expiry_time = datetime.now() + timedelta(seconds=self.expires_in_seconds)
-        super().__setitem__(key, (value, expiry_time))
+        with self.lock:
+            super().__setitem__(key, value)
+            self._touch(key)
+            self.expire()
+            if self.max_size > 0:
+                while len(self.expiry) > self.max_size:
+                    self._remove(next(iter(self.expiry)))
+
+    def __delitem__(self, key):
+        with self.lock:
+            if key not in self.expiry:
+                raise KeyError(key)
+            self._remove(key)
 
     def get(self, key, default=None):
         try:
@@ -24,19 +73,65 @@ class ExpiredDict(dict):
         except KeyError:
             return default
 
+    def pop(self, key, *default):
+        with self.lock:
+            if key in self:
+                value = super().__getitem__(key)
+                self._remove(key)
+                return value
+            if default:
+                return default[0]
+            raise KeyError(key)
+
     def __contains__(self, key):
-        try:
-            self[key]
-            return True
-        except KeyError:
-            return False
+        with self.lock:
+            expiry_time = self.expiry.get(key)
+            return expiry_time is not None and time.monotonic() <= expiry_time
+
+    def __len__(self):
+        with self.lock:
+            self.expire()
+            return len(self.expiry)
 
     def keys(self):
-        keys = list(super().keys())
-        return [key for key in keys if key in self]
+        with self.lock:
+            self.expire()
+            return list(self.expiry)
+
+    def values(self):
+        with self.lock:
+            self.expire()
+            return [super(ExpiredDict, self).__getitem__(key) for key in self.expiry]
 
     def items(self):
-        return [(key, self[key]) for key in self.keys()]
+        with self.lock:
+            self.expire()
+            return [(key, super(ExpiredDict, self).__getitem__(key)) for key in self.expiry]
 
     def __iter__(self):
         return self.keys().__iter__()
+
+    def clear(self):
+        with self.lock:
+            super().clear()
+            self.expiry.clear()
+
+    def expire(self):
+        """
+        从队首清理所有已过期的key，每个key只会被清理一次
+        """
+        now = time.monotonic()
+        with self.lock:
+            while self.expiry:
+                key, expiry_time = next(iter(self.expiry.items()))
+                if expiry_time >= now:
+                    break
+                self._remove(key)
+
+    def _touch(self, key):
+        self.expiry[key] = time.monotonic() + self.expires_in_seconds
+        self.expiry.move_to_end(key)
+
+    def _remove(self, key):
+        del self.expiry[key]
+        super().__delitem__(key)
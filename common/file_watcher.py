@@ -0,0 +1,48 @@
+import os
+import threading
+import time
+
+from common.log import logger
+
+
+class FileWatcher(object):
+    """
+    轮询文件的修改时间，文件变化时在后台线程中调用对应的回调
+    """
+
+    def __init__(self, interval=3):
+        self.interval = interval
+        self.watches = {}  # path -> [上次的修改时间, callback]
+        self.lock = threading.Lock()
+
+    def watch(self, path, callback):
+        with self.lock:
+            self.watches[path] = [self._mtime(path), callback]
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="file-watcher", daemon=True)
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                watches = list(self.watches.items())
+            for path, watch in watches:
+                mtime = self._mtime(path)
+                if mtime == watch[0]:
+                    continue
+                watch[0] = mtime
+                logger.info("[FileWatcher] {} changed, reloading".format(path))
+                try:
+                    watch[1]()
+                except Exception as e:
+                    # 文件可能还没写完或格式有误，保留原配置，等待下次修改
+                    logger.error("[FileWatcher] reload {} failed: {}".format(path, e))
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
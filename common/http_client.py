@@ -0,0 +1,87 @@
+"""
+共享的HTTP客户端，按scheme+host复用requests.Session，同一服务的请求复用已建立的TCP/TLS连接
+"""
+
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import conf, subscribe_config
+
+_sessions = {}  # (scheme, host) -> requests.Session
+_lock = threading.Lock()
+
+
+class _RejectAllCookies(DefaultCookiePolicy):
+    # Session被不同服务、不同用户的请求共用，不保存响应设置的cookie，需要cookie的请求自行传入cookies参数
+    def set_ok(self, cookie, request):
+        return False
+
+
+def get_session(url) -> requests.Session:
+    """
+    返回url所在host的Session，每个host一个连接池，连接池大小为http_pool_size
+    """
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                session.cookies.set_policy(_RejectAllCookies())
+                pool_size = conf().get("http_pool_size", 10)
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _sessions[key] = session
+    return session
+
+
+def request(method, url, use_proxy=False, **kwargs) -> requests.Response:
+    """
+    与requests.request参数相同，未指定timeout时使用http_connect_timeout和http_read_timeout
+    :param use_proxy: 是否使用配置中的proxy，目前只用于访问openai的请求
+    """
+    if kwargs.get("timeout") is None:
+        kwargs["timeout"] = (conf().get("http_connect_timeout", 5), conf().get("http_read_timeout", 180))
+    if use_proxy and "proxies" not in kwargs:
+        proxy = conf().get("proxy")
+        if proxy:
+            kwargs["proxies"] = {"http": proxy, "https": proxy}
+    return get_session(url).request(method, url, **kwargs)
+
+
+def get(url, **kwargs) -> requests.Response:
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs) -> requests.Response:
+    return request("POST", url, **kwargs)
+
+
+def put(url, **kwargs) -> requests.Response:
+    return request("PUT", url, **kwargs)
+
+
+def close_all():
+    """
+    关闭所有连接池，之后的请求会按当前配置重新创建
+    """
+    with _lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+def _on_config_changed(changed_keys, old_config, new_config):
+    if "http_pool_size" in changed_keys:
+        close_all()
+
+
+subscribe_config(_on_config_changed)
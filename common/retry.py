@@ -0,0 +1,206 @@
+"""
+bot请求的重试策略和熔断器
+重试等待时间按指数退避加随机抖动计算，接口返回Retry-After时按其等待；同一服务连续失败时熔断，熔断期间直接返回错误
+"""
+
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+from common.log import logger
+from config import conf
+
+_defer = contextvars.ContextVar("defer_retry", default=False)  # 用ContextVar而不是threading.local，在其他线程中执行的插件可以通过copy_context继承
+_breakers = {}  # provider -> CircuitBreaker
+_breakers_lock = threading.Lock()
+
+CIRCUIT_OPEN_REPLY = "服务暂时不可用，请稍后再试"
+
+
+class RetryLater(BaseException):
+    """
+    在defer_retry范围内需要重试时抛出，调用方在delay秒后以retry_count重新发起请求，等待期间不占用线程
+    继承BaseException，不会被bot中的except Exception当作请求失败处理
+    """
+
+    def __init__(self, delay, retry_count):
+        super().__init__("retry after {:.1f}s".format(delay))
+        self.delay = delay
+        self.retry_count = retry_count
+
+
+@contextmanager
+def defer_retry():
+    """
+    在此范围内RetryPolicy.wait不在当前线程等待，而是抛出RetryLater
+    """
+    token = _defer.set(True)
+    try:
+        yield
+    finally:
+        _defer.reset(token)
+
+
+def throttle(delay, retry_count):
+    """
+    本地限流需要等待时调用，不计入重试次数，也不受retry_max_delay限制
+    在defer_retry范围内抛出RetryLater(retry_count不变)，调用方稍后重新调度，否则在当前线程等待
+    """
+    if _defer.get():
+        raise RetryLater(delay, retry_count)
+    time.sleep(delay)
+
+
+def get_retry_after(error):
+    """
+    从响应或异常携带的响应头中读取Retry-After，支持秒数和HTTP日期两种格式
+    :return: 需要等待的秒数，没有时返回None
+    """
+    if error is None:
+        return None
+    headers = getattr(error, "headers", None)
+    if headers is None and getattr(error, "response", None) is not None:
+        headers = getattr(error.response, "headers", None)
+    if not headers:
+        return None
+    try:
+        value = headers.get("Retry-After") or headers.get("retry-after")
+    except Exception:
+        return None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+class CircuitBreaker(object):
+    """
+    连续失败circuit_breaker_threshold次后打开，circuit_breaker_recovery秒内直接拒绝请求
+    之后进入半开状态放行一个探测请求，成功则关闭，失败则重新打开；探测请求没有结果时每隔recovery秒再放行一个
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if time.time() - self.opened_at >= conf().get("circuit_breaker_recovery", 60):
+                self.state = self.HALF_OPEN
+                self.opened_at = time.time()
+                logger.info("[CircuitBreaker] {} half open, probing".format(self.name))
+                return True
+            return False
+
+    def is_open(self):
+        return self.state == self.OPEN
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info("[CircuitBreaker] {} closed".format(self.name))
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            threshold = conf().get("circuit_breaker_threshold", 5)
+            if self.state == self.HALF_OPEN or (threshold and self.failures >= threshold and self.state == self.CLOSED):
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                logger.warn("[CircuitBreaker] {} open after {} failures".format(self.name, self.failures))
+
+
+def get_breaker(provider) -> CircuitBreaker:
+    with _breakers_lock:
+        breaker = _breakers.get(provider)
+        if breaker is None:
+            breaker = _breakers[provider] = CircuitBreaker(provider)
+        return breaker
+
+
+class RetryPolicy(object):
+    """
+    每个bot持有一个，同一provider共用一个熔断器
+    用法：请求前调用allow，成功后调用record_success，服务端错误调用record_failure，需要重试时调用wait
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.breaker = get_breaker(provider)
+
+    def allow(self):
+        return self.breaker.allow()
+
+    def record_success(self):
+        self.breaker.record_success()
+
+    def record_failure(self):
+        self.breaker.record_failure()
+
+    def backoff(self, retry_count, retry_after=None):
+        """
+        第retry_count次重试前的等待时间，在指数退避的后一半区间内随机取值，避免多个请求同时重试
+        """
+        if retry_after is not None:
+            return retry_after
+        delay = min(conf().get("retry_max_delay", 30), conf().get("retry_base_delay", 2) * (2 ** retry_count))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _retry_delay(self, retry_count, error):
+        """
+        :return: 重试前需要等待的秒数，已达到重试次数上限、熔断或Retry-After超过retry_max_delay时返回None
+        """
+        if retry_count >= conf().get("retry_max_times", 2) or self.breaker.is_open():
+            return None
+        retry_after = get_retry_after(error)
+        if retry_after is not None and retry_after > conf().get("retry_max_delay", 30):
+            logger.warn("[{}] Retry-After={}s exceeds retry_max_delay, give up".format(self.provider, retry_after))
+            return None
+        delay = self.backoff(retry_count, retry_after)
+        logger.warn("[{}] 第{}次重试, {:.1f}秒后".format(self.provider, retry_count + 1, delay))
+        return delay
+
+    def wait(self, retry_count, error=None):
+        """
+        判断是否重试并等待退避时间
+        在defer_retry范围内不等待，抛出RetryLater由调用方稍后重新调度
+        :return: False表示已达到重试次数上限、熔断或Retry-After超过retry_max_delay，不再重试
+        """
+        delay = self._retry_delay(retry_count, error)
+        if delay is None:
+            return False
+        if _defer.get():
+            raise RetryLater(delay, retry_count + 1)
+        time.sleep(delay)
+        return True
+
+    async def async_wait(self, retry_count, error=None):
+        """
+        wait的asyncio版本，在事件循环中等待退避时间
+        """
+        delay = self._retry_delay(retry_count, error)
+        if delay is None:
+            return False
+        await asyncio.sleep(delay)
+        return True
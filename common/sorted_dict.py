@@ -1,7 +1,12 @@
-import heapq
+import bisect
 
 
 class SortedDict(dict):
+    """
+    按sort_func(key, value)排序的dict，排序值相同时按key排序
+    有序的(排序值, key)列表用二分查找维护，插入和删除只移动一次列表元素，不再整体重排
+    """
+
     def __init__(self, sort_func=lambda k, v: k, init_dict=None, reverse=False):
         if init_dict is None:
             init_dict = []
@@ -10,53 +15,48 @@ class SortedDict(dict):
         self.sort_func = sort_func
         self.sorted_keys = None
         self.reverse = reverse
-        self.heap = []
+        self.priorities = {}  # key -> 当前排序值
+        self.sorted_pairs = []  # 升序的(排序值, key)
         for k, v in init_dict:
             self[k] = v
 
     def __setitem__(self, key, value):
-        if key in self:
-            super().__setitem__(key, value)
-            for i, (priority, k) in enumerate(self.heap):
-                if k == key:
-                    self.heap[i] = (self.sort_func(key, value), key)
-                    heapq.heapify(self.heap)
-                    break
-            self.sorted_keys = None
-        else:
-            super().__setitem__(key, value)
-            heapq.heappush(self.heap, (self.sort_func(key, value), key))
-            self.sorted_keys = None
+        super().__setitem__(key, value)
+        self._update_order(key)
 
     def __delitem__(self, key):
         super().__delitem__(key)
-        for i, (priority, k) in enumerate(self.heap):
-            if k == key:
-                del self.heap[i]
-                heapq.heapify(self.heap)
-                break
+        self._remove_pair(key, self.priorities.pop(key))
         self.sorted_keys = None
 
     def keys(self):
         if self.sorted_keys is None:
-            self.sorted_keys = [k for _, k in sorted(self.heap, reverse=self.reverse)]
+            keys = [k for _, k in self.sorted_pairs]
+            if self.reverse:
+                keys.reverse()
+            self.sorted_keys = keys
         return self.sorted_keys
 
     def items(self):
-        if self.sorted_keys is None:
-            self.sorted_keys = [k for _, k in sorted(self.heap, reverse=self.reverse)]
-        sorted_items = [(k, self[k]) for k in self.sorted_keys]
-        return sorted_items
+        return [(k, self[k]) for k in self.keys()]
+
+    def _update_order(self, key):
+        """
+        value被原地修改后调用，重新计算key的排序值
+        """
+        new_priority = self.sort_func(key, self[key])
+        if key in self.priorities:
+            priority = self.priorities[key]
+            if new_priority == priority:
+                return
+            self._remove_pair(key, priority)
+        self.priorities[key] = new_priority
+        bisect.insort(self.sorted_pairs, (new_priority, key))
+        self.sorted_keys = None
 
-    def _update_heap(self, key):
-        for i, (priority, k) in enumerate(self.heap):
-            if k == key:
-                new_priority = self.sort_func(key, self[key])
-                if new_priority != priority:
-                    self.heap[i] = (new_priority, key)
-                    heapq.heapify(self.heap)
-                    self.sorted_keys = None
-                break
+    def _remove_pair(self, key, priority):
+        i = bisect.bisect_left(self.sorted_pairs, (priority, key))
+        del self.sorted_pairs[i]
 
     def __iter__(self):
         return iter(self.keys())
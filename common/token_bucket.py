@@ -1,39 +1,146 @@
+import asyncio
 import threading
 import time
 
 
 class TokenBucket:
-    def __init__(self, tpm, timeout=None):
-        self.capacity = int(tpm)  # 令牌桶容量
-        self.tokens = 0  # 初始令牌数为0
+    """
+    令牌桶，每次取令牌时按距上次更新的时间补充令牌，不需要后台线程
+    创建时桶是满的，启动后的第一批请求不需要等待
+    """
+
+    def __init__(self, tpm, timeout=None, capacity=None):
         self.rate = int(tpm) / 60  # 令牌每秒生成速率
-        self.timeout = timeout  # 等待令牌超时时间
-        self.cond = threading.Condition()  # 条件变量
-        self.is_running = True
-        # 开启令牌生成线程
-        threading.Thread(target=self._generate_tokens).start()
-
-    def _generate_tokens(self):
-        """生成令牌"""
-        while self.is_running:
-            with self.cond:
-                if self.tokens < self.capacity:
-                    self.tokens += 1
-                self.cond.notify()  # 通知获取令牌的线程
-            time.sleep(1 / self.rate)
-
-    def get_token(self):
-        """获取令牌"""
-        with self.cond:
-            while self.tokens <= 0:
-                flag = self.cond.wait(self.timeout)
-                if not flag:  # 超时
+        self.capacity = capacity or int(tpm)  # 令牌桶容量
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.timeout = timeout  # get_token默认的等待超时时间，None表示一直等待
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def _wait_time(self, amount):
+        # 超过容量的请求在桶满时放行，否则永远取不到
+        return max(0.0, min(amount, self.capacity) - self.tokens) / self.rate
+
+    def try_acquire(self, amount=1):
+        """
+        不等待，令牌足够时立即取走
+        :return: (是否取到, 还需等待的秒数)
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            wait = self._wait_time(amount)
+            if wait <= 0:
+                self.tokens -= amount
+            return wait <= 0, wait
+
+    def consume(self, amount):
+        """
+        不检查余量直接扣除，余量可以为负，用于请求结束后按实际用量补扣(amount为负时退还)
+        """
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+    def get_token(self, amount=1, timeout=-1):
+        """
+        获取令牌，令牌不足时等待
+        :param timeout: 最长等待秒数，默认使用创建时的timeout，None表示一直等待
+        :return: 超时返回False
+        """
+        if timeout == -1:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            ok, wait = self.try_acquire(amount)
+            if ok:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining < wait:
                     return False
-            self.tokens -= 1
-        return True
+            time.sleep(wait)
+
+    async def async_get_token(self, amount=1, timeout=-1):
+        """
+        get_token的asyncio版本，等待时不占用线程
+        """
+        if timeout == -1:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            ok, wait = self.try_acquire(amount)
+            if ok:
+                return True
+            if deadline is not None and deadline - time.monotonic() < wait:
+                return False
+            await asyncio.sleep(wait)
 
     def close(self):
-        self.is_running = False
+        # 没有后台线程，保留该方法兼容旧的调用方
+        pass
+
+
+class RateLimiter:
+    """
+    同时限制每分钟请求数(rpm)和每分钟token数(tpm)，两者为0时不限制
+    请求前按预估的token数取令牌，请求结束后调用record按实际用量补扣
+    """
+
+    def __init__(self, rpm=0, tpm=0):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.lock = threading.Lock()
+
+    def try_acquire(self, tokens=0):
+        """
+        :return: (是否放行, 还需等待的秒数)，两个桶都有余量时才同时扣除
+        """
+        with self.lock:
+            now = time.monotonic()
+            buckets = [(bucket, amount) for bucket, amount in ((self.requests, 1), (self.tokens, tokens)) if bucket]
+            wait = 0.0
+            for bucket, amount in buckets:
+                with bucket.lock:
+                    bucket._refill(now)
+                    wait = max(wait, bucket._wait_time(amount))
+            if wait > 0:
+                return False, wait
+            for bucket, amount in buckets:
+                with bucket.lock:
+                    bucket.tokens -= amount
+            return True, 0.0
+
+    def acquire(self, tokens=0, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            ok, wait = self.try_acquire(tokens)
+            if ok:
+                return True
+            if deadline is not None and deadline - time.monotonic() < wait:
+                return False
+            time.sleep(wait)
+
+    async def async_acquire(self, tokens=0, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            ok, wait = self.try_acquire(tokens)
+            if ok:
+                return True
+            if deadline is not None and deadline - time.monotonic() < wait:
+                return False
+            await asyncio.sleep(wait)
+
+    def record(self, tokens):
+        """
+        按实际用量补扣token，tokens为实际用量与预估值的差
+        """
+        if self.tokens and tokens:
+            self.tokens.consume(tokens)
 
 
 if __name__ == "__main__":
@@ -42,4 +149,5 @@ if __name__ == "__main__":
     for i in range(3):
         if token_bucket.get_token():
             print(f"第{i+1}次请求成功")
+    print(token_bucket.try_acquire(20))  # 桶中只剩17个令牌，返回需要等待的秒数
     token_bucket.close()
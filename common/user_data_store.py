@@ -0,0 +1,125 @@
+import json
+import os
+import pickle
+import sqlite3
+from pathlib import Path
+from sqlite3 import Error
+
+from common.expired_dict import ExpiredDict
+from common.log import logger
+
+
+class UserData(dict):
+    """
+    单个用户的数据，修改后立即写回存储
+    """
+
+    def __init__(self, store, user, data=None):
+        super().__init__(data or {})
+        self.store = store
+        self.user = user
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.store.save(self.user, self)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.store.save(self.user, self)
+
+    def pop(self, key, *default):
+        exists = key in self
+        value = super().pop(key, *default)
+        if exists:
+            self.store.save(self.user, self)
+        return value
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self.store.save(self.user, self)
+
+    def clear(self):
+        super().clear()
+        self.store.save(self.user, self)
+
+
+class UserDataStore(object):
+    """
+    按用户存储的用户数据(私有api_key、模型等)，读取时按需加载并缓存，修改时只写该用户的一行
+    """
+
+    def __init__(self, db_path, cache_size=10000, cache_expires=3600):
+        self.db_path = Path(db_path)
+        self.cache = ExpiredDict(cache_expires, max_size=cache_size)  # user -> UserData，没有数据的用户也会缓存
+        self._init_db()
+
+    def _init_db(self):
+        """初始化数据库和表结构"""
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._get_connection() as conn:
+            try:
+                conn.execute("""PRAGMA journal_mode = WAL""")
+                conn.execute("""PRAGMA synchronous = NORMAL""")
+                conn.execute(
+                    """CREATE TABLE IF NOT EXISTS user_datas (
+                                user TEXT PRIMARY KEY,
+                                data TEXT NOT NULL
+                            )"""
+                )
+                conn.commit()
+            except Error as e:
+                logger.error(f"[UserDataStore] 初始化数据库失败: {str(e)}")
+
+    def _get_connection(self):
+        """获取数据库连接"""
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def get(self, user) -> UserData:
+        user_data = self.cache.get(user)
+        if user_data is None:
+            user_data = UserData(self, user, self._load(user))
+            self.cache[user] = user_data
+        return user_data
+
+    def _load(self, user):
+        with self._get_connection() as conn:
+            try:
+                row = conn.execute("""SELECT data FROM user_datas WHERE user = ?""", (user,)).fetchone()
+                return json.loads(row[0]) if row else None
+            except Error as e:
+                logger.error(f"[UserDataStore] 读取用户数据失败: {str(e)}")
+                return None
+
+    def save(self, user, data):
+        with self._get_connection() as conn:
+            try:
+                if data:
+                    conn.execute(
+                        """INSERT OR REPLACE INTO user_datas (user, data) VALUES (?, ?)""",
+                        (user, json.dumps(data, ensure_ascii=False)),
+                    )
+                else:
+                    conn.execute("""DELETE FROM user_datas WHERE user = ?""", (user,))
+                conn.commit()
+            except Error as e:
+                logger.error(f"[UserDataStore] 保存用户数据失败: {str(e)}")
+
+    def migrate_pickle(self, pkl_path):
+        """
+        将旧版本保存的user_datas.pkl一次性导入，导入后重命名为user_datas.pkl.migrated
+        """
+        if not os.path.exists(pkl_path):
+            return
+        try:
+            with open(pkl_path, "rb") as f:
+                user_datas = pickle.load(f)
+            with self._get_connection() as conn:
+                conn.executemany(
+                    """INSERT OR IGNORE INTO user_datas (user, data) VALUES (?, ?)""",
+                    [(user, json.dumps(data, ensure_ascii=False)) for user, data in user_datas.items() if data],
+                )
+                conn.commit()
+            os.replace(pkl_path, pkl_path + ".migrated")
+            logger.info("[UserDataStore] migrated {} user datas from {}".format(len(user_datas), pkl_path))
+        except Exception as e:
+            logger.error("[UserDataStore] migrate {} failed: {}".format(pkl_path, e))
@@ -1,4 +1,5 @@
 import io
+import json
 import os
 import re
 from urllib.parse import urlparse
@@ -76,3 +77,41 @@ def remove_markdown_symbol(text: str):
     if not text:
         return text
     return re.sub(r'\*\*(.*?)\*\*', r'\1', text)
+
+
+def iter_stream_content(res):
+    """
+    解析OpenAI兼容接口的SSE流式响应，逐段返回增量文本
+    :param res: stream=True发起请求得到的requests响应
+    """
+    for line in res.iter_lines():
+        if not line:
+            continue
+        decoded_line = line.decode("utf-8")
+        if not decoded_line.startswith("data:"):
+            continue
+        data = decoded_line[5:].strip()
+        if data == "[DONE]":
+            break
+        try:
+            json_data = json.loads(data)
+        except json.JSONDecodeError:
+            continue
+        choices = json_data.get("choices") or [{}]
+        delta_content = (choices[0].get("delta") or {}).get("content")
+        if delta_content:
+            yield delta_content
+
+
+def join_stream(chunks, on_complete):
+    """
+    透传流式回复的文本片段，结束后将完整内容交给on_complete，一般用于写入会话
+    """
+    content = ""
+    try:
+        for chunk in chunks:
+            content += chunk
+            yield chunk
+    finally:
+        if content:
+            on_complete(content)
@@ -7,6 +7,7 @@ import pickle
 import copy
 
 from common.log import logger
+from common.user_data_store import UserDataStore
 
 # 将所有可用的配置项写在字典里, 请使用小写字母
 # 此处的配置值无实际意义，程序不会读取此处的配置，仅用于提示格式，请将配置加入到config.json中
@@ -15,6 +16,8 @@ available_setting = {
     "open_ai_api_key": "",  # openai api key
     # openai apibase，当use_azure_chatgpt为true时，需要设置对应的api base
     "open_ai_api_base": "https://api.openai.com/v1",
+    "open_ai_api_pool": [],  # [可选] 多个openai key/endpoint轮流使用，每项如{"api_key": "", "api_base": "", "weight": 1, "rpm": 0, "tpm": 0}，azure可加"deployment_id"，为空时只使用open_ai_api_key
+    "open_ai_api_pool_cooldown": 60,  # key/endpoint返回401/429/5xx后暂停使用的秒数，连续失败时翻倍
     "proxy": "",  # openai使用的代理
     # chatgpt模型， 当use_azure_chatgpt为true时，其名称为Azure上model deployment名称
     "model": "gpt-3.5-turbo",  # 可选择: gpt-4o, pt-4o-mini, gpt-4-turbo, claude-3-sonnet, wenxin, moonshot, qwen-turbo, xunfei, glm-4, minimax, gemini等模型，全部可选模型详见common/const.py文件
@@ -49,6 +52,15 @@ available_setting = {
     "image_proxy": True,  # 是否需要图片代理，国内访问LinkAI时需要
     "image_create_prefix": ["画", "看", "找"],  # 开启图片回复的前缀
     "concurrency_in_session": 1,  # 同一会话最多有多少条消息在处理中，大于1可能乱序
+    "handler_pool_size": 8,  # 处理消息的线程池大小
+    "max_inflight_messages": 0,  # 所有会话同时处理中的消息数上限，0为不限制，可按上游LLM的限流设置
+    "session_queue_max_size": 0,  # 每个会话排队等待处理的消息数上限，0为不限制，#开头的管理命令不受限制
+    "session_queue_overflow_policy": "drop_oldest",  # 会话队列满时的策略，可选 drop_oldest(丢弃最早的消息), drop_newest(丢弃新消息), reply_busy(丢弃新消息并回复提示)
+    "session_busy_reply": "消息太多啦，请稍后再发",  # reply_busy策略下回复的提示
+    "stream_reply": False,  # 是否流式回复，web、飞书、钉钉AI卡片逐步展示，其他通道按句子分段发送
+    "stream_reply_min_length": 100,  # 不支持逐步展示的通道，缓存的回复超过该长度后在句子结尾处分段发送
+    "stream_update_interval": 1,  # 飞书消息和钉钉AI卡片刷新流式回复的最小间隔，单位秒
+    "async_mode": False,  # 是否使用asyncio事件循环处理消息，未实现async_reply的bot会在线程池中执行
     "image_create_size": "256x256",  # 图片大小,可选有 256x256, 512x512, 1024x1024 (dall-e-3默认为1024x1024)
     "group_chat_exit_group": False,
     # chatgpt会话参数
@@ -56,8 +68,11 @@ available_setting = {
     # 人格描述
     "character_desc": "你是ChatGPT, 一个由OpenAI训练的大型语言模型, 你旨在回答并解决人们的任何问题，并且可以使用多种语言与人交流。",
     "conversation_max_tokens": 1000,  # 支持上下文记忆的最多字符数
+    "session_store": "memory",  # 会话上下文的存储方式，可选 memory(仅内存), sqlite(重启后保留，支持多进程共享), file(重启后保留，单进程)
+    "session_store_path": "",  # sqlite数据库文件或file存储目录的路径，为空时使用数据目录下的conversations.db或conversations
     # chatgpt限流配置
     "rate_limit_chatgpt": 20,  # chatgpt的调用频率限制
+    "rate_limit_chatgpt_tpm": 0,  # chatgpt每分钟的token数限制，0表示不限制
     "rate_limit_dalle": 50,  # openai dalle的调用频率限制
     # chatgpt api参数 参考https://platform.openai.com/docs/api-reference/chat/create
     "temperature": 0.9,
@@ -65,6 +80,14 @@ available_setting = {
     "frequency_penalty": 0,
     "presence_penalty": 0,
     "request_timeout": 180,  # chatgpt请求超时时间，openai接口默认设置为600，对于难问题一般需要较长时间
+    "http_pool_size": 10,  # 共享HTTP客户端中每个host的最大连接数
+    "http_connect_timeout": 5,  # 共享HTTP客户端默认的连接超时时间(秒)
+    "http_read_timeout": 180,  # 共享HTTP客户端默认的读取超时时间(秒)
+    "retry_max_times": 2,  # bot请求失败后的最大重试次数
+    "retry_base_delay": 2,  # 重试的初始退避时间(秒)，之后每次翻倍并加入随机抖动
+    "retry_max_delay": 30,  # 单次退避的最长时间(秒)，接口要求的Retry-After超过该值时不再重试
+    "circuit_breaker_threshold": 5,  # 同一服务连续失败多少次后熔断，熔断期间直接返回错误，0表示不熔断
+    "circuit_breaker_recovery": 60,  # 熔断多少秒后放行一个探测请求
     "timeout": 120,  # chatgpt重试超时时间，在这个时间内，将会自动重试
     # Baidu 文心一言参数
     "baidu_wenxin_model": "eb-instant",  # 默认使用ERNIE-Bot-turbo模型
@@ -153,6 +176,7 @@ available_setting = {
     "dingtalk_robot_code": "",  # 钉钉机器人Robot code 
     "dingtalk_client_secret": "",  # 钉钉机器人Client Secret
     "dingtalk_card_enabled": False,
+    "dingtalk_card_template_id": "",  # 钉钉AI卡片模板id，开启dingtalk_card_enabled和stream_reply后用于流式回复
     
     # chatgpt指令自定义触发词
     "clear_memory_commands": ["#清除记忆"],  # 重置会话指令，必须以#开头
@@ -161,8 +185,14 @@ available_setting = {
     "subscribe_msg": "",  # 订阅消息, 支持: wechatmp, wechatmp_service, wechatcom_app
     "debug": False,  # 是否开启debug模式，开启后会打印更多日志
     "appdata_dir": "",  # 数据目录
+    "config_watch": False,  # 是否监听config/config.json和plugins/config.json的修改并自动重载，只重建受影响的bot和插件
+    "config_watch_interval": 3,  # 检查配置文件修改的间隔，单位秒
     # 插件配置
     "plugin_trigger_prefix": "$",  # 规范插件提供聊天相关指令的前缀，建议不要和管理员指令前缀"#"冲突
+    "plugin_soft_timeout": 5,  # 插件处理单个事件超过该时间(秒)时打印警告，0表示不检查
+    "plugin_hard_timeout": 0,  # 大于0时插件在独立线程池中执行，超过该时间(秒)后跳过该插件继续处理，0表示不限制
+    "plugin_pool_size": 0,  # 开启plugin_hard_timeout时执行插件的线程数，0表示与handler_pool_size相同
+    "plugin_lazy_load": False,  # 插件目录未变化时按数据目录下plugins_manifest.json中缓存的扫描结果启动，插件第一次收到事件时才导入，插件的导入错误和初始化也推迟到那时
     # 是否使用全局插件配置
     "use_global_plugin_config": False,
     "max_media_send_count": 3,  # 单次最大发送媒体资源的个数
@@ -200,52 +230,76 @@ available_setting = {
 }
 
 
+_MISSING = object()
+
+
 class Config(dict):
     def __init__(self, d=None):
         super().__init__()
+        self.version = 0  # 每次修改配置项加1，用于判断依赖配置编译的缓存是否过期
         if d is None:
             d = {}
         for k, v in d.items():
             self[k] = v
-        # user_datas: 用户数据，key为用户名，value为用户数据，也是dict
+        # user_datas: 用户数据，key为用户名，value为用户数据，也是dict；load_user_datas后改为从user_data_store中按需读取
         self.user_datas = {}
+        self.user_data_store = None
 
     def __getitem__(self, key):
-        if key not in available_setting:
-            raise Exception("key {} not in available_setting".format(key))
-        return super().__getitem__(key)
+        # 写入时已校验过key，读取只在未命中时检查key是否合法
+        try:
+            return super().__getitem__(key)
+        except KeyError:
+            if key not in available_setting:
+                raise Exception("key {} not in available_setting".format(key))
+            raise
 
     def __setitem__(self, key, value):
         if key not in available_setting:
             raise Exception("key {} not in available_setting".format(key))
+        self.version += 1
         return super().__setitem__(key, value)
 
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError as e:
+        value = super().get(key, _MISSING)
+        if value is _MISSING:
+            if key not in available_setting:
+                raise Exception("key {} not in available_setting".format(key))
             return default
-        except Exception as e:
-            raise e
+        return value
 
     # Make sure to return a dictionary to ensure atomic
     def get_user_data(self, user) -> dict:
+        if self.user_data_store is not None:
+            return self.user_data_store.get(user)
         if self.user_datas.get(user) is None:
             self.user_datas[user] = {}
         return self.user_datas[user]
 
     def load_user_datas(self):
+        """
+        打开用户数据存储，存在旧版本的user_datas.pkl时一次性迁移
+        在替换全局配置前调用，使用自身的appdata_dir而不是conf()
+        """
+        global _user_data_store
         try:
-            with open(os.path.join(get_appdata_dir(), "user_datas.pkl"), "rb") as f:
-                self.user_datas = pickle.load(f)
-                logger.info("[Config] User datas loaded.")
-        except FileNotFoundError as e:
-            logger.info("[Config] User datas file not found, ignore.")
+            data_path = os.path.join(get_root(), self.get("appdata_dir", ""))
+            db_path = os.path.join(data_path, "user_datas.db")
+            # 配置重载时数据目录未变化则沿用已打开的存储，持有旧配置的对象和新配置读到的是同一份缓存
+            if _user_data_store is None or str(_user_data_store.db_path) != db_path:
+                store = UserDataStore(db_path)
+                store.migrate_pickle(os.path.join(data_path, "user_datas.pkl"))
+                _user_data_store = store
+                logger.info("[Config] User datas store opened.")
+            self.user_data_store = _user_data_store
         except Exception as e:
             logger.info("[Config] User datas error: {}".format(e))
-            self.user_datas = {}
+            self.user_data_store = None
 
     def save_user_datas(self):
+        # 用户数据修改时已逐条写入存储，只有未打开存储时才需要整体保存
+        if self.user_data_store is not None:
+            return
         try:
             with open(os.path.join(get_appdata_dir(), "user_datas.pkl"), "wb") as f:
                 pickle.dump(self.user_datas, f)
@@ -255,6 +309,7 @@ class Config(dict):
 
 
 config = Config()
+_user_data_store = None  # 所有Config共用的用户数据存储，在load_user_datas中打开
 
 
 def drag_sensitive(config):
@@ -282,6 +337,9 @@ def drag_sensitive(config):
 
 
 def load_config():
+    """
+    在新的Config对象上完成读取、环境变量覆盖和用户数据加载后再整体替换，读取配置的线程不会看到加载了一半的配置
+    """
     global config
     config_path = "./config/config.json"
     if not os.path.exists(config_path):
@@ -292,7 +350,7 @@ def load_config():
     logger.debug("[INIT] config str: {}".format(drag_sensitive(config_str)))
 
     # 将json字符串反序列化为dict类型
-    config = Config(json.loads(config_str))
+    new_config = Config(json.loads(config_str))
 
     # override config with environment variables.
     # Some online deployment platforms (e.g. Railway) deploy project from github directly. So you shouldn't put your secrets like api key in a config file, instead use environment variables to override the default config.
@@ -301,22 +359,47 @@ def load_config():
         if name in available_setting:
             logger.info("[INIT] override config by environ args: {}={}".format(name, value))
             try:
-                config[name] = eval(value)
+                new_config[name] = eval(value)
             except:
                 if value == "false":
-                    config[name] = False
+                    new_config[name] = False
                 elif value == "true":
-                    config[name] = True
+                    new_config[name] = True
                 else:
-                    config[name] = value
+                    new_config[name] = value
 
-    if config.get("debug", False):
+    if new_config.get("debug", False):
         logger.setLevel(logging.DEBUG)
         logger.debug("[INIT] set log level to DEBUG")
 
-    logger.info("[INIT] load config: {}".format(drag_sensitive(config)))
+    logger.info("[INIT] load config: {}".format(drag_sensitive(new_config)))
+
+    new_config.load_user_datas()
+    old_config = config
+    config = new_config
+    changed_keys = {key for key in set(old_config) | set(new_config) if dict.get(old_config, key, _MISSING) != dict.get(new_config, key, _MISSING)}
+    if changed_keys:
+        notify_config_subscribers(changed_keys, old_config, new_config)
 
-    config.load_user_datas()
+
+# 配置重新加载后需要通知的回调
+config_subscribers = []
+
+
+def subscribe_config(callback):
+    """
+    订阅配置变化，load_config后以(changed_keys, old_config, new_config)调用callback
+    :param callback: 回调函数，changed_keys为值发生变化的配置项集合
+    """
+    config_subscribers.append(callback)
+
+
+def notify_config_subscribers(changed_keys, old_config, new_config):
+    for callback in list(config_subscribers):
+        try:
+            callback(changed_keys, old_config, new_config)
+        except Exception as e:
+            logger.exception("[INIT] config subscriber error: {}".format(e))
 
 
 def get_root():
@@ -2,14 +2,22 @@
 
 import json
 import os
+import re
+import threading
 
 import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.file_watcher import FileWatcher
 from common.log import logger
+from config import conf as global_conf
+from config import get_appdata_dir, global_config
 from plugins import *
 
-from .lib.WordsSearch import WordsSearch
+from .lib.IncrementalWordsSearch import IncrementalWordsSearch
+
+_watcher = None  # 所有Banwords实例共用的词库文件监视器，插件重载后回调换成新实例的
+SENTENCE_END_PATTERN = re.compile(r"[。！？!?\n]")  # 流式回复缓存到句子结尾再过滤
 
 
 @plugins.register(
@@ -35,16 +43,18 @@ class Banwords(Plugin):
                     with open(config_path, "w") as f:
                         json.dump(conf, f, indent=4)
 
-            self.searchr = WordsSearch()
+            # 敏感词没有变化时直接读取上次编译的自动机，运行中增删的词超过rebuild_threshold后在后台重新编译
+            self.searchr = IncrementalWordsSearch(os.path.join(get_appdata_dir(), "banwords.dat"), conf.get("rebuild_threshold", 1000))
             self.action = conf["action"]
-            banwords_path = os.path.join(curdir, "banwords.txt")
-            with open(banwords_path, "r", encoding="utf-8") as f:
-                words = []
-                for line in f:
-                    word = line.strip()
-                    if word:
-                        words.append(word)
-            self.searchr.SetKeywords(words)
+            self.banwords_path = os.path.join(curdir, "banwords.txt")
+            self.file_lock = threading.Lock()
+            self.searchr.SetKeywords(self._read_words())
+            if conf.get("hot_reload", True):
+                global _watcher
+                if _watcher is None:
+                    _watcher = FileWatcher(conf.get("hot_reload_interval", 3))
+                    _watcher.start()
+                _watcher.watch(self.banwords_path, self.reload_words)
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
             if conf.get("reply_filter", True):
                 self.handlers[Event.ON_DECORATE_REPLY] = self.on_decorate_reply
@@ -63,6 +73,10 @@ class Banwords(Plugin):
 
         content = e_context["context"].content
         logger.debug("[Banwords] on_handle_context. content: %s" % content)
+        if e_context["context"].type == ContextType.TEXT and content.startswith(f"{_get_trigger_prefix()}banwords"):
+            # 管理指令先于过滤处理，否则删除敏感词的指令本身会被过滤
+            self._process_admin_cmd(e_context)
+            return
         if self.action == "ignore":
             f = self.searchr.FindFirst(content)
             if f:
@@ -77,6 +91,9 @@ class Banwords(Plugin):
                 return
 
     def on_decorate_reply(self, e_context: EventContext):
+        if e_context["reply"].type == ReplyType.TEXT_STREAM:
+            e_context["reply"].content = self._filter_stream(e_context["reply"].content)
+            return
         if e_context["reply"].type not in [ReplyType.TEXT]:
             return
 
@@ -96,5 +113,120 @@ class Banwords(Plugin):
                 e_context.action = EventAction.CONTINUE
                 return
 
-    def get_help_text(self, **kwargs):
-        return "过滤消息中的敏感词。"
+    def _filter_stream(self, chunks):
+        """
+        流式回复缓存到句子结尾再检查，检查时带上已发送的内容，跨越句子的敏感词也能发现
+        已发送的内容无法撤回：ignore时在包含敏感词的句子处停止输出并提示，replace时替换未发送部分的敏感词并在结尾提示
+        """
+        sent = ""  # 已发送部分的原文
+        buffer = ""
+        replaced = False
+        for chunk in chunks:
+            buffer += chunk
+            end = 0
+            for match in SENTENCE_END_PATTERN.finditer(buffer):
+                end = match.end()
+            if not end:
+                continue
+            segment, buffer = buffer[:end], buffer[end:]
+            filtered = self._filter_segment(sent, segment)
+            if filtered is None:
+                yield "\n\n[INFO]\n回复中包含敏感词，已停止输出"
+                return
+            sent += segment
+            replaced = replaced or filtered != segment
+            yield filtered
+        if buffer:
+            filtered = self._filter_segment(sent, buffer)
+            if filtered is None:
+                yield "\n\n[INFO]\n回复中包含敏感词，已停止输出"
+                return
+            replaced = replaced or filtered != buffer
+            yield filtered
+        if replaced:
+            yield "\n\n[INFO]\n已替换回复中的敏感词"
+
+    def _filter_segment(self, sent, segment):
+        """
+        :param sent: 已发送部分的原文
+        :return: 过滤后的句子，ignore时包含敏感词返回None
+        """
+        text = sent + segment
+        if self.reply_action == "ignore":
+            f = self.searchr.FindFirst(text)
+            if f:
+                logger.info("[Banwords] %s in reply, stop streaming" % f["Keyword"])
+                return None
+        elif self.reply_action == "replace" and self.searchr.ContainsAny(text):
+            return self.searchr.Replace(text)[len(sent):]
+        return segment
+
+    def _read_words(self):
+        with open(self.banwords_path, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()]
+
+    def _save_words(self):
+        with self.file_lock:
+            tmp_path = self.banwords_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write("\n".join(self.searchr.GetKeywords()) + "\n")
+            os.replace(tmp_path, self.banwords_path)
+
+    def reload_words(self):
+        """
+        banwords.txt变化后只把增删的词应用到当前词库，不重新编译全部敏感词
+        """
+        with self.file_lock:
+            words = self._read_words()
+        current = set(self.searchr.GetKeywords())
+        added = self.searchr.AddKeywords([word for word in words if word not in current])
+        removed = self.searchr.RemoveKeywords(current - set(words))
+        logger.info("[Banwords] reloaded banwords.txt, {} added, {} removed".format(len(added), len(removed)))
+        return added, removed
+
+    def _process_admin_cmd(self, e_context: EventContext):
+        cmd = e_context["context"].content.split()
+        e_context.action = EventAction.BREAK_PASS
+        if not _is_admin(e_context):
+            e_context["reply"] = Reply(ReplyType.ERROR, "需要管理员权限执行")
+            return
+        if len(cmd) >= 3 and cmd[1] == "add":
+            words = self.searchr.AddKeywords(cmd[2:])
+            self._save_words()
+            e_context["reply"] = Reply(ReplyType.INFO, "已添加{}个敏感词".format(len(words)))
+        elif len(cmd) >= 3 and cmd[1] == "del":
+            words = self.searchr.RemoveKeywords(cmd[2:])
+            self._save_words()
+            e_context["reply"] = Reply(ReplyType.INFO, "已删除{}个敏感词".format(len(words)))
+        elif len(cmd) == 2 and cmd[1] == "reload":
+            added, removed = self.reload_words()
+            e_context["reply"] = Reply(ReplyType.INFO, "已重新读取词库，新增{}个，删除{}个".format(len(added), len(removed)))
+        elif len(cmd) == 2 and cmd[1] == "rebuild":
+            self.searchr.Rebuild()
+            e_context["reply"] = Reply(ReplyType.INFO, "已在后台重新编译词库")
+        else:
+            e_context["reply"] = Reply(ReplyType.ERROR, self.get_help_text(verbose=True))
+
+    def get_help_text(self, verbose=False, **kwargs):
+        help_text = "过滤消息中的敏感词。"
+        if not verbose:
+            return help_text
+        trigger_prefix = _get_trigger_prefix()
+        help_text += "\n\n管理员指令：\n"
+        help_text += f"{trigger_prefix}banwords add 词1 词2: 添加敏感词\n"
+        help_text += f"{trigger_prefix}banwords del 词1 词2: 删除敏感词\n"
+        help_text += f"{trigger_prefix}banwords reload: 重新读取banwords.txt\n"
+        help_text += f"{trigger_prefix}banwords rebuild: 在后台重新编译词库"
+        return help_text
+
+
+def _get_trigger_prefix():
+    return global_conf().get("plugin_trigger_prefix", "$")
+
+
+def _is_admin(e_context: EventContext) -> bool:
+    context = e_context["context"]
+    if context["isgroup"]:
+        actual_user_id = context.kwargs.get("msg").actual_user_id
+        return bool(actual_user_id) and actual_user_id in global_config["admin_users"]
+    return context["receiver"] in global_config["admin_users"]
@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# 与WordsSearch接口相同的Aho–Corasick自动机，状态转移用双数组(base/check)存储，
+# 所有状态信息都是array中的整数，不再为每个节点创建对象，编译结果可以缓存到磁盘
+
+import hashlib
+import json
+import os
+import re
+import struct
+import sys
+from array import array
+from collections import deque
+
+__all__ = ["ArrayWordsSearch"]
+
+CACHE_MAGIC = b"BWAC"
+CACHE_VERSION = 1
+
+
+class ArrayWordsSearch(object):
+    """
+    base[s] + code(字符) = t 且 check[t] == s 时，状态s经过该字符转移到t，否则沿fail[s]回退
+    word[s]为以状态s结尾的关键词下标(-1表示没有)，dict_link[s]为s的后缀中最近的以关键词结尾的状态
+    """
+
+    ARRAY_NAMES = ("base", "check", "fail", "word", "dict_link")
+
+    def __init__(self):
+        self._keywords = []
+        self.alphabet = {}  # 字符 -> 从1开始的编号，按出现次数从多到少编号，使常用字符的转移更紧凑
+        for name in self.ARRAY_NAMES:
+            setattr(self, name, array("i", [0]))
+        self.check[0] = -1
+        self.word[0] = -1
+        self.first_chars = re.compile("(?!)")  # 匹配任一关键词首字符的正则，状态回到根节点时用它跳过无关文本
+
+    def SetKeywords(self, keywords, cache_path=None):
+        """
+        编译关键词列表，指定cache_path时关键词未变化则直接读取缓存，否则编译后写入缓存
+        """
+        self._keywords = list(keywords)
+        digest = self._digest(self._keywords)
+        if cache_path and self._load_cache(cache_path, digest):
+            return
+        self._build()
+        if cache_path:
+            self._save_cache(cache_path, digest)
+
+    @staticmethod
+    def _digest(keywords):
+        return hashlib.sha1("\n".join(keywords).encode("utf-8", "surrogatepass")).digest()
+
+    def _build(self):
+        counts = {}
+        for keyword in self._keywords:
+            for ch in keyword:
+                counts[ch] = counts.get(ch, 0) + 1
+        self.alphabet = {ch: i + 1 for i, ch in enumerate(sorted(counts, key=lambda ch: (-counts[ch], ch)))}
+
+        # 先用dict构建trie，节点编号按插入顺序
+        goto = [{}]
+        word = [-1]
+        for index, keyword in enumerate(self._keywords):
+            if not keyword:
+                continue
+            node = 0
+            for ch in keyword:
+                code = self.alphabet[ch]
+                next_node = goto[node].get(code)
+                if next_node is None:
+                    next_node = len(goto)
+                    goto[node][code] = next_node
+                    goto.append({})
+                    word.append(-1)
+                node = next_node
+            if word[node] < 0:
+                word[node] = index
+
+        # 广度优先计算fail和dict_link
+        node_count = len(goto)
+        fail = [0] * node_count
+        dict_link = [0] * node_count
+        order = []
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for code, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and code not in goto[state]:
+                    state = fail[state]
+                target = goto[state].get(code, 0)
+                fail[child] = target
+                dict_link[child] = target if word[target] >= 0 else dict_link[target]
+
+        # 按广度优先顺序把trie节点放入双数组，position[node]为节点在双数组中的下标
+        position = [0] * node_count
+        base = [0]
+        check = [-1]
+        used = bytearray(1)
+        used[0] = 1
+        next_free = 1
+        multi_free = 1
+        for node in [0] + order:
+            codes = sorted(goto[node])
+            if not codes:
+                continue
+            next_free = used.find(0, next_free)
+            if next_free < 0:
+                next_free = len(used)
+            # 从第一个空位开始，找第一个子节点能放入的空位，再检查其余子节点是否冲突
+            # 前面的空位大多是单个子节点留下的零散空洞，多个子节点的节点从上一个多子节点的位置开始找，避免反复检查这些空洞
+            free = max(next_free, codes[0] + 1)
+            if len(codes) > 1:
+                free = max(free, multi_free)
+            while True:
+                free = used.find(0, free)
+                if free < 0:
+                    free = len(used)
+                b = free - codes[0]
+                top = b + codes[-1]
+                if top >= len(used):
+                    grow = top + 1 - len(used)
+                    used.extend(bytes(grow))
+                    base.extend([0] * grow)
+                    check.extend([-1] * grow)
+                if not any(used[b + code] for code in codes):
+                    break
+                free += 1
+            if len(codes) > 1:
+                multi_free = free
+            base[position[node]] = b
+            for code in codes:
+                t = b + code
+                used[t] = 1
+                check[t] = position[node]
+                position[goto[node][code]] = t
+
+        # 数组末尾留出字母表大小的空间，扫描时base[s] + code不会越界
+        size = len(base) + len(self.alphabet) + 1
+        base.extend([0] * (size - len(base)))
+        check.extend([-1] * (size - len(check)))
+        da_fail = [0] * size
+        da_word = [-1] * size
+        da_dict_link = [0] * size
+        for node in range(node_count):
+            p = position[node]
+            da_fail[p] = position[fail[node]]
+            da_word[p] = word[node]
+            da_dict_link[p] = position[dict_link[node]]
+        self.base = array("i", base)
+        self.check = array("i", check)
+        self.fail = array("i", da_fail)
+        self.word = array("i", da_word)
+        self.dict_link = array("i", da_dict_link)
+        self._compile_first_chars()
+
+    def _compile_first_chars(self):
+        root_base = self.base[0]
+        chars = [ch for ch, code in self.alphabet.items() if self.check[root_base + code] == 0]
+        self.first_chars = re.compile("[{}]".format("".join(re.escape(ch) for ch in chars))) if chars else re.compile("(?!)")
+
+    def _save_cache(self, cache_path, digest):
+        header = json.dumps({"alphabet": "".join(sorted(self.alphabet, key=self.alphabet.get)), "size": len(self.base)}, ensure_ascii=False)
+        header = header.encode("utf-8", "surrogatepass")
+        tmp_path = cache_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(CACHE_MAGIC)
+                f.write(struct.pack("<IB20sI", CACHE_VERSION, sys.byteorder == "little", digest, len(header)))
+                f.write(header)
+                for name in self.ARRAY_NAMES:
+                    getattr(self, name).tofile(f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+
+    def _load_cache(self, cache_path, digest):
+        try:
+            with open(cache_path, "rb") as f:
+                if f.read(4) != CACHE_MAGIC:
+                    return False
+                version, little, cached_digest, header_len = struct.unpack("<IB20sI", f.read(29))
+                if version != CACHE_VERSION or bool(little) != (sys.byteorder == "little") or cached_digest != digest:
+                    return False
+                header = json.loads(f.read(header_len).decode("utf-8", "surrogatepass"))
+                arrays = []
+                for name in self.ARRAY_NAMES:
+                    a = array("i")
+                    a.fromfile(f, header["size"])
+                    arrays.append(a)
+        except (OSError, ValueError, EOFError, struct.error, KeyError):
+            return False
+        self.alphabet = {ch: i + 1 for i, ch in enumerate(header["alphabet"])}
+        for name, a in zip(self.ARRAY_NAMES, arrays):
+            setattr(self, name, a)
+        self._compile_first_chars()
+        return True
+
+    def _scan(self, text):
+        """
+        逐字符推进自动机，在有关键词结束的位置产出(位置, 状态)
+        处于根节点时用正则直接跳到下一个可能是关键词开头的字符
+        """
+        alphabet_get = self.alphabet.get
+        search = self.first_chars.search
+        base, check, fail, word, dict_link = self.base, self.check, self.fail, self.word, self.dict_link
+        length = len(text)
+        pos = 0
+        while True:
+            match = search(text, pos)
+            if match is None:
+                return
+            state = 0
+            for index in range(match.start(), length):
+                code = alphabet_get(text[index])
+                if code is None:
+                    state = 0
+                    break
+                while True:
+                    t = base[state] + code
+                    if check[t] == state:
+                        state = t
+                        break
+                    if not state:
+                        break
+                    state = fail[state]
+                if not state:
+                    break
+                if word[state] >= 0 or dict_link[state]:
+                    yield index, state
+            else:
+                return
+            pos = index + 1
+
+    def _longest(self, state):
+        """
+        以状态state结尾的最长关键词下标
+        """
+        index = self.word[state]
+        return index if index >= 0 else self.word[self.dict_link[state]]
+
+    def _result(self, item, index):
+        keyword = self._keywords[item]
+        return {"Keyword": keyword, "Success": True, "End": index, "Start": index + 1 - len(keyword), "Index": item}
+
+    def FindFirst(self, text):
+        for index, state in self._scan(text):
+            return self._result(self._longest(state), index)
+        return None
+
+    def _matches(self, text):
+        """
+        产出所有匹配的(结束位置, 关键词下标)，同一位置的关键词从长到短
+        """
+        word, dict_link = self.word, self.dict_link
+        for index, state in self._scan(text):
+            if word[state] < 0:
+                state = dict_link[state]
+            while state:
+                yield index, word[state]
+                state = dict_link[state]
+
+    def FindAll(self, text):
+        return [self._result(item, index) for index, item in self._matches(text)]
+
+    def ContainsAny(self, text):
+        for _ in self._scan(text):
+            return True
+        return False
+
+    def Replace(self, text, replaceChar="*"):
+        """
+        在每个匹配位置替换以之结尾的最长关键词，先合并所有区间再一次拼接
+        """
+        keywords = self._keywords
+        spans = []
+        for index, state in self._scan(text):
+            start = index + 1 - len(keywords[self._longest(state)])
+            while spans and start <= spans[-1][1]:
+                start = min(start, spans.pop()[0])
+            spans.append((start, index + 1))
+        if not spans:
+            return text
+        parts = []
+        last = 0
+        for start, end in spans:
+            parts.append(text[last:start])
+            parts.append(replaceChar * (end - start))
+            last = end
+        parts.append(text[last:])
+        return "".join(parts)
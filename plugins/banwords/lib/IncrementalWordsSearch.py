@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# 支持运行时增删关键词的ArrayWordsSearch，增删关键词时不需要重新编译全部关键词
+
+import threading
+from collections import namedtuple
+
+from common.log import logger
+
+from .ArrayWordsSearch import ArrayWordsSearch
+
+__all__ = ["IncrementalWordsSearch"]
+
+# base: 主自动机，base_words: 编译base时的关键词，delta: 之后新增的关键词编译成的小自动机，removed: 之后删除的关键词
+Snapshot = namedtuple("Snapshot", ["base", "base_words", "delta", "removed"])
+
+
+class IncrementalWordsSearch(object):
+    """
+    主自动机编译后不再修改，新增的关键词编译成一个小的增量自动机，删除的关键词在匹配结果中过滤
+    增量超过rebuild_threshold时在后台线程重新编译主自动机，编译完成后替换整个快照，查询时不需要加锁
+    """
+
+    def __init__(self, cache_path=None, rebuild_threshold=1000):
+        self.cache_path = cache_path
+        self.rebuild_threshold = rebuild_threshold
+        self.words = {}  # 当前全部关键词，dict保持插入顺序
+        self.version = 0  # SetKeywords时增加，丢弃基于旧关键词列表的后台编译结果
+        self.rebuilding = False
+        self.lock = threading.Lock()
+        self.snapshot = Snapshot(ArrayWordsSearch(), frozenset(), None, frozenset())
+
+    def SetKeywords(self, keywords):
+        """
+        替换全部关键词并同步编译
+        """
+        with self.lock:
+            self.words = dict.fromkeys(word for word in keywords if word)
+            self.version += 1
+            words, version = list(self.words), self.version
+        base = ArrayWordsSearch()
+        base.SetKeywords(words, self.cache_path)
+        with self.lock:
+            if version == self.version:
+                self._publish(base, frozenset(words))
+
+    def GetKeywords(self):
+        with self.lock:
+            return list(self.words)
+
+    def AddKeywords(self, keywords):
+        """
+        新增关键词，返回实际新增的关键词
+        """
+        with self.lock:
+            added = [word for word in dict.fromkeys(keywords) if word and word not in self.words]
+            if added:
+                self.words.update(dict.fromkeys(added))
+                self._publish(self.snapshot.base, self.snapshot.base_words)
+        return added
+
+    def RemoveKeywords(self, keywords):
+        """
+        删除关键词，返回实际删除的关键词
+        """
+        with self.lock:
+            removed = [word for word in dict.fromkeys(keywords) if word in self.words]
+            if removed:
+                for word in removed:
+                    del self.words[word]
+                self._publish(self.snapshot.base, self.snapshot.base_words)
+        return removed
+
+    def Rebuild(self):
+        """
+        在后台线程中按当前全部关键词重新编译主自动机
+        """
+        with self.lock:
+            self._start_rebuild()
+
+    def _publish(self, base, base_words):
+        """
+        按当前关键词和主自动机计算增量并替换快照，调用时需持有锁
+        """
+        added = [word for word in self.words if word not in base_words]
+        removed = frozenset(word for word in base_words if word not in self.words)
+        delta = None
+        if added:
+            delta = ArrayWordsSearch()
+            delta.SetKeywords(added)
+        self.snapshot = Snapshot(base, base_words, delta, removed)
+        if len(added) + len(removed) > self.rebuild_threshold:
+            self._start_rebuild()
+
+    def _start_rebuild(self):
+        if self.rebuilding:
+            return
+        self.rebuilding = True
+        thread = threading.Thread(target=self._rebuild, args=(list(self.words), self.version), name="banwords-rebuild", daemon=True)
+        thread.start()
+
+    def _rebuild(self, words, version):
+        try:
+            base = ArrayWordsSearch()
+            base.SetKeywords(words, self.cache_path)
+        except Exception as e:
+            logger.error("[IncrementalWordsSearch] rebuild failed: {}".format(e))
+            with self.lock:
+                self.rebuilding = False
+            return
+        with self.lock:
+            self.rebuilding = False
+            if version == self.version:
+                # 编译期间的增删会作为新的增量保留下来
+                self._publish(base, frozenset(words))
+        logger.info("[IncrementalWordsSearch] rebuilt with {} words".format(len(words)))
+
+    def _matches(self, snapshot, text):
+        """
+        返回所有匹配的(结束位置, 关键词, 下标)，按结束位置排序，同一位置的关键词从长到短
+        增量自动机中的关键词下标排在主自动机的关键词之后
+        """
+        base, _, delta, removed = snapshot
+        keywords = base._keywords
+        matches = [(index, keywords[item], item) for index, item in base._matches(text) if keywords[item] not in removed]
+        if delta is not None:
+            offset = len(keywords)
+            matches.extend((index, delta._keywords[item], offset + item) for index, item in delta._matches(text))
+            matches.sort(key=lambda match: (match[0], -len(match[1])))
+        return matches
+
+    @staticmethod
+    def _result(index, keyword, item):
+        return {"Keyword": keyword, "Success": True, "End": index, "Start": index + 1 - len(keyword), "Index": item}
+
+    def FindFirst(self, text):
+        snapshot = self.snapshot
+        if snapshot.delta is None and not snapshot.removed:
+            return snapshot.base.FindFirst(text)
+        matches = self._matches(snapshot, text)
+        return self._result(*matches[0]) if matches else None
+
+    def FindAll(self, text):
+        snapshot = self.snapshot
+        if snapshot.delta is None and not snapshot.removed:
+            return snapshot.base.FindAll(text)
+        return [self._result(*match) for match in self._matches(snapshot, text)]
+
+    def ContainsAny(self, text):
+        snapshot = self.snapshot
+        if snapshot.delta is None and not snapshot.removed:
+            return snapshot.base.ContainsAny(text)
+        if snapshot.delta is not None and snapshot.delta.ContainsAny(text):
+            return True
+        keywords = snapshot.base._keywords
+        return any(keywords[item] not in snapshot.removed for _, item in snapshot.base._matches(text))
+
+    def Replace(self, text, replaceChar="*"):
+        snapshot = self.snapshot
+        if snapshot.delta is None and not snapshot.removed:
+            return snapshot.base.Replace(text, replaceChar)
+        # 以同一位置结尾的关键词中最长的会覆盖其余的，替换所有匹配区间的并集即可
+        result = list(text)
+        for index, keyword, _ in self._matches(snapshot, text):
+            result[index + 1 - len(keyword):index + 1] = [replaceChar] * len(keyword)
+        return "".join(result)
@@ -127,6 +127,14 @@ ADMIN_COMMANDS = {
         "args": ["插件名"],
         "desc": "更新指定插件",
     },
+    "status": {
+        "alias": ["status", "运行状态"],
+        "desc": "查看消息队列的运行状态",
+    },
+    "pstats": {
+        "alias": ["pstats", "插件统计"],
+        "desc": "查看插件的耗时、异常和超时统计",
+    },
     "debug": {
         "alias": ["debug", "调试模式", "DEBUG"],
         "desc": "开启机器调试日志",
@@ -177,6 +185,7 @@ def get_help_text(isadmin, isgroup):
     desc="为你的机器人添加指令集，有用户和管理员两种角色，加载顺序请放在首位，初次运行后插件目录会生成配置文件, 填充管理员密码后即可认证",
     version="1.0",
     author="lanvent",
+    lazy=False,
 )
 class Godcmd(Plugin):
     def __init__(self):
@@ -335,8 +344,7 @@ class Godcmd(Plugin):
                             self.isrunning = True
                             ok, result = True, "服务已恢复"
                         elif cmd == "reconf":
-                            load_config()
-                            Bridge().reset_bot()
+                            load_config()  # Bridge订阅了配置变化，只重建受影响的bot
                             ok, result = True, "配置已重载"
                         elif cmd == "resetall":
                             if bottype in [const.OPEN_AI, const.CHATGPT, const.CHATGPTONAZURE, const.LINKAI,
@@ -354,6 +362,23 @@ class Godcmd(Plugin):
                             else:
                                 logger.setLevel(logging.DEBUG)
                                 ok, result = True, "DEBUG模式已开启"
+                        elif cmd == "status":
+                            stats = channel.get_queue_stats()
+                            ok = True
+                            result = "消息队列状态：\n"
+                            result += f"会话数: {stats['sessions']}, 排队消息数: {stats['queued']}, 最长会话队列: {stats['max_queue_depth']}\n"
+                            result += f"处理中: {stats['inflight']}, 待分发会话: {stats['ready']}\n"
+                            result += f"丢弃最早: {stats['drop_oldest']}, 丢弃最新: {stats['drop_newest']}, 繁忙回复: {stats['reply_busy']}"
+                        elif cmd == "pstats":
+                            ok = True
+                            summary = PluginManager().stats.summary()
+                            if not summary:
+                                result = "暂无插件统计"
+                            else:
+                                result = "插件统计(按总耗时排序)：\n"
+                                for name, event, stat in summary:
+                                    result += f"{name} {event.name}: 调用{stat.calls}次, 平均{stat.total_time / stat.calls * 1000:.1f}ms, "
+                                    result += f"P95≤{stat.percentile(95) * 1000:.0f}ms, 最大{stat.max_time * 1000:.0f}ms, 异常{stat.errors}, 超时{stat.timeouts}\n"
                         elif cmd == "plist":
                             plugins = PluginManager().list_plugins()
                             ok = True
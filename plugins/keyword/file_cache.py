@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import unquote, urlparse
+
+from common import http_client
+
+from common.log import logger
+
+
+class RemoteFileCache(object):
+    """
+    按URL缓存远程文件，ttl秒内直接使用缓存，过期后带ETag/Last-Modified重新验证，文件未修改时不再下载
+    同一URL同时只有一个线程在下载
+    """
+
+    def __init__(self, cache_dir, ttl=3600):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.locks = {}  # url -> Lock
+        self.locks_lock = threading.Lock()
+
+    def _lock(self, url):
+        with self.locks_lock:
+            lock = self.locks.get(url)
+            if lock is None:
+                lock = self.locks[url] = threading.Lock()
+            return lock
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+        file_name = unquote(os.path.basename(urlparse(url).path)) or key
+        # 每个URL一个目录，保留原文件名，发送文件时对方看到的仍是原文件名
+        return os.path.join(self.cache_dir, key, file_name), os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, url):
+        """
+        :return: 本地文件路径，下载失败且没有缓存时返回None
+        """
+        file_path, meta_path = self._paths(url)
+        with self._lock(url):
+            meta = {}
+            if os.path.exists(file_path) and os.path.exists(meta_path):
+                try:
+                    with open(meta_path, "r", encoding="utf-8") as f:
+                        meta = json.load(f)
+                except Exception:
+                    meta = {}
+            if meta and time.time() - meta.get("checked_at", 0) < self.ttl:
+                return file_path
+            headers = {}
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+            try:
+                # stream=True时需要关闭响应，连接才会回到共享的连接池
+                with http_client.get(url, headers=headers, timeout=(5, 60), stream=True) as response:
+                    if response.status_code == 304 and meta:
+                        logger.debug("[keyword] {} not modified, use cache".format(url))
+                    else:
+                        response.raise_for_status()
+                        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                        tmp_path = file_path + ".tmp"
+                        with open(tmp_path, "wb") as f:
+                            for chunk in response.iter_content(chunk_size=65536):
+                                f.write(chunk)
+                        os.replace(tmp_path, file_path)
+                        meta = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+                        logger.info("[keyword] downloaded {} to {}".format(url, file_path))
+                meta["checked_at"] = time.time()
+                with open(meta_path, "w", encoding="utf-8") as f:
+                    json.dump(meta, f)
+                return file_path
+            except Exception as e:
+                logger.warn("[keyword] download {} failed: {}".format(url, e))
+                return file_path if os.path.exists(file_path) else None
@@ -1,14 +1,20 @@
 # encoding:utf-8
 
+import io
 import json
 import os
-import requests
 import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
+from common.file_watcher import FileWatcher
 from common.log import logger
 from plugins import *
 
+from .file_cache import RemoteFileCache
+from .rules import KeywordRules
+
+_watcher = None  # 所有Keyword实例共用的配置文件监视器，插件重载后回调换成新实例的
+
 
 @plugins.register(
     name="Keyword",
@@ -17,27 +23,36 @@ from plugins import *
     desc="关键词匹配过滤",
     version="0.1",
     author="fengyege.top",
+    context_types=[ContextType.TEXT],
 )
 class Keyword(Plugin):
     def __init__(self):
         super().__init__()
         try:
             curdir = os.path.dirname(__file__)
-            config_path = os.path.join(curdir, "config.json")
+            self.config_path = os.path.join(curdir, "config.json")
             conf = None
-            if not os.path.exists(config_path):
-                logger.debug(f"[keyword]不存在配置文件{config_path}")
+            if not os.path.exists(self.config_path):
+                logger.debug(f"[keyword]不存在配置文件{self.config_path}")
                 conf = {"keyword": {}}
-                with open(config_path, "w", encoding="utf-8") as f:
+                with open(self.config_path, "w", encoding="utf-8") as f:
                     json.dump(conf, f, indent=4)
             else:
-                logger.debug(f"[keyword]加载配置文件{config_path}")
-                with open(config_path, "r", encoding="utf-8") as f:
+                logger.debug(f"[keyword]加载配置文件{self.config_path}")
+                with open(self.config_path, "r", encoding="utf-8") as f:
                     conf = json.load(f)
             # 加载关键词
-            self.keyword = conf["keyword"]
+            self.rules = KeywordRules(conf)
+            # 下载过的文件和图片按URL缓存，过期后用ETag确认是否有更新
+            self.file_cache = RemoteFileCache(os.path.join("tmp", "keyword"), conf.get("file_cache_ttl", 3600))
+            if conf.get("hot_reload", True):
+                global _watcher
+                if _watcher is None:
+                    _watcher = FileWatcher(conf.get("hot_reload_interval", 3))
+                    _watcher.start()
+                _watcher.watch(self.config_path, self.reload_rules)
 
-            logger.info("[keyword] {}".format(self.keyword))
+            logger.info("[keyword] {} rules loaded".format(len(self.rules)))
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
             logger.info("[keyword] inited.")
         except Exception as e:
@@ -50,9 +65,10 @@ class Keyword(Plugin):
 
         content = e_context["context"].content.strip()
         logger.debug("[keyword] on_handle_context. content: %s" % content)
-        if content in self.keyword:
-            logger.info(f"[keyword] 匹配到关键字【{content}】")
-            reply_text = self.keyword[content]
+        matched = self.rules.match(content)
+        if matched is not None:
+            keyword, reply_text = matched
+            logger.info(f"[keyword] 匹配到关键字【{keyword}】")
 
             # 判断匹配内容的类型
             if (reply_text.startswith("http://") or reply_text.startswith("https://")) and any(reply_text.endswith(ext) for ext in [".jpg", ".webp", ".jpeg", ".png", ".gif", ".img"]):
@@ -60,21 +76,26 @@ class Keyword(Plugin):
                 reply = Reply()
                 reply.type = ReplyType.IMAGE_URL
                 reply.content = reply_text
-                
+                channel = e_context["channel"]
+                if channel is not None and ReplyType.IMAGE not in channel.NOT_SUPPORT_REPLYTYPE:
+                    # 渠道支持直接发送图片时使用缓存的图片，不再每次由渠道重新下载
+                    file_path = self.file_cache.get(reply_text)
+                    if file_path:
+                        with open(file_path, "rb") as f:
+                            reply.type = ReplyType.IMAGE
+                            reply.content = io.BytesIO(f.read())
+
             elif (reply_text.startswith("http://") or reply_text.startswith("https://")) and any(reply_text.endswith(ext) for ext in [".pdf", ".doc", ".docx", ".xls", "xlsx",".zip", ".rar"]):
             # 如果是以 http:// 或 https:// 开头，且".pdf", ".doc", ".docx", ".xls", "xlsx",".zip", ".rar"结尾，则下载文件到tmp目录并发送给用户
-                file_path = "tmp"
-                if not os.path.exists(file_path):
-                    os.makedirs(file_path)
-                file_name = reply_text.split("/")[-1]  # 获取文件名
-                file_path = os.path.join(file_path, file_name)
-                response = requests.get(reply_text)
-                with open(file_path, "wb") as f:
-                    f.write(response.content)
+                file_path = self.file_cache.get(reply_text)
                 #channel/wechat/wechat_channel.py和channel/wechat_channel.py中缺少ReplyType.FILE类型。
                 reply = Reply()
-                reply.type = ReplyType.FILE
-                reply.content = file_path
+                if file_path:
+                    reply.type = ReplyType.FILE
+                    reply.content = file_path
+                else:
+                    reply.type = ReplyType.ERROR
+                    reply.content = "文件下载失败，请稍后再试"
             
             elif (reply_text.startswith("http://") or reply_text.startswith("https://")) and any(reply_text.endswith(ext) for ext in [".mp4"]):
             # 如果是以 http:// 或 https:// 开头，且".mp4"结尾，则下载视频到tmp目录并发送给用户
@@ -91,6 +112,15 @@ class Keyword(Plugin):
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS  # 事件结束，并跳过处理context的默认逻辑
             
+    def reload_rules(self):
+        """
+        配置文件变化后重新编译规则并整体替换，配置有误时抛出异常，保留原规则
+        """
+        with open(self.config_path, "r", encoding="utf-8") as f:
+            conf = json.load(f)
+        self.rules = KeywordRules(conf)
+        logger.info("[keyword] reloaded, {} rules".format(len(self.rules)))
+
     def get_help_text(self, **kwargs):
         help_text = "关键词过滤"
         return help_text
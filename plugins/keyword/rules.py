@@ -0,0 +1,45 @@
+import re
+
+from channel.trigger_matcher import KeywordMatcher, PrefixMatcher
+from common.log import logger
+
+
+class KeywordRules(object):
+    """
+    由配置编译成的关键词规则，依次按 完全匹配(keyword) > 前缀(prefix) > 包含(contains) > 正则(regex) 查找回复
+    前缀规则取配置中最靠前的，包含规则取消息中最先出现的，正则规则按配置顺序取第一个匹配的
+    """
+
+    def __init__(self, conf):
+        self.exact = {k: v for k, v in (conf.get("keyword") or {}).items() if k}
+        self.prefix = {k: v for k, v in (conf.get("prefix") or {}).items() if k}
+        self.prefix_matcher = PrefixMatcher(list(self.prefix))
+        self.contains = {k: v for k, v in (conf.get("contains") or {}).items() if k}
+        self.contains_matcher = KeywordMatcher(list(self.contains))
+        self.regex = []
+        for pattern, reply in (conf.get("regex") or {}).items():
+            try:
+                self.regex.append((re.compile(pattern), reply))
+            except re.error as e:
+                logger.warn("[keyword] 忽略无效的正则{}: {}".format(pattern, e))
+
+    def __len__(self):
+        return len(self.exact) + len(self.prefix) + len(self.contains) + len(self.regex)
+
+    def match(self, content):
+        """
+        :return: (匹配到的关键词, 回复内容)，没有匹配时返回None
+        """
+        reply = self.exact.get(content)
+        if reply is not None:
+            return content, reply
+        prefix = self.prefix_matcher.match(content)
+        if prefix is not None:
+            return prefix, self.prefix[prefix]
+        keyword = self.contains_matcher.find(content)
+        if keyword is not None:
+            return keyword, self.contains[keyword]
+        for pattern, reply in self.regex:
+            if pattern.search(content):
+                return pattern.pattern, reply
+        return None
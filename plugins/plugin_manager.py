@@ -1,17 +1,27 @@
 # encoding:utf-8
 
+import contextvars
+import copy
 import importlib
 import importlib.util
 import json
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
+from bridge.context import Context, ContextType
+from bridge.reply import Reply
 from common.log import logger
 from common.singleton import singleton
 from common.sorted_dict import SortedDict
-from config import conf, remove_plugin_config, write_plugin_config
+from config import conf, plugin_config, remove_plugin_config, write_plugin_config
 
 from .event import *
+from .plugin_manifest import LazyPluginInstance, PluginManifest, PluginStub, plugin_fingerprint
+from .plugin_stats import PluginStats
 
 
 @singleton
@@ -19,10 +29,18 @@ class PluginManager:
     def __init__(self):
         self.plugins = SortedDict(lambda k, v: v.priority, reverse=True)
         self.listening_plugins = {}
+        self.dispatch_table = {}  # event -> context type -> [(优先级排名, 插件名, handler, 前缀)]，按优先级排序，只包含已开启的插件
         self.instances = {}
         self.pconf = {}
         self.current_plugin_path = None
         self.loaded = {}
+        self.stats = PluginStats()  # 各插件事件处理的耗时、异常和超时统计
+        self.plugin_pool = None  # 配置了plugin_hard_timeout时执行插件事件处理函数的线程池
+        self.plugin_pool_lock = threading.Lock()
+        self.stuck_futures = set()  # 当前线程池中超时后仍在执行的插件
+        self.manifest = PluginManifest()
+        self.lazy_lock = threading.RLock()
+        self.global_config_names = set()  # 配置来自plugins/config.json的插件名(小写)，其余插件使用各自目录下的config.json
 
     def register(self, name: str, desire_priority: int = 0, **kwargs):
         def wrapper(plugincls):
@@ -35,6 +53,11 @@ class PluginManager:
             plugincls.namecn = kwargs.get("namecn") if kwargs.get("namecn") != None else name
             plugincls.hidden = kwargs.get("hidden") if kwargs.get("hidden") != None else False
             plugincls.enabled = True
+            # 插件关心的消息类型和文本前缀，为None时不过滤，用于生成emit_event的分发表，对插件的所有事件生效
+            plugincls.context_types = frozenset(kwargs["context_types"]) if kwargs.get("context_types") else None
+            plugincls.prefixes = tuple(kwargs["prefixes"]) if kwargs.get("prefixes") else None
+            # 为False时启动时总是导入并实例化，否则开启plugin_lazy_load后等到第一次收到事件才导入
+            plugincls.lazy = kwargs.get("lazy") if kwargs.get("lazy") != None else True
             if self.current_plugin_path == None:
                 raise Exception("Plugin path not set")
             self.plugins[name.upper()] = plugincls
@@ -70,6 +93,7 @@ class PluginManager:
 
         从 plugins/config.json 中加载所有插件的配置并写入 config.py 的全局配置中，供插件中使用
         插件实例中通过 config.pconf(plugin_name) 即可获取该插件的配置
+        :return: plugins/config.json中的配置，文件不存在时返回空字典
         """
         all_config_path = "./plugins/config.json"
         try:
@@ -81,19 +105,31 @@ class PluginManager:
 
                 # write to global config
                 write_plugin_config(all_conf)
+                return all_conf
         except Exception as e:
             logger.error(e)
+        return {}
 
     def scan_plugins(self):
         logger.info("Scaning plugins ...")
         plugins_dir = "./plugins"
         raws = [self.plugins[name] for name in self.plugins]
+        lazy_load = conf().get("plugin_lazy_load", False)
         for plugin_name in os.listdir(plugins_dir):
             plugin_path = os.path.join(plugins_dir, plugin_name)
             if os.path.isdir(plugin_path):
                 # 判断插件是否包含同名__init__.py文件
                 main_module_path = os.path.join(plugin_path, "__init__.py")
                 if os.path.isfile(main_module_path):
+                    fingerprint = plugin_fingerprint(plugin_path)
+                    if lazy_load and plugin_path not in self.loaded:
+                        # 目录没有变化时直接使用清单中的插件信息，等到插件第一次收到事件再导入
+                        stubs = self.manifest.get(plugin_name, fingerprint)
+                        if stubs and all(stub.lazy for stub in stubs):
+                            for stub in stubs:
+                                if stub.name.upper() not in self.plugins:
+                                    self.plugins[stub.name.upper()] = stub
+                            continue
                     # 导入插件
                     import_path = "plugins.{}".format(plugin_name)
                     try:
@@ -112,6 +148,8 @@ class PluginManager:
                     except Exception as e:
                         logger.warn("Failed to import plugin %s: %s" % (plugin_name, e))
                         continue
+                    plugin_classes = [plugincls for plugincls in self.plugins.values() if plugincls.path == plugin_path]
+                    self.manifest.update(plugin_name, fingerprint, plugin_classes)
         pconf = self.pconf
         news = [self.plugins[name] for name in self.plugins]
         new_plugins = list(set(news) - set(raws))
@@ -128,14 +166,36 @@ class PluginManager:
             else:
                 self.plugins[name].enabled = pconf["plugins"][rawname]["enabled"]
                 self.plugins[name].priority = pconf["plugins"][rawname]["priority"]
-                self.plugins._update_heap(name)  # 更新下plugins中的顺序
+                self.plugins._update_order(name)  # 更新下plugins中的顺序
         if modified:
             self.save_config()
+        self.manifest.save()
         return new_plugins
 
     def refresh_order(self):
         for event in self.listening_plugins.keys():
             self.listening_plugins[event].sort(key=lambda name: self.plugins[name].priority, reverse=True)
+        self.build_dispatch_table()
+
+    def build_dispatch_table(self):
+        """
+        插件开启、关闭、调整优先级或重新加载后重新生成分发表
+        每种消息类型只保留关心该类型的插件，context为None的事件使用key为None的表
+        """
+        dispatch_table = {}
+        for event, names in self.listening_plugins.items():
+            entries = []
+            for rank, name in enumerate(names):
+                plugincls = self.plugins[name]
+                instance = self.instances.get(name)
+                if plugincls.enabled and instance is not None and event in instance.handlers:
+                    entries.append((rank, name, instance.handlers[event], plugincls.context_types, plugincls.prefixes))
+            table = {None: [(rank, name, handler, prefixes) for rank, name, handler, _, prefixes in entries]}
+            for ctype in ContextType:
+                table[ctype] = [(rank, name, handler, prefixes) for rank, name, handler, context_types, prefixes in entries
+                                if context_types is None or ctype in context_types]
+            dispatch_table[event] = table
+        self.dispatch_table = dispatch_table
 
     def activate_plugins(self):  # 生成新开启的插件实例
         failed_plugins = []
@@ -144,61 +204,279 @@ class PluginManager:
                 if 'GODCMD' in self.instances and name == 'GODCMD':
                     continue
                 # if name not in self.instances:
-                try:
-                    instance = plugincls()
-                except Exception as e:
-                    logger.warn("Failed to init %s, diabled. %s" % (name, e))
-                    self.disable_plugin(name)
+                if not self._activate_plugin(name):
                     failed_plugins.append(name)
-                    continue
-                if name in self.instances:
-                    self.instances[name].handlers.clear()
-                self.instances[name] = instance
-                for event in instance.handlers:
-                    if event not in self.listening_plugins:
-                        self.listening_plugins[event] = []
-                    self.listening_plugins[event].append(name)
         self.refresh_order()
         return failed_plugins
 
+    def _activate_plugin(self, name: str):
+        plugincls = self.plugins[name]
+        if isinstance(plugincls, PluginStub):
+            if plugincls.events is not None:
+                instance = LazyPluginInstance(self, name, plugincls.events)
+            else:
+                # 清单中没有记录监听的事件，只能立即导入
+                plugincls = self._import_plugin(name)
+                if plugincls is None:
+                    self.disable_plugin(name)
+                    return False
+        if not isinstance(plugincls, PluginStub):
+            try:
+                instance = plugincls()
+            except Exception as e:
+                logger.warn("Failed to init %s, diabled. %s" % (name, e))
+                self.disable_plugin(name)
+                return False
+            self.manifest.set_events(os.path.basename(plugincls.path), plugincls.name, instance.handlers)
+        if name in self.instances:
+            self.instances[name].handlers.clear()
+        self.instances[name] = instance
+        for event in instance.handlers:
+            if event not in self.listening_plugins:
+                self.listening_plugins[event] = []
+            if name not in self.listening_plugins[event]:
+                self.listening_plugins[event].append(name)
+        return True
+
+    def _import_plugin(self, name: str):
+        """
+        导入清单中记录的插件，用导入后注册的插件类替换PluginStub，保留当前的开启状态和优先级
+        """
+        stub = self.plugins[name]
+        import_path = "plugins.{}".format(stub.dirname)
+        logger.info("Lazy loading plugin %s from %s" % (stub.name, stub.path))
+        try:
+            self.current_plugin_path = stub.path
+            self.loaded[stub.path] = importlib.import_module(import_path)
+        except Exception as e:
+            logger.warn("Failed to import plugin %s: %s" % (stub.dirname, e))
+            return None
+        finally:
+            self.current_plugin_path = None
+        plugincls = self.plugins.get(name)
+        if plugincls is None or isinstance(plugincls, PluginStub):
+            logger.warn("Plugin %s not registered by %s" % (name, import_path))
+            return None
+        plugincls.enabled = stub.enabled
+        plugincls.priority = stub.priority
+        self.plugins._update_order(name)
+        plugin_classes = [cls for cls in self.plugins.values() if cls.path == stub.path]
+        self.manifest.update(stub.dirname, plugin_fingerprint(stub.path), plugin_classes)
+        return plugincls
+
+    def load_lazy_plugin(self, name: str):
+        """
+        LazyPluginInstance第一次被使用时调用，导入并实例化插件后重新生成分发表，返回插件实例
+        """
+        with self.lazy_lock:
+            if not isinstance(self.plugins.get(name), PluginStub):
+                instance = self.instances.get(name)
+                return None if isinstance(instance, LazyPluginInstance) else instance
+            plugincls = self._import_plugin(name)
+            self._deactivate_plugin(name)
+            if plugincls is None:
+                self.disable_plugin(name)
+                self.build_dispatch_table()
+                return None
+            self._activate_plugin(name)
+            self.refresh_order()
+            self.manifest.save()
+            return self.instances.get(name)
+
+    def _deactivate_plugin(self, name: str):
+        for event in self.listening_plugins:
+            if name in self.listening_plugins[event]:
+                self.listening_plugins[event].remove(name)
+        if name in self.instances:
+            self.instances[name].handlers.clear()
+            del self.instances[name]
+
     def reload_plugin(self, name: str):
         name = name.upper()
         remove_plugin_config(name)
         if name in self.instances:
-            for event in self.listening_plugins:
-                if name in self.listening_plugins[event]:
-                    self.listening_plugins[event].remove(name)
-            if name in self.instances:
-                self.instances[name].handlers.clear()
-            del self.instances[name]
+            self._deactivate_plugin(name)
             self.activate_plugins()
             return True
         return False
 
+    def reload_all_config(self):
+        """
+        重新读取plugins/config.json，只重新实例化配置发生变化的插件，其他插件实例及其状态保持不变
+        :return: 重新实例化的插件名列表
+        """
+        all_config_path = "./plugins/config.json"
+        try:
+            with open(all_config_path, "r", encoding="utf-8") as f:
+                all_conf = {k.lower(): v for k, v in json.load(f).items()}
+        except Exception as e:
+            logger.error("Failed to load plugins/config.json: {}".format(e))
+            return []
+        # 只比较plugins/config.json中新增、修改或删除的部分，使用插件目录下config.json的插件不受影响
+        changed = [name for name in all_conf if all_conf[name] != plugin_config.get(name)]
+        removed = [name for name in self.global_config_names if name not in all_conf]
+        for name in removed:
+            remove_plugin_config(name)  # 重新实例化时改为读取插件目录下的config.json
+        changed += removed
+        self.global_config_names = set(all_conf)
+        write_plugin_config(all_conf)
+        reloaded = []
+        for name in changed:
+            name = name.upper()
+            if name in self.instances and name != "GODCMD":
+                logger.info("Plugin %s config changed, reloading..." % name)
+                self._deactivate_plugin(name)
+                if self._activate_plugin(name):
+                    reloaded.append(name)
+        self.refresh_order()
+        return reloaded
+
     def load_plugins(self):
         self.load_config()
         self.scan_plugins()
         # 加载全量插件配置
-        self._load_all_config()
+        self.global_config_names = {name.lower() for name in self._load_all_config()}
         pconf = self.pconf
         logger.debug("plugins.json config={}".format(pconf))
         for name, plugin in pconf["plugins"].items():
             if name.upper() not in self.plugins:
                 logger.error("Plugin %s not found, but found in plugins.json" % name)
         self.activate_plugins()
+        self.manifest.save()
 
     def emit_event(self, e_context: EventContext, *args, **kwargs):
-        if e_context.event in self.listening_plugins:
-            for name in self.listening_plugins[e_context.event]:
-                if self.plugins[name].enabled and e_context.action == EventAction.CONTINUE:
-                    logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
-                    instance = self.instances[name]
-                    instance.handlers[e_context.event](e_context, *args, **kwargs)
-                    if e_context.is_break():
-                        e_context["breaked_by"] = name
-                        logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+        table = self.dispatch_table.get(e_context.event)
+        if not table:
+            return e_context
+        context = e_context.econtext.get("context")
+        ctype = context.type if context is not None else None
+        entries = table[ctype]
+        i = 0
+        while i < len(entries) and e_context.action == EventAction.CONTINUE:
+            rank, name, handler, prefixes = entries[i]
+            i += 1
+            if prefixes and ctype == ContextType.TEXT and not context.content.startswith(prefixes):
+                continue
+            logger.debug("Plugin %s triggered by event %s" % (name, e_context.event))
+            self._call_handler(name, handler, e_context, *args, **kwargs)
+            if e_context.is_break():
+                e_context["breaked_by"] = name
+                logger.debug("Plugin %s breaked event %s" % (name, e_context.event))
+            context = e_context.econtext.get("context")
+            if context is not None and context.type != ctype:
+                # 插件修改了消息类型，改用新类型的分发表，从优先级低于当前插件的位置继续
+                ctype = context.type
+                entries = table[ctype]
+                i = 0
+                while i < len(entries) and entries[i][0] <= rank:
+                    i += 1
         return e_context
 
+    def _call_handler(self, name, handler, e_context, *args, **kwargs):
+        """
+        调用插件的事件处理函数并记录耗时，超过plugin_soft_timeout时打印警告
+        plugin_hard_timeout大于0时在独立的线程池中执行，超时后不再等待该插件，事件继续交给后续插件处理
+        hard_timeout从插件开始执行时计时，在线程池中排队的时间不计入，排队同样超过hard_timeout时取消执行
+        """
+        hard_timeout = conf().get("plugin_hard_timeout", 0)
+        start = time.perf_counter()
+        error = timeout = False
+        try:
+            if hard_timeout > 0:
+                # 插件在副本上执行，按时完成才写回，超时后插件对副本的修改不会影响后续插件和bot
+                sandbox = self._isolate_event(e_context)
+                started = threading.Event()
+
+                def run():
+                    started.set()
+                    return handler(sandbox, *args, **kwargs)
+
+                future = self._get_plugin_pool().submit(contextvars.copy_context().run, run)
+                if not started.wait(hard_timeout) and future.cancel():
+                    timeout = True
+                    logger.warning("[PluginManager] Plugin %s queued for more than %ss on event %s, skipped" % (name, hard_timeout, e_context.event))
+                else:
+                    try:
+                        future.result(timeout=hard_timeout)
+                        self._merge_event(e_context, sandbox)
+                    except FutureTimeoutError:
+                        timeout = True
+                        self._mark_stuck(future)
+                        logger.warning("[PluginManager] Plugin %s timed out on event %s after %ss, skipped" % (name, e_context.event, hard_timeout))
+            else:
+                handler(e_context, *args, **kwargs)
+        except Exception:
+            error = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stats.record(name, e_context.event, elapsed, error, timeout)
+            soft_timeout = conf().get("plugin_soft_timeout", 5)
+            if soft_timeout and elapsed > soft_timeout and not timeout:
+                logger.warning("[PluginManager] Plugin %s took %.2fs on event %s" % (name, elapsed, e_context.event))
+
+    def _get_plugin_pool(self):
+        """
+        超时后仍在执行的插件占满线程池时，换一个新的线程池，旧线程池中的插件执行完后线程自然退出
+        """
+        with self.plugin_pool_lock:
+            # 默认与处理消息的线程数相同，每个处理线程都有空闲的插件线程，插件不需要排队
+            pool_size = conf().get("plugin_pool_size") or conf().get("handler_pool_size", 8)
+            if self.plugin_pool is None or len(self.stuck_futures) >= pool_size:
+                if self.plugin_pool is not None:
+                    logger.warning("[PluginManager] %d plugin handlers still running after timeout, start a new pool" % len(self.stuck_futures))
+                    self.plugin_pool.shutdown(wait=False)
+                self.plugin_pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="plugin")
+                self.stuck_futures = set()
+            return self.plugin_pool
+
+    def _mark_stuck(self, future):
+        with self.plugin_pool_lock:
+            stuck_futures = self.stuck_futures
+            stuck_futures.add(future)
+
+        def discard(f):
+            with self.plugin_pool_lock:
+                stuck_futures.discard(f)
+
+        future.add_done_callback(discard)
+
+    @staticmethod
+    def _isolate_event(e_context: EventContext) -> EventContext:
+        """
+        复制事件上下文，context和reply也复制一层
+        """
+        econtext = dict(e_context.econtext)
+        clones = {}  # 副本 -> 原对象
+        for key, value in econtext.items():
+            if isinstance(value, (Context, Reply)):
+                clone = copy.copy(value)
+                if isinstance(clone, Context):
+                    clone.kwargs = dict(clone.kwargs)
+                clones[id(clone)] = (clone, value)
+                econtext[key] = clone
+        sandbox = EventContext(e_context.event, econtext)
+        sandbox.action = e_context.action
+        sandbox.clones = clones
+        return sandbox
+
+    @staticmethod
+    def _merge_event(e_context: EventContext, sandbox: EventContext):
+        """
+        将插件对副本的修改写回原事件上下文；插件原地修改的context和reply写回原对象，调用方持有的引用也能看到修改
+        """
+        original = e_context.econtext
+        for key in list(original):
+            if key not in sandbox.econtext:
+                del original[key]
+        for key, value in sandbox.econtext.items():
+            clone, target = sandbox.clones.get(id(value), (None, None))
+            if clone is value:
+                target.__dict__.update(value.__dict__)
+                value = target
+            original[key] = value
+        e_context.action = sandbox.action
+
     def set_plugin_priority(self, name: str, priority: int):
         name = name.upper()
         if name not in self.plugins:
@@ -206,10 +484,10 @@ class PluginManager:
         if self.plugins[name].priority == priority:
             return True
         self.plugins[name].priority = priority
-        self.plugins._update_heap(name)
+        self.plugins._update_order(name)
         rawname = self.plugins[name].name
         self.pconf["plugins"][rawname]["priority"] = priority
-        self.pconf["plugins"]._update_heap(rawname)
+        self.pconf["plugins"]._update_order(rawname)
         self.save_config()
         self.refresh_order()
         return True
@@ -238,6 +516,7 @@ class PluginManager:
             rawname = self.plugins[name].name
             self.pconf["plugins"][rawname]["enabled"] = False
             self.save_config()
+            self.build_dispatch_table()
             return True
         return True
 
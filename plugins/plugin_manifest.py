@@ -0,0 +1,175 @@
+import json
+import os
+import threading
+
+from bridge.context import ContextType
+from common.log import logger
+from config import get_appdata_dir
+
+from .event import Event
+
+
+def plugin_fingerprint(plugin_path):
+    """
+    插件目录下所有.py文件的数量和最大修改时间，任一文件新增、删除或修改后都会变化
+    """
+    count = 0
+    latest = 0
+    for root, dirs, files in os.walk(plugin_path):
+        dirs[:] = [d for d in dirs if d != "__pycache__"]
+        for file in files:
+            if file.endswith(".py"):
+                count += 1
+                latest = max(latest, os.stat(os.path.join(root, file)).st_mtime_ns)
+    return "{}:{}".format(count, latest)
+
+
+class PluginStub(object):
+    """
+    尚未导入的插件，属性与register写入插件类的属性相同，由清单中缓存的扫描结果生成
+    """
+
+    def __init__(self, dirname, info):
+        self.dirname = dirname
+        self.name = info["name"]
+        self.priority = info["priority"]
+        self.desc = info.get("desc")
+        self.author = info.get("author")
+        self.path = info["path"]
+        self.version = info.get("version", "1.0")
+        self.namecn = info.get("namecn", self.name)
+        self.hidden = info.get("hidden", False)
+        self.lazy = info.get("lazy", True)
+        self.enabled = True
+        self.context_types = frozenset(ContextType[t] for t in info["context_types"]) if info.get("context_types") else None
+        self.prefixes = tuple(info["prefixes"]) if info.get("prefixes") else None
+        # 插件实例监听的事件，插件从未实例化过时为None，开启时需要先导入
+        self.events = [Event[e] for e in info["events"]] if info.get("events") is not None else None
+
+
+class LazyPluginInstance(object):
+    """
+    PluginStub开启后的实例，第一次收到事件或访问其他属性时才导入并实例化插件，之后转交给真正的插件实例
+    """
+
+    def __init__(self, manager, name, events):
+        self.manager = manager
+        self.name = name
+        self.handlers = {event: self._make_handler(event) for event in events}
+
+    def _make_handler(self, event):
+        def handler(e_context, *args, **kwargs):
+            instance = self.manager.load_lazy_plugin(self.name)
+            if instance is not None and event in instance.handlers:
+                instance.handlers[event](e_context, *args, **kwargs)
+
+        return handler
+
+    def __getattr__(self, attr):
+        instance = self.manager.load_lazy_plugin(self.name)
+        if instance is None:
+            raise AttributeError(attr)
+        return getattr(instance, attr)
+
+
+class PluginManifest(object):
+    """
+    插件扫描结果的缓存，按插件目录记录目录指纹和其中注册的插件信息，目录未变化时启动无需导入插件即可得到插件列表
+    """
+
+    def __init__(self, path=None):
+        self._path = path  # 默认为数据目录下的plugins_manifest.json，PluginManager创建时配置还未加载，第一次使用时再确定
+        self._entries = None  # 目录名 -> {"fingerprint": 目录指纹, "plugins": [插件信息]}
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = os.path.join(get_appdata_dir(), "plugins_manifest.json")
+        return self._path
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._entries = {}
+            if os.path.exists(self.path):
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        self._entries = json.load(f)
+                except Exception as e:
+                    logger.warn("Failed to load plugin manifest %s: %s" % (self.path, e))
+        return self._entries
+
+    def get(self, dirname, fingerprint):
+        """
+        返回目录对应的PluginStub列表，目录有变化或没有缓存时返回None
+        """
+        entry = self.entries.get(dirname)
+        if not entry or entry.get("fingerprint") != fingerprint or not entry.get("plugins"):
+            return None
+        try:
+            return [PluginStub(dirname, info) for info in entry["plugins"]]
+        except Exception as e:
+            logger.warn("Invalid plugin manifest for %s: %s" % (dirname, e))
+            return None
+
+    def update(self, dirname, fingerprint, plugin_classes):
+        """
+        导入目录后记录其中注册的插件，目录未变化时保留已记录的事件
+        """
+        with self.lock:
+            old = self.entries.get(dirname)
+            events = {}
+            if old and old.get("fingerprint") == fingerprint:
+                events = {info["name"]: info.get("events") for info in old.get("plugins", [])}
+            plugins = []
+            for plugincls in plugin_classes:
+                plugins.append(
+                    {
+                        "name": plugincls.name,
+                        "priority": plugincls.priority,
+                        "desc": plugincls.desc,
+                        "author": plugincls.author,
+                        "path": plugincls.path,
+                        "version": plugincls.version,
+                        "namecn": plugincls.namecn,
+                        "hidden": plugincls.hidden,
+                        "lazy": plugincls.lazy,
+                        "context_types": sorted(t.name for t in plugincls.context_types) if plugincls.context_types else None,
+                        "prefixes": list(plugincls.prefixes) if plugincls.prefixes else None,
+                        "events": events.get(plugincls.name),
+                    }
+                )
+            entry = {"fingerprint": fingerprint, "plugins": plugins}
+            if old != entry:
+                self.entries[dirname] = entry
+                self.dirty = True
+
+    def set_events(self, dirname, name, events):
+        """
+        插件实例化后记录其监听的事件
+        """
+        with self.lock:
+            entry = self.entries.get(dirname)
+            if not entry:
+                return
+            event_names = sorted(event.name for event in events)
+            for info in entry["plugins"]:
+                if info["name"] == name and info.get("events") != event_names:
+                    info["events"] = event_names
+                    self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(self.entries, f, indent=4, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+                self.dirty = False
+            except Exception as e:
+                logger.warn("Failed to save plugin manifest %s: %s" % (self.path, e))
+
@@ -0,0 +1,71 @@
+import threading
+
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10)  # 耗时直方图的桶上界，单位秒
+
+
+class PluginStat(object):
+    """
+    单个插件处理单个事件的调用次数、耗时直方图、异常和超时次数
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, elapsed, error=False, timeout=False):
+        self.calls += 1
+        self.errors += int(error)
+        self.timeouts += int(timeout)
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def percentile(self, p):
+        """
+        返回第p百分位所在桶的上界，落在最后一个桶时返回最大耗时
+        """
+        target = self.calls * p / 100
+        count = 0
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            count += self.buckets[i]
+            if count >= target:
+                return min(bound, self.max_time)
+        return self.max_time
+
+
+class PluginStats(object):
+    """
+    所有插件的调用统计，key为(插件名, 事件)
+    """
+
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, event, elapsed, error=False, timeout=False):
+        with self.lock:
+            stat = self.stats.get((name, event))
+            if stat is None:
+                stat = self.stats[(name, event)] = PluginStat()
+            stat.record(elapsed, error, timeout)
+
+    def summary(self):
+        """
+        按总耗时从高到低返回[(插件名, 事件, PluginStat)]
+        """
+        with self.lock:
+            items = [(name, event, stat) for (name, event), stat in self.stats.items()]
+        return sorted(items, key=lambda item: item[2].total_time, reverse=True)
+
+    def clear(self):
+        with self.lock:
+            self.stats.clear()
@@ -1,7 +1,9 @@
 # encoding:utf-8
 
+import difflib
 import json
 import os
+from collections import Counter
 
 import plugins
 from bridge.bridge import Bridge
@@ -32,6 +34,47 @@ class RolePlay:
         return prompt
 
 
+class RoleIndex:
+    """
+    角色名的字符倒排索引，模糊查找时先用共同字符数估算相似度上界剪枝，再对剩下的候选计算SequenceMatcher相似度
+    上界与SequenceMatcher.quick_ratio相同，结果与逐个比较所有角色一致
+    """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.postings = {}  # 字符 -> [(角色序号, 该字符在角色名中出现的次数)]
+        for i, name in enumerate(self.names):
+            for ch, count in Counter(name).items():
+                self.postings.setdefault(ch, []).append((i, count))
+
+    def closest(self, name, min_sim):
+        """
+        返回与name相似度不低于min_sim的最相似角色名，相似度相同时取靠后的，与原先逐个比较的结果相同
+        """
+        common = {}
+        for ch, count in Counter(name).items():
+            for i, role_count in self.postings.get(ch, ()):
+                common[i] = common.get(i, 0) + min(count, role_count)
+        if min_sim <= 0:
+            # 相似度下限为0时没有共同字符的角色也可能被选中
+            for i in range(len(self.names)):
+                common.setdefault(i, 0)
+        candidates = []
+        for i, matches in common.items():
+            bound = 2.0 * matches / (len(name) + len(self.names[i]))
+            if bound >= min_sim:
+                candidates.append((bound, i))
+        candidates.sort(reverse=True)
+        best_sim, best = min_sim, None
+        for bound, i in candidates:
+            if bound < best_sim:
+                break
+            sim = difflib.SequenceMatcher(None, name, self.names[i]).ratio()
+            if sim > best_sim or (sim == best_sim and (best is None or i > best)):
+                best_sim, best = sim, i
+        return None if best is None else self.names[best]
+
+
 @plugins.register(
     name="Role",
     desire_priority=0,
@@ -39,6 +82,7 @@ class RolePlay:
     desc="为你的Bot设置预设角色",
     version="1.0",
     author="lanvent",
+    context_types=[ContextType.TEXT],
 )
 class Role(Plugin):
     def __init__(self):
@@ -61,6 +105,12 @@ class Role(Plugin):
                     if len(self.tags[tag][1]) == 0:
                         logger.debug(f"[Role] no role found for tag {tag} ")
                         del self.tags[tag]
+                self.role_index = RoleIndex(self.roles)
+                # 预先生成各角色类型的角色列表，查看角色类型时不再遍历所有角色
+                self.tag_names = {desc: tag for tag, (desc, _) in reversed(list(self.tags.items()))}
+                self.tag_listings = {tag: "".join(f"{role['title']}: {role['remark']}\n" for role in roles) for tag, (_, roles) in self.tags.items()}
+                self.all_roles_listing = "".join(f"{role['title']}: {role['remark']}\n" for role in self.roles.values())
+                self.tags_text = "，".join([self.tags[tag][0] for tag in self.tags])
 
             if len(self.roles) == 0:
                 raise Exception("no role found")
@@ -80,19 +130,7 @@ class Role(Plugin):
         if name in self.roles:
             found_role = name
         elif find_closest:
-            import difflib
-
-            def str_simularity(a, b):
-                return difflib.SequenceMatcher(None, a, b).ratio()
-
-            max_sim = min_sim
-            max_role = None
-            for role in self.roles:
-                sim = str_simularity(name, role)
-                if sim >= max_sim:
-                    max_sim = sim
-                    max_role = role
-            found_role = max_role
+            found_role = self.role_index.closest(name, min_sim)
         return found_role
 
     def on_handle_context(self, e_context: EventContext):
@@ -127,24 +165,19 @@ class Role(Plugin):
             if len(clist) > 1:
                 tag = clist[1].strip()
                 help_text = "角色列表：\n"
-                for key, value in self.tags.items():
-                    if value[0] == tag:
-                        tag = key
-                        break
+                tag = self.tag_names.get(tag, tag)
                 if tag == "所有":
-                    for role in self.roles.values():
-                        help_text += f"{role['title']}: {role['remark']}\n"
+                    help_text += self.all_roles_listing
                 elif tag in self.tags:
-                    for role in self.tags[tag][1]:
-                        help_text += f"{role['title']}: {role['remark']}\n"
+                    help_text += self.tag_listings[tag]
                 else:
                     help_text = f"未知角色类型。\n"
                     help_text += "目前的角色类型有: \n"
-                    help_text += "，".join([self.tags[tag][0] for tag in self.tags]) + "\n"
+                    help_text += self.tags_text + "\n"
             else:
                 help_text = f"请输入角色类型。\n"
                 help_text += "目前的角色类型有: \n"
-                help_text += "，".join([self.tags[tag][0] for tag in self.tags]) + "\n"
+                help_text += self.tags_text + "\n"
             reply = Reply(ReplyType.INFO, help_text)
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
@@ -196,7 +229,7 @@ class Role(Plugin):
         help_text += f"{trigger_prefix}停止扮演: 清除设定的角色。\n"
         help_text += f"{trigger_prefix}角色类型" + " 角色类型: 查看某类{角色类型}的所有预设角色，为所有时输出所有预设角色。\n"
         help_text += "\n目前的角色类型有: \n"
-        help_text += "，".join([self.tags[tag][0] for tag in self.tags]) + "。\n"
+        help_text += self.tags_text + "。\n"
         help_text += f"\n命令例子: \n{trigger_prefix}角色 写作助理\n"
         help_text += f"{trigger_prefix}角色类型 所有\n"
         help_text += f"{trigger_prefix}停止扮演\n"
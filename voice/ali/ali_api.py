@@ -11,7 +11,7 @@ Description:
 import http.client
 import json
 import time
-import requests
+from common import http_client
 import datetime
 import hashlib
 import hmac
@@ -47,7 +47,7 @@ def text_to_speech_aliyun(url, text, appkey, token):
         "format": "wav"
     }
 
-    response = requests.post(url, headers=headers, data=json.dumps(data))
+    response = http_client.post(url, headers=headers, data=json.dumps(data))
 
     if response.status_code == 200 and response.headers['Content-Type'] == 'audio/mpeg':
         output_file = TmpDir().path() + "reply-" + str(int(time.time())) + "-" + str(hash(text) & 0x7FFFFFFF) + ".wav"
@@ -211,6 +211,6 @@ class AliyunTokenGenerator:
         url = 'http://nls-meta.cn-shanghai.aliyuncs.com/?' + urllib.parse.urlencode(params)
 
         # 发送请求
-        response = requests.get(url)
+        response = http_client.get(url)
 
         return response.text